@@ -1,22 +1,66 @@
+import time
+startup_times = [("start", time.perf_counter())]
+
 import cmd
+import importlib
 import os, sys
 try:
     import readline
 except:
     readline = None
 import re
-import argparse
 import shlex
 import signal
-from fuzzywuzzy import process as fuzz
+import sqlite3
 import textwrap
-
-from pyautogui import press
+import types
+# argparse, fuzzywuzzy and pyautogui are slow to import, so
+# they are imported by the commands which need them instead.
+startup_times.append(("standard library", time.perf_counter()))
 
 from .cli_util import *
+startup_times.append(("cli_util", time.perf_counter()))
 
 real_print = print
 
+# Commands which live in their own modules, mapped to the name of the
+# module. A module is only imported the first time one of its commands
+# (or that command's help) is used, which keeps startup fast no matter
+# how many commands there are. The module must define a function
+# do_<command>(clee, line), and may define complete_<command> and
+# help_<command> in the same way.
+lazy_commands = {
+    "atfgrep": "atfgrep",
+    "export": "htmlexport",
+    "kwic": "kwic",
+    "numerals": "numerals",
+    "query": "query",
+    "select": "selection",
+    "similar": "similar",
+    "snapshot": "snapshot",
+    "sync": "journal",
+}
+
+def mark_startup(phase):
+    startup_times.append((phase, time.perf_counter()))
+
+def print_startup_profile():
+    print("Startup profile:")
+    for (_, prev), (phase, now) in zip(startup_times, startup_times[1:]):
+        print(f"  {phase:24} {(now-prev)*1000:8.1f} ms")
+    total = startup_times[-1][1] - startup_times[0][1]
+    print(f"  {'prompt ready after':24} {total*1000:8.1f} ms")
+
+    # Report the work which was deferred until the first command:
+    start = time.perf_counter()
+    db.execute("SELECT 1")
+    opened = time.perf_counter()
+    len(canonical_uids)
+    loaded = time.perf_counter()
+    print("Deferred to first use:")
+    print(f"  {'open database':24} {(opened-start)*1000:8.1f} ms")
+    print(f"  {'load UIDs':24} {(loaded-opened)*1000:8.1f} ms")
+
 def getYesNo(question):
     ans = None
     while ans not in ["Y", "N"]:
@@ -24,6 +68,8 @@ def getYesNo(question):
     return ans == "Y"
 
 def extract_refs(comment):
+    from fuzzywuzzy import process as fuzz
+
     objrefs = []
     signrefs = []
 
@@ -49,17 +95,9 @@ def extract_refs(comment):
                 objrefs.append((u,p))
 
     for sign in re.findall(r'M[0-9X]{1,3}[-~a-zA-Z0-9+|]*', comment):
-        canonical = ''
-        sign = sign.upper()
-        for Mgroup, rest in re.findall(r'M([0-9X]+)([^M]*)', sign):
-            if 'X' in Mgroup:
-                number = 'XXX'
-            else:
-                number = f"{int(Mgroup):03}"
-            canonical += "M" + number + rest 
-        query = cursor.execute("SELECT SignID FROM Signs WHERE DahlName = ?", (canonical,))
-        if rows := query.fetchall():
-            for (signid,) in rows:
+        canonical = signlist.normalize(sign)
+        if ids := signlist.ids(canonical):
+            for signid in ids:
                 signrefs.append((signid, canonical))
         else:
             signrefs.append((None, canonical))
@@ -100,14 +138,45 @@ class CLEE(cmd.Cmd):
 
     prompt = "\n┏" + "━"*70 + "\n┗ CLEE > "
 
-    selection = set()
+    # Tablets chosen with the select command, as a bitmap
+    # (see clee.selection).
+    selection = 0
     # Number of UIDs to print when showing selected objects.
     selection_limit = 10
 
     def __init__(self):
         super().__init__()
         self.ignore = False
+        self.startup_profile = False
+        # Warm caches in the background while waiting for the first
+        # command (see clee.warm)
+        self.warm = False
+        self.warmer = None
+
+    def get_names(self):
+        return super().get_names() + [f"do_{command}" for command in lazy_commands]
+
+    def __getattr__(self, name):
+        # Only called for attributes which don't exist yet, i.e. for
+        # commands which haven't been imported from lazy_commands.
+        prefix, _, command = name.partition("_")
+        if prefix in ["do", "complete", "help"] and command in lazy_commands:
+            module = importlib.import_module(f".{lazy_commands[command]}", __package__)
+            if hasattr(module, name):
+                return types.MethodType(getattr(module, name), self)
+        raise AttributeError(name)
     
+    def split_filter(self, line):
+        """
+        Split a trailing "in EXPRESSION" selection filter off a command.
+        Returns the rest of the command and the bitmap of the selected
+        texts, or None if there is no filter.
+        """
+        if " in " not in line:
+            return line, None
+        from .selection import split_filter
+        return split_filter(line, self.selection)
+
     def completion(self, text, line, options):
         mline = line.partition(' ')[2]
         offs = len(mline) - len(text)
@@ -124,10 +193,13 @@ class CLEE(cmd.Cmd):
         atf P009309
         """
         try:
-            with open(os.path.join(atf_path, f"{line}.atf")) as fp:
-                print(fp.read())
-        except:
+            print(read_atf(line))
+        except KeyError:
             print(f"Could not find ATF file for {line}")
+        except (ValueError, OSError) as e:
+            # a corrupt ATF store, or ATF which isn't UTF-8
+            # (UnicodeDecodeError is a ValueError)
+            print(f"Could not read the ATF for {line}: {e}")
 
     def do_grep(self, line):
         """
@@ -135,6 +207,7 @@ class CLEE(cmd.Cmd):
 
         Usage:
         grep pattern
+        grep pattern in selection
         -- right now, pattern must be a single M-sign. More complex
            patterns will be supported in the future.
 
@@ -142,33 +215,24 @@ class CLEE(cmd.Cmd):
         grep M004~b
 
         grep M157+M288
+
+        grep M157 in @susa
+        -- only shows texts in the saved selection @susa (see "? select")
         """
+        try:
+            line, within = self.split_filter(line)
+        except ValueError as e:
+            print(e)
+            return
         if sign := is_sign(line):
-            if "+" in sign:
-                components = sign.split("+")
-
-                # TODO extract to a method to reduce duplication
-                # cf. repeated code in do_describe
-                try:
-                    (left_id,) = cursor.execute("SELECT SignID FROM Signlist WHERE DahlName = ?", (components[0],)).fetchone()
-                    (middle_id,) = cursor.execute("SELECT SignID FROM Signlist WHERE DahlName = ?", (components[1],)).fetchone()
-                    if len(components) == 3:
-                        (right_id,) = cursor.execute("SELECT SignID FROM Signlist WHERE DahlName = ?", (components[2],)).fetchone()
-                except:
-                    return
-                if len(components) == 3:
-                    texts = get_texts_by_cg(left_id, middle_id, right_id)
-                else:
-                    texts = get_texts_by_cg(left_id, middle_id)
-            else:
-                try:
-                    (sign_id, base_name) = cursor.execute("SELECT SignID, BaseName from Signlist WHERE DahlName = ?", (sign,)).fetchone()
-                except:
-                    sign_id = None
-                if sign_id:
-                    texts = get_texts_by_sign(sign_id)
-                else:
-                    return
+            # highlight the sign as describe names it, e.g. M56 -> M056
+            sign = signlist.normalize(sign)
+            texts = get_texts(sign)
+            if texts is None:
+                return
+            if within is not None:
+                from .selection import contains
+                texts = [(uid, count) for uid, count in texts if contains(within, uid)]
             list_idx = 0
             # Monkeypatch print to highlight strings
             # matching the given pattern
@@ -217,6 +281,7 @@ class CLEE(cmd.Cmd):
         rename P009001:4:sgn:0 M157~a
         -- relabels P009001:4:sgn:0 (the first sign of P009001) as M157~a
         """
+        import argparse
         parser = argparse.ArgumentParser(exit_on_error=False)
         parser.error = lambda x: print(x)
         parser.add_argument(
@@ -235,9 +300,13 @@ class CLEE(cmd.Cmd):
             print(f"Unknown UID: {args._id}")
             return
 
-        name = args._name.upper()
-        cursor.execute("SELECT SignID FROM Signlist WHERE DahlName = ?", (name,))
-        if not (rows := cursor.fetchall()):
+        # remember the current labels, to detect changes by another
+        # session while we wait for the user
+        cursor.execute("SELECT Attribute, Value FROM ObjectAttributeValue WHERE UID = ? AND Attribute IN ('DahlName', 'SignID') ORDER BY Attribute", (uid,))
+        before = cursor.fetchall()
+
+        name = signlist.normalize(args._name)
+        if not (rows := signlist.ids(name)):
             allowMissing = getYesNo(f"WARNING: no sign called {name} exists in the Signlist. Do you want to proceed?")
             if allowMissing:
                 sign_id = -1
@@ -249,11 +318,19 @@ class CLEE(cmd.Cmd):
             print("Aborting")
             return
         else:
-            (sign_id,) = rows[0]
+            (sign_id,) = rows
 
-        cursor.execute("UPDATE ObjectAttributeValue SET Value = ? WHERE UID = ? AND Attribute = 'DahlName'", (name, uid))
-        cursor.execute("UPDATE ObjectAttributeValue SET Value = ? WHERE UID = ? AND Attribute = 'SignID'", (sign_id, uid))
-        db.commit()
+        try:
+            from .journal import journaled
+            with transaction() as cur, journaled(cur, f"rename {uid} {name}", [(uid, 'DahlName'), (uid, 'SignID')]):
+                cur.execute("SELECT Attribute, Value FROM ObjectAttributeValue WHERE UID = ? AND Attribute IN ('DahlName', 'SignID') ORDER BY Attribute", (uid,))
+                if cur.fetchall() != before:
+                    raise WriteConflict(f"{uid} was relabelled by another session; not renaming it.")
+                cur.execute("UPDATE ObjectAttributeValue SET Value = ? WHERE UID = ? AND Attribute = 'DahlName'", (name, uid))
+                cur.execute("UPDATE ObjectAttributeValue SET Value = ? WHERE UID = ? AND Attribute = 'SignID'", (sign_id, uid))
+        except (WriteConflict, sqlite3.OperationalError) as e:
+            print(e)
+            return
 
         print(f"Updated token {uid} with DahlName {name} (SignID {sign_id})")
         
@@ -281,6 +358,7 @@ class CLEE(cmd.Cmd):
         """
         # annotate UID attribute value
         # prompt if exists
+        import argparse
         parser = argparse.ArgumentParser(exit_on_error=False)
         parser.error = lambda x: print(x)
         parser.add_argument(
@@ -325,18 +403,25 @@ class CLEE(cmd.Cmd):
                 else:
                     action = 'none'
 
-            if action == 'add':
-                cursor.execute("INSERT INTO ObjectAttributeValue VALUES (?, ?, ?)", (args._id, args._attr, value))
-                db.commit()
-            elif action == 'update':
-                cursor.execute("UPDATE ObjectAttributeValue SET Value = ? WHERE UID = ? AND Attribute = ?", (value, args._id, args._attr))
-                db.commit()
-            elif action == 'delete':
-                cursor.execute("DELETE FROM ObjectAttributeValue WHERE UID = ? AND Attribute = ? AND Value = ?", (args._id, args._attr, value))
-                db.commit()
-            elif action == 'rename':
-                cursor.execute("UPDATE ObjectAttributeValue SET Attribute = ? WHERE UID = ? AND Attribute = ?", (value, args._id, args._attr))
-                db.commit()
+            if action == 'none':
+                return
+            from .journal import journaled
+            cells = [(args._id, args._attr)] + ([(args._id, value)] if action == 'rename' else [])
+            command = shlex.join(["annotate", action, args._id, args._attr, value])
+            with transaction() as cur, journaled(cur, command, cells):
+                # the user may have spent a while at the prompt: make sure
+                # nobody else changed this attribute in the meantime
+                cur.execute("SELECT * FROM ObjectAttributeValue WHERE UID = ? AND Attribute = ?", (args._id,args._attr))
+                if sorted(cur.fetchall()) != sorted(current):
+                    raise WriteConflict(f"{args._id}'s {args._attr} was changed by another session; nothing was written. Check the new value with \"describe {args._id}\".")
+                if action == 'add':
+                    cur.execute("INSERT INTO ObjectAttributeValue VALUES (?, ?, ?)", (args._id, args._attr, value))
+                elif action == 'update':
+                    cur.execute("UPDATE ObjectAttributeValue SET Value = ? WHERE UID = ? AND Attribute = ?", (value, args._id, args._attr))
+                elif action == 'delete':
+                    cur.execute("DELETE FROM ObjectAttributeValue WHERE UID = ? AND Attribute = ? AND Value = ?", (args._id, args._attr, value))
+                elif action == 'rename':
+                    cur.execute("UPDATE ObjectAttributeValue SET Attribute = ? WHERE UID = ? AND Attribute = ?", (value, args._id, args._attr))
 
         except Exception as e:
             print(e)
@@ -357,6 +442,7 @@ class CLEE(cmd.Cmd):
         Usage:
         describe uid
         describe dahlname
+        describe dahlname in selection
         
         Examples:
         describe P008791
@@ -372,7 +458,20 @@ class CLEE(cmd.Cmd):
         -- prints information about the sign M106+M288, including its frequency and a list of 
            texts where it occurs. Frequency information is computed on-the-fly from the database
            to ensure that it remains up-to-date.
+
+        describe M106+M288 in provenience=Susa and not @checked
+        -- only counts attestations in texts matching the selection (see "? select")
+
+        describe M4
+        -- M4 is short for M004. As M004 has variants, also lists the attestations of M004
+           and its variants together, with a count for each variant.
         """
+        try:
+            line, within = self.split_filter(line)
+        except ValueError as e:
+            print(e)
+            return
+
         # Try to parse input as...
         # UID
         if uid := is_uid(line):
@@ -380,64 +479,40 @@ class CLEE(cmd.Cmd):
 
         # Sign name
         elif sign := is_sign(line):
-            line = sign
-            show_texts = True
+            line = sign = signlist.normalize(sign)
 
-            try:
-                (sign_id,base_name) = cursor.execute("SELECT SignID, BaseName from Signlist WHERE DahlName = ?", (sign,)).fetchone()
+            if (sign_id := signlist.id(sign)) is not None:
+                base_name = signlist.base(sign)
+                variants = [name for name in signlist.variants(sign) if name != sign]
                 if base_name != sign:
                     draw_header("variants")
                     print(f"{sign} (sign id {sign_id}) is a variant of {base_name}\n")
-                else:
-                     cursor.execute("SELECT SignID, DahlName from Signlist WHERE BaseName = ? AND DahlName != ?", (base_name,sign))
-                     if rows := cursor.fetchall():
-                        draw_header("variants")
-                        print(f"{sign} (sign id {sign_id}) has variants {', '.join([r for _, r in rows])}\n")
+                elif variants:
+                    draw_header("variants")
+                    print(f"{sign} (sign id {sign_id}) has variants {', '.join(variants)}\n")
 
                 show_comments_by_sign(sign_id, sign)
 
-            except:
+            elif "+" not in sign:
                 print(f"{sign} looks like a sign name, but it's not in the signlist.\n")
-                show_texts = False
+                return
 
             if "+" in sign:
-                components = sign.split("+")
-
-                try:
-                    (left_id,) = cursor.execute("SELECT SignID FROM Signlist WHERE DahlName = ?", (components[0],)).fetchone()
-                    draw_header("components")
-                    print(f"The component {components[0]} has sign id {left_id}")
-                except:
-                    print(f"The component {components[0]} is not in the signlist")
-                    show_texts = False
-                try:
-                    (middle_id,) = cursor.execute("SELECT SignID FROM Signlist WHERE DahlName = ?", (components[1],)).fetchone()
-                    print(f"The component {components[1]} has sign id {middle_id}")
-                except:
-                    print(f"The component {components[1]} is not in the signlist")
-                    show_texts = False
-                try:
-                    if len(components) == 3:
-                        (right_id,) = cursor.execute("SELECT SignID FROM Signlist WHERE DahlName = ?", (components[2],)).fetchone()
-                        print(f"The component {components[2]} has sign id {right_id}")
-                except:
-                    print(f"The component {components[3]} is not in the signlist")
-                    show_texts = False
-                
-                print()
-                if show_texts:
-                    if len(components) == 3:
-                        texts = get_texts_by_cg(left_id, middle_id, right_id)
+                draw_header("components")
+                for component, component_id in signlist.components(sign):
+                    if component_id is None:
+                        print(f"The component {component} is not in the signlist")
                     else:
-                        texts = get_texts_by_cg(left_id, middle_id)
-                else:
-                    return
+                        print(f"The component {component} has sign id {component_id}")
+                print()
 
-            elif show_texts:
-                texts = get_texts_by_sign(sign_id)
-            else:
+            if (texts := get_texts(sign)) is None:
                 return
 
+            if within is not None:
+                from .selection import contains
+                texts = [(uid, count) for uid, count in texts if contains(within, uid)]
+
             draw_header("attestations")
             print(f"{sign} is attested {sum([c for _, c in texts])} times in {len(texts)} texts:")
             attestations = ', '.join(
@@ -448,6 +523,9 @@ class CLEE(cmd.Cmd):
                 print(line)
             print()
 
+            if "+" not in sign and signlist.base(sign) == sign and len(signlist.variants(sign)) > 1:
+                show_variant_attestations(sign, within)
+
         else:
             print(f"Unknown identifier: '{line}'")
 
@@ -486,6 +564,7 @@ class CLEE(cmd.Cmd):
         -- since CLEE cannot automatically detect N-signs at the moment, -s is used to link the comment to N39B
         -- CLEE will recognize shorthands like M56 as referring to M056
         """
+        import argparse
         parser = argparse.ArgumentParser(exit_on_error=False)
         parser.add_argument(
             'comment',
@@ -527,11 +606,8 @@ class CLEE(cmd.Cmd):
                 extracted_uid.append(canonical_uids[uid])
             # verify type references
             for sign in args.sign[-1]:
-                sign = sign.upper()
-                query = cursor.execute("SELECT SignID FROM Signs WHERE DahlName = ?", (sign,))
-                if rows := query.fetchall():
-                    for (signid,) in rows:
-                        extracted_sign.append(signid)
+                if ids := signlist.ids(sign):
+                    extracted_sign.extend(ids)
                 else:
                     raise ValueError(f"Sign not found: {sign}.")
 
@@ -539,16 +615,20 @@ class CLEE(cmd.Cmd):
             if len(extracted_uid) == len(extracted_sign) == 0:
                 add = getYesNo("This comment does not refer to any objects or signs. Add it anyways?")
             print("Inserting comment...")
-            cursor.execute("INSERT INTO Comment(Comment) VALUES (?)", (comment,))
-            commentid = cursor.lastrowid
+            from .journal import record_comment
+            with transaction() as cur:
+                cur.execute("INSERT INTO Comment(Comment) VALUES (?)", (comment,))
+                commentid = cur.lastrowid
+                for uid in extracted_uid:
+                    cur.execute("INSERT INTO ReferencesObject(CommentID, UID) VALUES (?, ?)", (commentid, uid))
+                for signid in extracted_sign:
+                    cur.execute("INSERT INTO ReferencesSign(CommentID, SignID) VALUES (?, ?)", (commentid, signid))
+                record_comment(cur, f"comment {shlex.quote(comment)}", comment, extracted_uid, extracted_sign)
             print(f"Inserted comment with CommentID = {commentid}")
             for uid in extracted_uid:
-                cursor.execute("INSERT INTO ReferencesObject(CommentID, UID) VALUES (?, ?)", (commentid, uid))
                 print(f"Linked comment {commentid} to object {uid}")
             for signid in extracted_sign:
-                cursor.execute("INSERT INTO ReferencesSign(CommentID, SignID) VALUES (?, ?)", (commentid, signid))
                 print(f"Linked comment {commentid} to sign {signid}")
-            db.commit()
         except Exception as e:
             print(e)
             print("Errors occured, comment not recorded.")
@@ -557,7 +637,19 @@ class CLEE(cmd.Cmd):
     def preloop(self):
         if readline and os.path.exists(histfile):
             readline.read_history_file(histfile)
+        mark_startup("read history")
+        if self.startup_profile:
+            print_startup_profile()
+        if self.warm:
+            from .warm import start
+            self.warmer = start()
     def precmd(self, line):
+        if self.warmer and line:
+            # the command gets the database to itself
+            self.warmer.stop()
+        if line:
+            refresh_memory()
+
         if self.ignore:
             self.ignore = False
             return ' '
@@ -568,6 +660,7 @@ class CLEE(cmd.Cmd):
         if readline:
             readline.set_history_length(histfile_size)
             readline.write_history_file(histfile)
+        start_command()
 
         line = line.strip()
         line = re.sub("", "", line)
@@ -588,6 +681,8 @@ class CLEE(cmd.Cmd):
         return self.close()
 
     def close(self):
+        if self.warmer:
+            self.warmer.stop()
         print("Goodbye")
         return True
 
@@ -604,11 +699,21 @@ def ctrl_c(clee):
         # simulate user pressing Enter, to
         # clear the input buffer and print a
         # clean prompt
+        from pyautogui import press
         press("Enter")
     return handler
 
 if __name__ == "__main__":
     clee = CLEE()
+    clee.startup_profile = "--startup-profile" in sys.argv[1:]
+    clee.warm = "--no-warm" not in sys.argv[1:]
+    mark_startup("create CLEE")
+    if "--memory" in sys.argv[1:]:
+        use_memory()
+        # Load the database now rather than on first use, so that the
+        # first command isn't slowed down
+        db.execute("SELECT 1")
+        mark_startup("load database into memory")
     
     original_sigint = signal.getsignal(signal.SIGINT)
     signal.signal(signal.SIGINT, handler=ctrl_c(clee))
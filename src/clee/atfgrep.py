@@ -0,0 +1,215 @@
+"""
+The atfgrep command: regular expression search over the raw ATF corpus.
+
+The corpus is split into chunks which are searched by a pool of
+processes, each reading its files through mmap (or from the packed
+ATF store, if there is one). Matches are printed as soon as the chunk
+they belong to has been searched, so the first results of a large
+search appear immediately.
+"""
+import bisect
+import mmap
+import multiprocessing
+import os
+import re
+import shlex
+import time
+
+# Per-process caches, filled in by the pool workers
+_patterns = {}
+_stores = {}
+
+def _compile(pattern, flags):
+    if (pattern, flags) not in _patterns:
+        _patterns[(pattern, flags)] = re.compile(pattern.encode("utf-8"), flags | re.MULTILINE)
+    return _patterns[(pattern, flags)]
+
+def _read(store_path, source):
+    """
+    Return the contents of a source: the path of an ATF file (mapped
+    into memory rather than read), or else a UID in the store at
+    store_path.
+    """
+    if not source.endswith(".atf"):
+        if store_path not in _stores:
+            from .atfstore import ATFStore
+            _stores[store_path] = ATFStore(store_path)
+        return _stores[store_path].raw(source)
+    with open(source, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+def source_name(source):
+    return os.path.basename(source)[:-4] if source.endswith(".atf") else source
+
+def search_chunk(task):
+    """
+    Search a chunk of the corpus. Runs in a pool worker.
+
+    :param task: A tuple `(pattern, flags, context, store_path, sources)`.
+    :returns: A list of `(name, groups)` pairs, one for each source with
+              at least one match. `groups` is a list of lists of
+              `(line_no, line, spans)`, where `spans` are the matched
+              `(start, end)` offsets within the line, or None for a
+              context line.
+    """
+    pattern, flags, context, store_path, sources = task
+    regex = _compile(pattern, flags)
+    results = []
+    for source in sources:
+        buf = _read(store_path, source)
+        found = [match.span() for match in regex.finditer(buf)]
+        if found:
+            newlines = [match.start() for match in re.finditer(b"\n", buf)]
+            # A final newline ends the last line rather than starting an
+            # empty one, so (as in grep) an empty match after it, e.g.
+            # of ^ or $, is not on any line
+            n_lines = len(newlines) + (1 if len(buf) and buf[-1:] != b"\n" else 0)
+
+            def line_bounds(n):
+                start = newlines[n-2]+1 if n > 1 else 0
+                end = newlines[n-1] if n <= len(newlines) else len(buf)
+                return start, end
+
+            matches = {}
+            for start, end in found:
+                line_no = bisect.bisect_left(newlines, start) + 1
+                if line_no > n_lines:
+                    continue
+                line_start = line_bounds(line_no)[0]
+                matches.setdefault(line_no, []).append((start-line_start, end-line_start))
+            shown = sorted(set(n for m in matches
+                               for n in range(max(1, m-context), min(n_lines, m+context)+1)))
+            groups = []
+            for n in shown:
+                if not groups or groups[-1][-1][0] < n-1:
+                    groups.append([])
+                # copy just this line out of the buffer
+                start, end = line_bounds(n)
+                raw = buf[start:end]
+                spans = None
+                if n in matches:
+                    # convert byte offsets into character offsets
+                    spans = [(len(raw[:a].decode("utf-8", "replace")), len(raw[:b].decode("utf-8", "replace")))
+                             for a, b in matches[n]]
+                groups[-1].append((n, raw.decode("utf-8", "replace"), spans))
+            if groups:
+                results.append((source_name(source), groups))
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+    return results
+
+def highlight(line, spans):
+    for start, end in reversed(spans):
+        line = line[:start] + "\033[31;1m" + line[start:end] + "\033[0m" + line[end:]
+    return line
+
+def corpus_sources():
+    """
+    Return `(store_path, sources)`: the packed ATF store, if there is one,
+    and a list of sources for `_read`. As in `cli_util.read_atf`, a tablet
+    is read from the store unless its file in atf_path is newer than the
+    store or isn't in it.
+
+    :raises OSError: if there is neither a store nor an ATF directory.
+    """
+    from .cli_util import atf_path, atf_store_path
+    if not os.path.exists(atf_store_path):
+        files = sorted(name for name in os.listdir(atf_path) if name.endswith(".atf"))
+        return None, [os.path.join(atf_path, name) for name in files]
+    from .atfstore import ATFStore, newer_files
+    store = ATFStore(atf_store_path)
+    try:
+        newer = newer_files(store, atf_path)
+        uids = set(store) - set(newer)
+    finally:
+        store.close()
+    return atf_store_path, sorted(uids | set(newer.values()), key=source_name)
+
+def do_atfgrep(clee, line):
+    """
+    Search the raw ATF of every tablet for a regular expression, and
+    highlight the matches.
+
+    Unlike grep, which searches for signs in the database, atfgrep
+    searches the ATF text itself, so it can find things like ruling
+    markers, damage notation, or particular spellings of numerals.
+
+    Usage:
+    atfgrep [-i] [-C lines] [-j processes] pattern
+
+    Examples:
+    atfgrep "#"
+    -- prints every line of ATF containing damage notation
+
+    atfgrep -C 1 "^@reverse"
+    -- prints the start of every reverse, with one line of context on either side
+
+    atfgrep -i "\\b3\\(n14\\)"
+    -- prints every line containing 3(N14), ignoring case
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="atfgrep", exit_on_error=False)
+    parser.add_argument(
+        'pattern',
+        type=str,
+    )
+    parser.add_argument(
+        '-i', '--ignore-case',
+        action='store_true',
+    )
+    parser.add_argument(
+        '-C', '--context',
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=os.cpu_count(),
+    )
+    try:
+        args = parser.parse_args(shlex.split(line))
+        flags = re.IGNORECASE if args.ignore_case else 0
+        _compile(args.pattern, flags)
+    except (argparse.ArgumentError, re.error, ValueError) as e:
+        print(e)
+        return
+    except SystemExit:
+        return
+
+    start = time.perf_counter()
+    try:
+        store_path, sources = corpus_sources()
+    except (OSError, ValueError) as e:
+        # no ATF at all, or a corrupt store
+        print(f"Could not read the ATF corpus: {e}")
+        return
+    jobs = max(1, args.jobs)
+    # Small chunks so that results stream in steadily, but not so small
+    # that the workers spend their time waiting on the pool.
+    size = max(1, min(64, len(sources) // (jobs*8)))
+    tasks = [(args.pattern, flags, args.context, store_path, sources[i:i+size])
+             for i in range(0, len(sources), size)]
+
+    n_matches = n_texts = 0
+    try:
+        with multiprocessing.Pool(jobs) as pool:
+            for results in pool.imap_unordered(search_chunk, tasks):
+                for name, groups in results:
+                    n_texts += 1
+                    for idx, group in enumerate(groups):
+                        if idx > 0 and args.context:
+                            print("--")
+                        for line_no, text, spans in group:
+                            if spans is None:
+                                print(f"{name}-{line_no}- {text}")
+                            else:
+                                n_matches += len(spans)
+                                print(f"\033[1m{name}:{line_no}:\033[0m {highlight(text, spans)}")
+    except (OSError, ValueError) as e:
+        # a file removed during the search, or a corrupt record in the store
+        print(f"Could not read the ATF corpus: {e}")
+        return
+    print(f"\n{n_matches} matches in {n_texts} texts ({time.perf_counter()-start:.2f}s)")
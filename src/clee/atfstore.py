@@ -0,0 +1,175 @@
+"""
+A packed store for ATF files.
+
+The ATF corpus ships as thousands of small files. A store keeps all
+of them in one file, read through mmap, with an index from UID to the
+position of each record so that any record can be fetched without a
+filesystem lookup. Records may be individually compressed.
+
+Layout of a store:
+  8 bytes   magic number, b"CLEEATF1"
+  8 bytes   offset of the index (little-endian unsigned)
+  8 bytes   length of the index
+  ...       the records, one after another
+  ...       the index: a JSON object mapping each UID to [offset, length, compressed]
+
+Usage:
+python -m clee.atfstore pack [--compress] [atf_dir] [store]
+python -m clee.atfstore unpack [store] [atf_dir]
+"""
+from collections.abc import Mapping
+import json
+import mmap
+import os
+import struct
+import zlib
+
+magic = b"CLEEATF1"
+header = struct.Struct("<8sQQ")
+
+class ATFStore(Mapping):
+    """
+    Read-only mapping from UID to ATF text, backed by a packed store.
+
+    An empty, truncated or otherwise corrupt store raises ValueError,
+    either when it is opened or when a damaged record is read.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            # mmap raises ValueError for an empty file
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic_, offset, length = header.unpack_from(self._map, 0)
+            if magic_ != magic:
+                raise ValueError(f"{path} is not an ATF store")
+            self._index = json.loads(self._map[offset:offset+length])
+            # of the file which was opened, even if the store is packed again
+            self.mtime = os.fstat(self._file.fileno()).st_mtime
+        except struct.error:
+            self._file.close()
+            raise ValueError(f"{path} is not an ATF store")
+        except ValueError:
+            self._file.close()
+            raise
+
+    def raw(self, uid):
+        """
+        Return the ATF for a UID as bytes, without decoding it.
+        """
+        offset, length, compressed = self._index[uid]
+        data = self._map[offset:offset+length]
+        try:
+            return zlib.decompress(data) if compressed else data
+        except zlib.error as e:
+            raise ValueError(f"the record for {uid} in {self.path} is corrupt: {e}")
+
+    def __getitem__(self, uid):
+        return self.raw(uid).decode("utf-8")
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+def newer_files(store, atf_dir):
+    """
+    Return the files in atf_dir which should be read instead of the
+    store: those which are newer than the store, or not in it. This
+    looks at every file, so it is done once, when the store is opened,
+    rather than on every read.
+
+    :param store: An open ATFStore.
+    :returns: A dict mapping UIDs to paths.
+    """
+    files = {}
+    if not os.path.isdir(atf_dir):
+        return files
+    with os.scandir(atf_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".atf"):
+                uid = entry.name[:-4]
+                if uid not in store or entry.stat().st_mtime > store.mtime:
+                    files[uid] = entry.path
+    return files
+
+def pack(atf_dir, path, compress=False):
+    """
+    Write every .atf file in a directory to a new store.
+
+    :param atf_dir: Directory containing files named <uid>.atf.
+    :param path: Where to write the store. An existing store is replaced.
+    :param compress: If True, compress each record which gets smaller by doing so.
+    :returns: The number of records written.
+    """
+    index = {}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fp:
+        fp.write(header.pack(magic, 0, 0))
+        for name in sorted(os.listdir(atf_dir)):
+            if not name.endswith(".atf"):
+                continue
+            with open(os.path.join(atf_dir, name), "rb") as atf:
+                data = atf.read()
+            compressed = False
+            if compress:
+                packed = zlib.compress(data, 9)
+                if len(packed) < len(data):
+                    data, compressed = packed, True
+            index[name[:-4]] = [fp.tell(), len(data), compressed]
+            fp.write(data)
+        offset = fp.tell()
+        encoded = json.dumps(index).encode("utf-8")
+        fp.write(encoded)
+        fp.seek(0)
+        fp.write(header.pack(magic, offset, len(encoded)))
+    os.replace(tmp_path, path)
+    return len(index)
+
+def unpack(path, atf_dir):
+    """
+    Write each record of a store back out as <atf_dir>/<uid>.atf.
+
+    :returns: The number of records written.
+    """
+    os.makedirs(atf_dir, exist_ok=True)
+    store = ATFStore(path)
+    try:
+        for uid in store:
+            with open(os.path.join(atf_dir, f"{uid}.atf"), "wb") as fp:
+                fp.write(store.raw(uid))
+        return len(store)
+    finally:
+        store.close()
+
+def main(argv=None):
+    import argparse
+    from .cli_util import atf_path, atf_store_path
+
+    parser = argparse.ArgumentParser(
+        prog="python -m clee.atfstore",
+        description="Convert between a directory of ATF files and a packed ATF store.")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    pack_parser = subparsers.add_parser("pack", help="pack a directory of ATF files into a store")
+    pack_parser.add_argument("atf_dir", nargs="?", default=atf_path)
+    pack_parser.add_argument("store", nargs="?", default=atf_store_path)
+    pack_parser.add_argument("--compress", action="store_true", help="compress each record")
+    unpack_parser = subparsers.add_parser("unpack", help="write the records of a store back out as ATF files")
+    unpack_parser.add_argument("store", nargs="?", default=atf_store_path)
+    unpack_parser.add_argument("atf_dir", nargs="?", default=atf_path)
+    args = parser.parse_args(argv)
+
+    if args.action == "pack":
+        count = pack(args.atf_dir, args.store, compress=args.compress)
+        print(f"Packed {count} ATF files from {args.atf_dir} into {args.store}")
+    else:
+        count = unpack(args.store, args.atf_dir)
+        print(f"Unpacked {count} ATF files from {args.store} into {args.atf_dir}")
+
+if __name__ == "__main__":
+    main()
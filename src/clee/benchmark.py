@@ -0,0 +1,135 @@
+"""
+Compare the startup cost and read latency of CLEE with the database on
+disk and in memory (python -m clee --memory).
+
+Each mode runs in a fresh process against its own copy of the database:
+it opens the database (for memory mode, this includes copying it into
+memory), loads the UID index, and then replays a recorded workload with
+clee.replay.
+
+Usage:
+python -m clee.benchmark [history|sql.log|session-file] [--db path] [--repeat n]
+
+Examples:
+python -m clee.benchmark
+-- replays ~/.clee/history in both modes and prints the latencies side by side
+
+python -m clee.benchmark session.txt --repeat 5
+-- replays the commands in session.txt five times in each mode
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from .replay import clee_dir, copy_database, group_answers, load_workload, percentile, replay
+
+modes = ["file", "memory"]
+
+def measure(mode, source, repeat=1):
+    """
+    Measure one mode, in this process. Must be run in a fresh process,
+    with CLEE_DB pointing at a copy of the database.
+
+    :returns: A dict with the startup times and the latencies of each command, in seconds.
+    """
+    from . import cli_util
+    if mode == "memory":
+        cli_util.use_memory()
+    start = time.perf_counter()
+    # Opens the database. The startup queries, like the replayed ones
+    # (see `replay`), must not end up in the user's sql.log
+    cli_util.db.set_trace_callback(None)
+    cli_util.db.execute("SELECT 1")
+    opened = time.perf_counter()
+    len(cli_util.canonical_uids)
+    loaded = time.perf_counter()
+
+    from .__main__ import CLEE
+    commands = [name[3:] for name in CLEE().get_names() if name.startswith("do_")]
+    workload = group_answers(load_workload(source), commands)
+    timings, errors = replay(workload, repeat=repeat)
+    return {
+        "startup": {"open database": opened - start, "load UIDs": loaded - opened},
+        "timings": timings,
+        "errors": errors,
+    }
+
+def run(mode, source, db, repeat=1):
+    """
+    Measure one mode in a subprocess, against a copy of db.
+    """
+    tmpdir = tempfile.mkdtemp(prefix="clee-benchmark-")
+    try:
+        copy = os.path.join(tmpdir, "grist.db")
+        copy_database(db, copy)
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, CLEE_DB=copy,
+                   PYTHONPATH=os.pathsep.join(filter(None, [package_dir, os.environ.get("PYTHONPATH")])))
+        result = subprocess.run(
+            [sys.executable, "-m", "clee.benchmark", source, "--mode", mode, "--repeat", str(repeat)],
+            env=env, capture_output=True, text=True, check=True)
+        return json.loads(result.stdout.splitlines()[-1])
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def report(results):
+    file, memory = results["file"], results["memory"]
+    print(f"{'STARTUP':16} {'FILE':>9} {'MEMORY':>9} {'RATIO':>7}")
+    for phase in file["startup"]:
+        a, b = file["startup"][phase]*1000, memory["startup"][phase]*1000
+        print(f"{phase:16} {a:>9.2f} {b:>9.2f} {b/a if a else float('nan'):>6.2f}x")
+    print()
+    print(f"{'COMMAND (P50)':16} {'N':>5} {'FILE':>9} {'MEMORY':>9} {'RATIO':>7}")
+    for kind, values in sorted(file["timings"].items(), key=lambda kv: -sum(kv[1])):
+        if kind not in memory["timings"]:
+            continue
+        a = percentile(values, 50)*1000
+        b = percentile(memory["timings"][kind], 50)*1000
+        errors = file["errors"].get(kind, 0) + memory["errors"].get(kind, 0)
+        print(f"{kind:16} {len(values):>5} {a:>9.2f} {b:>9.2f} {b/a if a else float('nan'):>6.2f}x"
+              f"{f'  ({errors} errors)' if errors else ''}")
+    total_file = sum(sum(values) for values in file["timings"].values())*1000
+    total_memory = sum(sum(values) for values in memory["timings"].values())*1000
+    print(f"{'total':16} {'':>5} {total_file:>9.2f} {total_memory:>9.2f} "
+          f"{total_memory/total_file if total_file else float('nan'):>6.2f}x")
+    print("(times in ms; RATIO is memory / file, so lower is better for memory)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m clee.benchmark",
+        description="Compare CLEE with the database on disk and in memory.")
+    parser.add_argument(
+        'source',
+        nargs='?',
+        default='history',
+        help='"history", "sql.log", or the path to a history, sql.log, or session file',
+    )
+    parser.add_argument(
+        '--db',
+        default=os.environ.get('CLEE_DB', os.path.join(clee_dir, 'grist.db')),
+        help='database to copy and benchmark against (default: ~/.clee/grist.db)',
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+    )
+    # Used by run() to measure one mode in a subprocess
+    parser.add_argument('--mode', choices=modes, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.mode:
+        print(json.dumps(measure(args.mode, args.source, args.repeat)))
+        return
+
+    print(f"Replaying {args.source} {args.repeat} times against copies of {args.db}")
+    results = {mode: run(mode, args.source, args.db, args.repeat) for mode in modes}
+    report(results)
+
+if __name__ == "__main__":
+    main()
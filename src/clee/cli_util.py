@@ -1,6 +1,10 @@
 from collections import defaultdict
+from collections.abc import Mapping
+import contextlib
+import hashlib
 import re
 import sqlite3
+import threading
 import time
 import os
 import textwrap
@@ -14,28 +18,447 @@ histfile_size = 1000
 
 logfile = os.path.join(clee_dir, 'sql.log')
 
-db_path = os.path.join(clee_dir, 'grist.db')
+# CLEE_DB lets tools such as clee.replay point CLEE at a copy of the database
+db_path = os.environ.get('CLEE_DB', os.path.join(clee_dir, 'grist.db'))
 
 atf_path = os.path.join(clee_dir, 'atf')
 
+# Packed alternative to atf_path; see clee.atfstore
+atf_store_path = os.path.join(clee_dir, 'atf.pack')
+atf_store = None
+# Files in atf_path which are read instead of the store (see read_atf)
+atf_newer = {}
+
+# Numbers the commands of a session, so that sql.log can tell one
+# command which ran several queries from a command run twice in a row,
+# and so that caches which only need checking once per command (such
+# as the signlist) know when a new one has started
+command_number = 0
+
+def start_command():
+    global command_number
+    command_number += 1
+
 def log_sql(query):
     with open(histfile, 'r') as fp:
         command = fp.read().splitlines()[-1]
     with open(logfile, 'a+') as fp:
-        fp.write(f"{time.ctime()} │ {command} │ {query}\n")
+        fp.write(f"{time.ctime()} #{os.getpid()}.{command_number} │ {command} │ {query}\n")
+
+class Lazy:
+    """
+    Stands in for an object which is expensive to create (such as the
+    database connection), and creates it the first time it is used.
+    This keeps the work out of startup so that the prompt appears
+    straight away.
+    """
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+
+    def __getattr__(self, name):
+        if self._target is None:
+            self._target = self._factory()
+        return getattr(self._target, name)
+
+class UIDIndex(Mapping):
+    """
+    Maps uppercased UIDs to their canonical form. The UIDs are loaded
+    from the database the first time the index is used.
+    """
+    def __init__(self):
+        self._uids = None
+
+    def _load(self):
+        if self._uids is None:
+            self._uids = warmed.get("uids") or self.read(cursor)
+        return self._uids
+
+    @staticmethod
+    def read(cursor):
+        cursor.execute("SELECT DISTINCT UID FROM Object")
+        # Uppercase the UIDs for ease of comparing to user input,
+        # but maintain the original casing for DB access:
+        return {uid.upper(): uid for (uid,) in cursor.fetchall()}
+
+    def __getitem__(self, uid):
+        return self._load()[uid]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+class SignlistIndex:
+    """
+    The signlist, held in memory: looks up SignIDs by name and names by
+    SignID, normalizes shorthand names, splits CGs into their
+    components, and finds the variants of a base sign. The signlist is
+    loaded the first time it is used, and again if the database has
+    changed since. CLEE never writes to the signlist itself, so this is
+    only checked once per command (see `start_command`), rather than on
+    every lookup.
+    """
+    def __init__(self):
+        self._version = None
+        self._checked = None
+
+    def _load(self):
+        if self._checked == command_number:
+            return self
+        version = db_version()
+        if self._version != version:
+            self._ids, self._names, self._bases, self._variants = warmed.get("signlist") or self.read(cursor)
+            self._version = version
+        self._checked = command_number
+        return self
+
+    def check(self, version, cursor):
+        """
+        Reload the signlist with cursor if version differs from the one
+        it was loaded at. This is for indexes which are used away from
+        CLEE's own connection, and checked by their owner (see
+        clee.server) rather than once per command.
+
+        :param version: Any value which changes whenever the database does.
+        """
+        if self._version != version:
+            self._ids, self._names, self._bases, self._variants = self.read(cursor)
+            self._version = version
+        return self
+
+    @staticmethod
+    def read(cursor):
+        ids = defaultdict(list)
+        names = {}
+        bases = {}
+        variants = defaultdict(list)
+        for sign_id, name, base_name in cursor.execute("SELECT SignID, DahlName, BaseName FROM Signlist ORDER BY SignID"):
+            ids[name].append(sign_id)
+            names[sign_id] = name
+            bases[name] = base_name
+            variants[base_name].append(name)
+        return ids, names, bases, variants
+
+    @staticmethod
+    def normalize(name):
+        """
+        Return the canonical form of a sign name or CG: uppercase, without
+        |...|, and with M-numbers padded to three digits (M56 -> M056).
+        """
+        name = name.upper().replace("|", "")
+        return re.sub(r"M([0-9]+|X+)(?=[^0-9X]|$)",
+                      lambda m: "MXXX" if "X" in m.group(1) else f"M{int(m.group(1)):03}", name)
+
+    def ids(self, name):
+        """
+        Return every SignID with this name (normally at most one).
+        """
+        return list(self._load()._ids.get(self.normalize(name), []))
+
+    def id(self, name):
+        """
+        Return the SignID of a sign name, or None if it is not in the signlist.
+        """
+        ids = self.ids(name)
+        return ids[0] if ids else None
+
+    def name(self, sign_id):
+        """
+        Return the DahlName of a SignID, or None.
+        """
+        try:
+            return self._load()._names.get(int(sign_id))
+        except (TypeError, ValueError):
+            return None
+
+    def components(self, name):
+        """
+        Split a sign name or CG into its components.
+
+        :returns: A list of `(name, sign_id)` pairs, where sign_id is None for components which are not in the signlist.
+        """
+        return [(component, self.id(component)) for component in self.normalize(name).split("+")]
+
+    def base(self, name):
+        """
+        Return the BaseName of a sign, or None if it is not in the signlist.
+        """
+        return self._load()._bases.get(self.normalize(name))
+
+    def variants(self, name):
+        """
+        Return the names of every sign with the same BaseName as this
+        one (including the base sign itself), in SignID order.
+        """
+        base = self.base(name)
+        return list(self._variants.get(base, [])) if base else []
+
+    def __contains__(self, name):
+        return self.id(name) is not None
+
+# Several CLEE sessions (and clee.server) may use the database at once.
+# How long to wait for another session to finish writing before giving
+# up, and how many times to try again after that:
+busy_timeout = 5.0
+write_retries = 5
+
+class WriteConflict(Exception):
+    """
+    Raised when another session changed the data a write was based on.
+    """
+
+def connect(path, read_only=False):
+    """
+    Open a connection with the settings CLEE needs for concurrent use:
+    WAL journaling, so that readers never block and are never blocked
+    by a writer; a busy timeout, so that writers wait for each other
+    instead of failing; and no implicit transactions, so that writes
+    are only made through `transaction`.
+
+    :param path: Path of the database.
+    :param read_only: Open the database read-only. The connection may then be shared between threads.
+    """
+    if read_only:
+        return sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=busy_timeout,
+                               isolation_level=None, check_same_thread=False)
+    connection = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None)
+    try:
+        connection.execute("PRAGMA journal_mode=WAL")
+    except sqlite3.OperationalError:
+        # e.g. the database is on a read-only filesystem
+        pass
+    return connection
+
+# With --memory, CLEE reads from a copy of the database held in memory
+# (see use_memory)
+in_memory = False
+# The connections to the database file and to the copy, in memory mode
+disk = None
+memory = None
+_disk_version = None
+# Number of times the file has been copied into memory
+_memory_copies = 0
+
+def use_memory():
+    """
+    Serve reads from a copy of the database in memory, which is loaded
+    with SQLite's backup API when the database is opened. Writes made
+    through `transaction` are applied to both the copy and the file,
+    and the copy is reloaded if another session changes the file. Must
+    be called before the database is first used.
+    """
+    global in_memory
+    in_memory = True
+
+def refresh_memory(connection=None):
+    """
+    Copy the database file into memory, if it has changed since it was
+    last copied. Does nothing unless CLEE is in memory mode and the
+    database has been opened. CLEE calls this before each command, so
+    that commands see changes made by other sessions.
+    """
+    global _disk_version, _memory_copies
+    if not in_memory or (disk is None and connection is None):
+        return
+    (version,) = disk.execute("PRAGMA data_version").fetchone()
+    if version != _disk_version:
+        # Copy through a connection of its own: `disk` may be holding the
+        # write lock (see `transaction`), which would make the backup wait
+        # forever, whereas WAL lets other connections read meanwhile
+        with contextlib.closing(connect(db_path, read_only=True)) as source:
+            source.backup(connection or memory)
+        _disk_version = version
+        _memory_copies += 1
+
+class WriteThrough:
+    """
+    A cursor which makes every change on both the in-memory database and
+    the database file, in memory mode. Queries only go to memory, and
+    results (fetchall, lastrowid, rowcount...) come from memory.
+    """
+    def __init__(self, memory, disk):
+        self._memory = memory.cursor()
+        self._disk = disk.cursor()
+
+    def writes(self, sql, parameters=()):
+        """
+        Return whether a statement changes the database, as
+        sqlite3_stmt_readonly would say: whether its program starts a
+        write transaction. So WITH ... SELECT and PRAGMAs which only
+        read are queries, whatever word they start with. The program is
+        compiled on the file's connection, which isn't traced.
+        """
+        if sql.lstrip()[:7].upper() == "EXPLAIN":
+            return False
+        program = self._disk.execute("EXPLAIN " + sql, parameters).fetchall()
+        # columns: addr, opcode, p1, p2, ...
+        return any(row[1] == "Transaction" and row[3] for row in program)
+
+    def execute(self, sql, parameters=()):
+        if self.writes(sql, parameters):
+            self._disk.execute(sql, parameters)
+        self._memory.execute(sql, parameters)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        self._disk.executemany(sql, seq_of_parameters)
+        self._memory.executemany(sql, seq_of_parameters)
+        return self
+
+    def __iter__(self):
+        return iter(self._memory)
+
+    def __getattr__(self, name):
+        return getattr(self._memory, name)
+
+@contextlib.contextmanager
+def transaction(connection=None):
+    """
+    Run a short write transaction: acquire the write lock up front
+    (retrying with backoff if another session holds it for longer than
+    the busy timeout), then commit when the block finishes or roll back
+    if it raises.
 
-db = sqlite3.connect(db_path)
-db.set_trace_callback(log_sql)
-cursor = db.cursor()
+    Usage:
+    with transaction() as cur:
+        cur.execute("UPDATE ...")
 
-cursor.execute("SELECT DISTINCT UID FROM Object")
-canonical_uids = cursor.fetchall()
-# Uppercase the UIDs for ease of comparing to user input,
-# but maintain the original casing for DB access:
-canonical_uids = {uid.upper(): uid for (uid,) in canonical_uids}
+    In memory mode, CLEE's transactions lock the database file and
+    write to it as well as to memory (see `WriteThrough`).
+
+    :param connection: The connection to write with; by default, CLEE's connection.
+    """
+    connection = connection or db
+    write_through = in_memory and connection is db
+    for attempt in range(write_retries):
+        try:
+            (disk if write_through else connection).execute("BEGIN IMMEDIATE")
+            break
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) and "busy" not in str(e) or attempt == write_retries-1:
+                raise
+            time.sleep(0.1 * 2**attempt)
+    try:
+        if write_through:
+            # The file is locked now; make sure the copy matches it
+            refresh_memory()
+            connection.execute("BEGIN")
+            yield WriteThrough(connection, disk)
+            disk.execute("COMMIT")
+        else:
+            yield connection.cursor()
+        connection.execute("COMMIT")
+    except BaseException:
+        if write_through and disk.in_transaction:
+            disk.execute("ROLLBACK")
+        if connection.in_transaction:
+            connection.execute("ROLLBACK")
+        raise
+
+def open_db():
+    global disk, memory
+    if in_memory:
+        disk = connect(db_path)
+        connection = memory = sqlite3.connect(":memory:", isolation_level=None)
+        refresh_memory(connection)
+    else:
+        connection = connect(db_path)
+    connection.set_trace_callback(log_sql)
+    return connection
+
+db = Lazy(open_db)
+cursor = Lazy(lambda: db.cursor())
+
+class Warmed:
+    """
+    Results computed ahead of time by clee.warm, on another thread and
+    connection. A result is only used while the data_version of the
+    warmer's probe connection is what it was when warming started, so
+    that no change made since, by this process or another one, is
+    missed; the first time it is used it is also checked against the
+    database (see `database_version`).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {}
+        self._current = (None, None)
+
+    def put(self, key, value, version, base):
+        """
+        :param version: The `database_version` the value was computed from.
+        :param base: A tuple `(probe, data_version)`: a read-only connection
+                     which stays open, and its PRAGMA data_version from
+                     before the value was computed.
+        """
+        with self._lock:
+            self._items[key] = [value, version, base, False]
+
+    def get(self, key):
+        """
+        Return a result if it is still valid, else None. Results are
+        checked with CLEE's own connection, so they can only be used
+        from the main thread.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return None
+        with self._lock:
+            item = self._items.get(key)
+        if item is None:
+            return None
+        value, version, (probe, base), checked = item
+        (now,) = probe.execute("PRAGMA data_version").fetchone()
+        valid = now == base
+        if valid and not checked:
+            if self._current[0] != (probe, now):
+                self._current = ((probe, now), database_version())
+            valid = self._current[1] == version
+        if not valid:
+            with self._lock:
+                self._items.pop(key, None)
+            return None
+        item[3] = True
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+canonical_uids = UIDIndex()
+signlist = SignlistIndex()
+warmed = Warmed()
 
 hide_uid_col = True
 
+def db_version(connection=db):
+    """
+    Return a value which changes whenever the database is modified,
+    whether by this process or another one. In-memory caches of query
+    results compare it to the version they were built from.
+
+    :param connection: The connection to ask; by default, CLEE's connection.
+                       Versions of different connections can't be compared.
+    """
+    (data_version,) = connection.execute("PRAGMA data_version").fetchone()
+    return (data_version, connection.total_changes, _memory_copies)
+
+def database_version(cursor=cursor):
+    """
+    Return a string identifying the contents of the database, which
+    persists across sessions and is the same for every connection: the
+    latest entry in the change journal and a digest of the ingested
+    files. Every change CLEE makes goes through one of the two; changes
+    made to the database by other programs are not detected.
+    """
+    from .journal import latest_seq
+    digest = hashlib.sha1()
+    if cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'IngestedFile'").fetchone():
+        for name, hash_ in cursor.execute("SELECT Name, Hash FROM IngestedFile ORDER BY Name"):
+            digest.update(f"{name} {hash_}\n".encode("utf-8"))
+    return f"{latest_seq(cursor)}-{digest.hexdigest()[:16]}"
+
 def is_uid(string):
     """
     Returns the canonical form of a UID, or False.
@@ -48,6 +471,33 @@ def is_uid(string):
     except:
         return False
 
+def read_atf(uid):
+    """
+    Return the ATF for a tablet, from the packed ATF store if there is
+    one and from atf_path otherwise. A file in atf_path which is newer
+    than the store, or which isn't in it, is read from atf_path. This is
+    checked once, when the store is opened, so reading from the store
+    doesn't touch the filesystem.
+
+    :param uid: The UID of a tablet, e.g. P008001.
+    :returns: The ATF as a string.
+    :raises KeyError: if there is no ATF for the given UID.
+    :raises ValueError: if the store or the file can't be read (e.g. a
+                        corrupt store, or ATF which isn't UTF-8).
+    """
+    global atf_store, atf_newer
+    if atf_store is None and os.path.exists(atf_store_path):
+        from .atfstore import ATFStore, newer_files
+        atf_store = ATFStore(atf_store_path)
+        atf_newer = newer_files(atf_store, atf_path)
+    if atf_store is not None and uid not in atf_newer and uid in atf_store:
+        return atf_store[uid]
+    try:
+        with open(os.path.join(atf_path, f"{uid}.atf"), encoding="utf-8") as fp:
+            return fp.read()
+    except OSError:
+        raise KeyError(uid)
+
 def show_comments_by_uid(uid):
     show_comments_(
         "ReferencesObject", 
@@ -60,7 +510,7 @@ def show_comments_by_uid(uid):
 def show_comments_by_sign(sign_id, dahlname):
     show_comments_("ReferencesSign", "SignID", sign_id, dahlname)
 
-def mentioned_entities(comment_id):
+def mentioned_entities(comment_id, cursor=cursor):
     """
     Return the UID or SignID of any entities associated with this comment.
 
@@ -175,21 +625,29 @@ def format_token(uid):
     """
 
 def get_sign_info(sign_id):
-    cursor.execute("SELECT DahlName FROM Signlist WHERE SignID = ?", (sign_id,))
-    if not (rows := cursor.fetchall()):
-        return (None,)
-    else:
-        return rows[0]
+    return (signlist.name(sign_id),)
 
-def get_parents(uid):
-    cursor.execute("SELECT Value, GROUP_CONCAT(UID) FROM ObjectAttributeValue WHERE Attribute = 'child' AND Value LIKE ?||'%' GROUP BY Value", (uid,))
+def token_key(uid):
+    """
+    Return a key which sorts the tokens of a tablet in reading order:
+    by entry, then position, then part of a CG.
+
+    :param uid: The UID of a token, e.g. P008001:6:sgn:0:1.
+    :returns: A tuple of integers, e.g. (6, 0, 1).
+    """
+    parts = uid.split(":")
+    return (int(parts[1]), int(parts[3])) + tuple(int(p) for p in parts[4:])
+
+def get_parents(uid, cursor=cursor):
+    # The range lets SQLite use an index to find the UIDs with the prefix
+    cursor.execute("SELECT Value, GROUP_CONCAT(UID) FROM ObjectAttributeValue WHERE Attribute = 'child' AND Value >= ?1 AND Value < ?1||char(1114111) AND Value LIKE ?1||'%' GROUP BY Value", (uid,))
     mapping = dict()
     for child, ancestors in cursor.fetchall():
         mapping[child] = ancestors.split(",")
     return mapping
 
-def get_ancestors(uid):
-    parents    = get_parents(uid)
+def get_ancestors(uid, cursor=cursor):
+    parents    = get_parents(uid, cursor=cursor)
     ancestors = parents; ancestors_ = parents
     while True:
         for k in ancestors:
@@ -201,23 +659,32 @@ def get_ancestors(uid):
     return ancestors
 
 def prettyprint_tablet(uid, head=None):
+    text = warmed.get(("tablet", uid, head))
+    if text is None:
+        text = layout_tablet(uid, head)
+    print(text, end='')
+
+def layout_tablet(uid, head=None, cursor=cursor):
+    """
+    Lay out the table which prettyprint_tablet prints.
+
+    :param uid: A tablet, or a prefix of the UIDs to show, e.g. P008001:3.
+    :param head: Only show this many lines.
+    :returns: The table as a string, or '' if there is nothing to show.
+    """
     cursor.execute("""
     WITH sgn AS 
-    ( -- get :sgn: objects with the given UID as prefix:
-      SELECT UID FROM Object WHERE UID LIKE ?||'%sgn%'
-    ), dname AS (
-      SELECT * FROM sgn NATURAL JOIN ObjectAttributeValue WHERE Attribute = 'DahlName'
-    ), sid AS (
-      SELECT * FROM sgn NATURAL JOIN ObjectAttributeValue WHERE Attribute = 'SignID'
-    ), qty as (
-      SELECT * FROM sgn NATURAL JOIN ObjectAttributeValue WHERE Attribute = 'quantity'
+    ( -- get :sgn: objects with the given UID as prefix (the range
+      -- lets SQLite find them with the index on Object):
+      SELECT UID FROM Object WHERE UID >= ?1 AND UID < ?1||char(1114111) AND UID LIKE ?1||'%sgn%'
     ) SELECT sgn.UID, dname.Value, sid.Value, Signs.DahlName, qty.Value 
-    FROM 
-    (
-      (sgn LEFT JOIN dname ON sgn.UID = dname.UID) 
-      LEFT JOIN sid ON dname.UID = sid.UID 
-      LEFT JOIN Signs ON sid.Value = Signs.SignID
-    ) LEFT JOIN qty on qty.UID = sgn.UID 
+    FROM sgn
+    -- joining the table rather than a CTE per attribute lets SQLite use
+    -- the index on ObjectAttributeValue(UID, Attribute)
+    LEFT JOIN ObjectAttributeValue AS dname ON dname.UID = sgn.UID AND dname.Attribute = 'DahlName'
+    LEFT JOIN ObjectAttributeValue AS sid ON sid.UID = dname.UID AND sid.Attribute = 'SignID'
+    LEFT JOIN Signs ON sid.Value = Signs.SignID
+    LEFT JOIN ObjectAttributeValue AS qty ON qty.UID = sgn.UID AND qty.Attribute = 'quantity'
     ORDER BY CAST(SUBSTR(SUBSTR(sgn.UID, 9), 0, INSTR(SUBSTR(sgn.UID,9),':')) AS INTEGER), 
                   SUBSTR(sgn.UID, INSTR(sgn.UID,'sgn:')+4)
     """,(uid,))
@@ -228,7 +695,7 @@ def prettyprint_tablet(uid, head=None):
         for UID, fallback, _, DahlName, quantity in cursor.fetchall()
     }
 
-    ancestors = get_ancestors(uid)
+    ancestors = get_ancestors(uid, cursor=cursor)
     all_uids = set(sum(ancestors.values(), []) + list(ancestors.keys()))
     descendents = {anc:[desc for desc in all_uids if desc in ancestors and anc in ancestors[desc]] for anc in all_uids}
 
@@ -295,6 +762,7 @@ def prettyprint_tablet(uid, head=None):
                 #lines[-1][3].append(f"{r'─' if value_line == 0 and n_vals == 1 else '┬' if value_line == 0 and n_vals > 1 else '├' if value_line < n_vals-1 else '└'} {value} xN01 ({system.replace(',','')}) ")
                 lines[-1][3].append(f"{'=' if value_line == 0 else ' '} {value} xN01 ({system.replace(',','')}){',' if value_line < n_vals-1 else ' '}")
     #print(any(h.strip() in headers for h in lines[0][0]))
+    out = []
     if lines != []:
         lines = [[[]]+l[1:]+l[:1] for l in lines]
         # TODO if HMM header, also label the later rows
@@ -312,9 +780,9 @@ def prettyprint_tablet(uid, head=None):
             if line_no == 0:
                 for i in range(len(lines[0])):
                     if i == 0:
-                        print("\033[1m┌", end='')
+                        out.append("\033[1m┌")
                     else:
-                        print("─"*(col_widths[i]+1), end='┬' if i < len(lines[0])-1 else "┐\n")
+                        out.append("─"*(col_widths[i]+1) + ('┬' if i < len(lines[0])-1 else "┐\n"))
             for i in range(len(lines[0])):
                 # Right-align the text column, so
                 # that counted objects are lined up
@@ -322,26 +790,25 @@ def prettyprint_tablet(uid, head=None):
                     fmt = "{:>{w}}"
                 else:
                     fmt = "{:<{w}}"
-                print(fmt.format(l[i],w=col_widths[i]), end='│')
+                out.append(fmt.format(l[i],w=col_widths[i]) + '│')
                 if i < len(l)-1:
-                    print(' ', end='')
+                    out.append(' ')
             if line_no == 0:
                 for i in range(len(lines[0])):
                     if i == 0:
-                        print("\n├", end='')
+                        out.append("\n├")
                     else:
-                        print("─"*(col_widths[i]+1), end='┼' if i < len(lines[0])-1 else "┤\033[0m")
+                        out.append("─"*(col_widths[i]+1) + ('┼' if i < len(lines[0])-1 else "┤\033[0m"))
             if line_no == len(lines)-1:
                 for i in range(len(lines[0])):
                     if i == 0:
-                        print("\n└", end='')
+                        out.append("\n└")
                     else:
-                        print("─"*(col_widths[i]+1), end='┴' if i < len(lines[0])-1 else "┘")
-            #if line_no == 0 or line_no == len(lines)-1:
-                #print("\033[0m",end='')
-            print()
+                        out.append("─"*(col_widths[i]+1) + ('┴' if i < len(lines[0])-1 else "┘"))
+            out.append("\n")
+    return ''.join(out)
 
-def get_attrs(uid):
+def get_attrs(uid, cursor=cursor):
     cursor.execute("SELECT Attribute, GROUP_CONCAT(Value) from ObjectAttributeValue WHERE UID = ? GROUP BY Attribute", (uid,))
     av_pairs = cursor.fetchall()
     av_dict = defaultdict(set)
@@ -349,6 +816,23 @@ def get_attrs(uid):
         av_dict[attr].add(val)
     return av_dict
 
+# Attributes which describe doesn't list
+ignore_attrs = [
+    "child", 
+    "digit", 
+    "class", 
+    "injected_span", 
+    "language", 
+    "publication", 
+    "followed_by", 
+    "preceded_by", 
+    "sign",
+    "component",
+    #"span_type",
+    "content",
+    "numeral",
+]
+
 def prettyprint(uid):
     type_ = get_type(uid)
     av_dict = get_attrs(uid)
@@ -398,21 +882,6 @@ def prettyprint(uid):
     print()
     show_comments_by_uid(uid)
 
-    ignore_attrs = [
-        "child", 
-        "digit", 
-        "class", 
-        "injected_span", 
-        "language", 
-        "publication", 
-        "followed_by", 
-        "preceded_by", 
-        "sign",
-        "component",
-        #"span_type",
-        "content",
-        "numeral",
-    ]
     header = False
     for k, v in av_dict.items():
         if k not in ignore_attrs:
@@ -421,7 +890,7 @@ def prettyprint(uid):
             print(f"{k}: {', '.join(v)}")
             header = True
 
-def get_texts_by_cg(left_id, middle_id, right_id=None):
+def get_texts_by_cg(left_id, middle_id, right_id=None, cursor=cursor):
     if right_id:
         cursor.execute("""
         WITH Tokens AS (
@@ -462,7 +931,9 @@ def get_texts_by_cg(left_id, middle_id, right_id=None):
         FROM Tokens GROUP BY SUBSTR(Parent, 1, 7)""", (middle_id, left_id))
     return cursor.fetchall()
 
-def get_texts_by_sign(sign_id):
+def get_texts_by_sign(sign_id, cursor=cursor):
+    if (texts := warmed.get("sign_texts")) is not None:
+        return list(texts.get(sign_id, []))
     cursor.execute("""
     WITH instances AS (
         SELECT SUBSTR(UID, 1, 7) AS UID 
@@ -472,6 +943,85 @@ def get_texts_by_sign(sign_id):
     ) SELECT UID, COUNT(UID) FROM instances GROUP BY UID;""", (sign_id,))
     return cursor.fetchall()
 
+def get_sign_texts(cursor=cursor):
+    """
+    Count the attestations of every sign in every text, as
+    get_texts_by_sign does for one sign.
+
+    :returns: A dict mapping each SignID to a list of `(uid, count)` pairs.
+    """
+    cursor.execute("""
+    SELECT Value, SUBSTR(UID, 1, 7), COUNT(*)
+    FROM ObjectAttributeValue
+    WHERE Attribute = 'SignID'
+    GROUP BY Value, SUBSTR(UID, 1, 7)""")
+    texts = defaultdict(list)
+    for sign_id, text, count in cursor.fetchall():
+        texts[sign_id].append((text, count))
+    return dict(texts)
+
+def get_texts(sign, cursor=cursor, resolver=signlist):
+    """
+    Return the texts which contain a sign or CG.
+
+    :param sign: A sign name or CG, e.g. M157 or M157+M288.
+    :param resolver: The SignlistIndex to look the sign up in.
+    :returns: A list of `(uid, count)` pairs, or None if the sign (or one of the components of the CG) is not in the signlist.
+    """
+    ids = [sign_id for _, sign_id in resolver.components(sign)]
+    if None in ids:
+        return None
+    if len(ids) == 1:
+        return get_texts_by_sign(ids[0], cursor=cursor)
+    return get_texts_by_cg(*ids[:3], cursor=cursor)
+
+def get_texts_by_variants(base_name, cursor=cursor):
+    """
+    Count the attestations of a base sign and all of its variants in one pass.
+
+    :param base_name: A base sign, e.g. M157.
+    :returns: A dict mapping each text to a dict of `{variant name: count}`.
+    """
+    ids = {signlist.id(name): name for name in signlist.variants(base_name)}
+    cursor.execute(f"""
+    SELECT SUBSTR(UID, 1, 7), Value, COUNT(*)
+    FROM ObjectAttributeValue
+    WHERE Attribute = 'SignID' AND Value IN ({', '.join('?' * len(ids))})
+    GROUP BY SUBSTR(UID, 1, 7), Value""", list(ids))
+    texts = defaultdict(dict)
+    for text, sign_id, count in cursor.fetchall():
+        texts[text][ids[int(sign_id)]] = count
+    return texts
+
+def show_variant_attestations(base_name, within=None):
+    """
+    Print the attestations of a base sign together with its variants.
+
+    :param within: A selection bitmap to restrict the texts to, or None.
+    """
+    texts = get_texts_by_variants(base_name)
+    if within is not None:
+        from .selection import contains
+        texts = {text: counts for text, counts in texts.items() if contains(within, text)}
+    totals = defaultdict(int)
+    n_texts = defaultdict(int)
+    for counts in texts.values():
+        for name, count in counts.items():
+            totals[name] += count
+            n_texts[name] += 1
+
+    draw_header("with variants")
+    print(f"{base_name} and its variants are attested {sum(totals.values())} times in {len(texts)} texts:")
+    for name in signlist.variants(base_name):
+        print(f"  {name:12} {totals[name]:>6} times in {n_texts[name]:>5} texts")
+    attestations = ', '.join(
+        f"{text} (x{sum(counts.values())}{': ' + ', '.join(f'{name} x{count}' for name, count in sorted(counts.items())) if len(counts) > 1 else ''})"
+        for text, counts in sorted(texts.items(), key=lambda item: sum(item[1].values()), reverse=True))
+    print()
+    for line in textwrap.wrap(attestations, initial_indent='  ', subsequent_indent="  "):
+        print(line)
+    print()
+
 def is_sign(line):
     if matches := re.match("^\|?((X|M[0-9]+|([0-9]+\()?N[0-9]+[A-Z]*[^)]*\)?)(~[0-9A-Z]+|@[A-Z])?\+?)+\|?$", line.upper()):
         line = line.upper().replace("|", "")
@@ -0,0 +1,497 @@
+"""
+Export the corpus as a static website, for readers without CLEE.
+
+The site has a page for every tablet (its transliteration and numeral
+values, as describe shows them, with its comments and attributes) and
+for every sign in the signlist (its comments, variants and
+attestations), linked to each other, and an index page with a search
+box. Searching uses an index which is built along with the pages, so
+the site can be opened straight from disk or served by any web server.
+
+Pages are rendered in a pool of processes. The export directory keeps
+a manifest (export.json) of the database version each page was
+rendered from and a hash of its content, so exporting again only
+re-renders the pages of tablets and signs which the change journal
+says have changed since (all of them, if ATF has been ingested since),
+and only rewrites files whose content actually differs.
+
+Usage:
+python -m clee.htmlexport [directory] [-j n] [--force]
+"""
+from collections import defaultdict
+import hashlib
+import html
+import json
+import multiprocessing
+import os
+import re
+import shlex
+import time
+import urllib.parse
+
+from .cli_util import *
+from .journal import changes_since
+
+export_path = os.path.join(clee_dir, 'html')
+manifest_name = "export.json"
+export_format = 1
+
+# Render in-process below this many pages, rather than starting a pool
+pool_threshold = 50
+
+style = """
+body { font-family: sans-serif; margin: 2em auto; max-width: 60em; padding: 0 1em; }
+nav { margin-bottom: 1em; }
+pre { font-size: 90%; overflow-x: auto; }
+a { text-decoration: none; }
+a:hover { text-decoration: underline; }
+.comment { margin-bottom: 0.5em; }
+.see-also { color: #555; font-size: 90%; }
+#results li { margin: 0.2em 0; }
+.subtitle { color: #555; }
+"""
+
+search_script = """
+// Client-side search over search-index.js, which defines searchIndex:
+//   docs: [[url, title, subtitle], ...]
+//   terms: sorted list of terms
+//   postings: for each term, the indices of the docs containing it
+function lowerBound(terms, word) {
+  var lo = 0, hi = terms.length;
+  while (lo < hi) {
+    var mid = (lo + hi) >> 1;
+    if (terms[mid] < word) lo = mid + 1; else hi = mid;
+  }
+  return lo;
+}
+
+function search(query) {
+  var words = query.toLowerCase().match(/[a-z0-9~]+/g) || [];
+  var result = null;
+  words.forEach(function (word) {
+    var docs = new Set();
+    // every term which starts with the word
+    for (var i = lowerBound(searchIndex.terms, word);
+         i < searchIndex.terms.length && searchIndex.terms[i].startsWith(word); i++) {
+      searchIndex.postings[i].forEach(function (d) { docs.add(d); });
+    }
+    result = result === null ? docs : new Set([...result].filter(function (d) { return docs.has(d); }));
+  });
+  return result === null ? [] : [...result].sort(function (a, b) { return a - b; });
+}
+
+function showResults() {
+  var results = document.getElementById("results");
+  var query = document.getElementById("query").value;
+  results.innerHTML = "";
+  var docs = search(query);
+  docs.slice(0, 200).forEach(function (d) {
+    var doc = searchIndex.docs[d];
+    var li = document.createElement("li");
+    var a = document.createElement("a");
+    a.href = doc[0];
+    a.textContent = doc[1];
+    li.appendChild(a);
+    if (doc[2]) {
+      var span = document.createElement("span");
+      span.className = "subtitle";
+      span.textContent = " " + doc[2];
+      li.appendChild(span);
+    }
+    results.appendChild(li);
+  });
+  document.getElementById("count").textContent =
+    query.trim() ? docs.length + " pages match" + (docs.length > 200 ? " (showing 200)" : "") : "";
+}
+"""
+
+def site_root(path):
+    """
+    Return the relative URL of the top of the site, from the page at path
+    (relative to the top of the site, e.g. tablets/P008001.html).
+    """
+    return "../" * path.count("/")
+
+def page(title, body, path):
+    """
+    Wrap the body of a page in the HTML they all share.
+
+    :param path: Where the page is, relative to the top of the site.
+    """
+    root = site_root(path)
+    nav = f'<nav><a href="{root}index.html">CLEE</a> › {html.escape(title)}</nav>\n' if root else ""
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{html.escape(title)} · CLEE</title>
+<link rel="stylesheet" href="{root}style.css">
+</head>
+<body>
+{nav}{body}
+</body>
+</html>
+"""
+
+def tablet_href(uid, root):
+    return f"{root}tablets/{urllib.parse.quote(uid.split(':')[0])}.html"
+
+def sign_href(name, root):
+    return f"{root}signs/{urllib.parse.quote(name)}.html"
+
+def sign_link(name, root):
+    if name in signlist:
+        return f'<a href="{sign_href(signlist.normalize(name), root)}">{html.escape(name)}</a>'
+    return html.escape(name)
+
+def link_signs(text, root):
+    """
+    Link the signs in a (HTML-escaped) piece of text to their pages,
+    recognising them as the commands do (see `is_sign`): sign names,
+    numerals such as 3(N01), whose sign is linked, and CGs, each of
+    whose components is linked.
+    """
+    def link_part(part):
+        if quantity := re.fullmatch(r"([0-9/]+\()(.+)(\))", part):
+            return quantity.group(1) + link_part(quantity.group(2)) + quantity.group(3)
+        if part.strip("|") in signlist:
+            return part.replace(part.strip("|"), sign_link(part.strip("|"), root))
+        return part
+
+    def link(match):
+        token = match.group(0)
+        if not is_sign(token):
+            return token
+        return "+".join(link_part(part) for part in token.split("+"))
+    return re.sub(r"[|0-9A-Za-z~@()+/]+", link, text)
+
+def terms(*texts):
+    return sorted(set(word for text in texts for word in re.findall(r"[a-z0-9~]+", str(text).lower())))
+
+def comments(table, column, value, approx=False):
+    """
+    Return the comments which describe would show, as a list of
+    `(comment, uids, signs)` tuples.
+    """
+    if approx:
+        cursor.execute(f"SELECT CommentID, Comment FROM Comment NATURAL JOIN {table} WHERE {column} LIKE ?||'%'", (value,))
+    else:
+        cursor.execute(f"SELECT CommentID, Comment FROM Comment NATURAL JOIN {table} WHERE {column} = ?", (value,))
+    result = []
+    for comment_id, comment in cursor.fetchall():
+        uids, signs = mentioned_entities(comment_id)
+        result.append((comment, [uid for (uid,) in uids], [sign for (sign,) in signs]))
+    return result
+
+def comments_html(found, name, root):
+    if not found:
+        return ""
+    out = ["<h2>Comments</h2>"]
+    for comment, uids, signs in found:
+        see_also = [f'<a href="{tablet_href(uid, root)}">{html.escape(uid)}</a>' for uid in uids if uid != name] + \
+                   [sign_link(sign, root) for sign in signs if sign != name]
+        out.append(f'<div class="comment">• {html.escape(comment)}'
+                   + (f'<div class="see-also">see also {", ".join(see_also)}</div>' if see_also else "")
+                   + "</div>")
+    return "\n".join(out)
+
+def render_tablet(uid):
+    """
+    :returns: A tuple `(path, html, entry)`, where entry holds the title,
+              subtitle and search terms of the page.
+    """
+    path = f"tablets/{uid}.html"
+    root = site_root(path)
+    attrs = get_attrs(uid)
+    (publication,) = attrs.get("publication", ("",))
+    body = [f"<h1>{html.escape(uid)}</h1>"]
+    if publication:
+        body.append(f"<p>{html.escape(uid)} is the UID for {html.escape(publication)}</p>")
+    try:
+        table = layout_tablet(uid)
+    except ValueError:
+        # a tablet without any lines
+        table = ""
+    table = re.sub(r"\033\[[0-9;]*m", "", table)
+    if table:
+        body.append(f'<pre class="tablet">{link_signs(html.escape(table), root)}</pre>')
+    found = comments("ReferencesObject", "UID", uid, approx=True)
+    body.append(comments_html(found, uid, root))
+    shown = {k: v for k, v in attrs.items() if k not in ignore_attrs}
+    if shown:
+        body.append("<h2>Attributes</h2>\n<dl>" + "".join(
+            f"<dt>{html.escape(k)}</dt><dd>{html.escape(', '.join(sorted(map(str, v))))}</dd>"
+            for k, v in sorted(shown.items())) + "</dl>")
+    entry = {
+        "title": uid,
+        "subtitle": publication,
+        "terms": terms(uid, publication, table, *(c for c, _, _ in found), *(v for vs in shown.values() for v in vs)),
+    }
+    return path, page(uid, "\n".join(body), path), entry
+
+def render_sign(name):
+    path = f"signs/{name}.html"
+    root = site_root(path)
+    sign_id = signlist.id(name)
+    base_name = signlist.base(name)
+    variants = [variant for variant in signlist.variants(name) if variant != name]
+    body = [f"<h1>{html.escape(name)}</h1>", f"<p>{html.escape(name)} has sign id {sign_id}</p>"]
+    if base_name != name:
+        body.append(f"<p>{html.escape(name)} is a variant of {sign_link(base_name, root)}</p>")
+    elif variants:
+        body.append(f"<p>{html.escape(name)} has variants {', '.join(sign_link(v, root) for v in variants)}</p>")
+    found = comments("ReferencesSign", "SignID", sign_id)
+    body.append(comments_html(found, name, root))
+
+    texts = get_texts_by_sign(sign_id)
+    body.append("<h2>Attestations</h2>")
+    body.append(f"<p>{html.escape(name)} is attested {sum(c for _, c in texts)} times in {len(texts)} texts:</p>")
+    body.append("<p>" + ", ".join(
+        f'<a href="{tablet_href(text, root)}">{html.escape(text)}</a> (x{count})'
+        for text, count in sorted(texts, key=lambda x: x[1], reverse=True)) + "</p>")
+
+    if base_name == name and variants:
+        by_text = get_texts_by_variants(name)
+        totals = defaultdict(int)
+        n_texts = defaultdict(int)
+        for counts in by_text.values():
+            for variant, count in counts.items():
+                totals[variant] += count
+                n_texts[variant] += 1
+        body.append("<h2>With variants</h2>")
+        body.append(f"<p>{html.escape(name)} and its variants are attested {sum(totals.values())} times in {len(by_text)} texts:</p>")
+        body.append("<table>" + "".join(
+            f"<tr><td>{sign_link(variant, root)}</td><td>{totals[variant]} times</td><td>in {n_texts[variant]} texts</td></tr>"
+            for variant in signlist.variants(name)) + "</table>")
+        body.append("<p>" + ", ".join(
+            f'<a href="{tablet_href(text, root)}">{html.escape(text)}</a> (x{sum(counts.values())}'
+            + (": " + ", ".join(f"{html.escape(v)} x{c}" for v, c in sorted(counts.items())) if len(counts) > 1 else "")
+            + ")"
+            for text, counts in sorted(by_text.items(), key=lambda item: sum(item[1].values()), reverse=True)) + "</p>")
+
+    entry = {
+        "title": name,
+        "subtitle": f"sign id {sign_id}" + (f", variant of {base_name}" if base_name != name else ""),
+        "terms": terms(name, base_name, *(c for c, _, _ in found)),
+    }
+    return path, page(name, "\n".join(body), path), entry
+
+def render(task):
+    """
+    Render one page. Runs in a worker process, or in CLEE's process for
+    small exports.
+
+    :param task: A tuple `("tablet", uid)` or `("sign", name)`.
+    :returns: A tuple `(path, html, entry)`.
+    """
+    kind, key = task
+    return render_tablet(key) if kind == "tablet" else render_sign(key)
+
+def _init_worker():
+    # Workers are started with "spawn", so cli_util opens a connection of
+    # their own; their queries shouldn't go into the user's sql.log
+    db.set_trace_callback(None)
+
+def render_index(manifest):
+    tablets = sorted((path, entry) for path, entry in manifest["pages"].items() if path.startswith("tablets/"))
+    signs = sorted(((path, entry) for path, entry in manifest["pages"].items() if path.startswith("signs/")),
+                   key=lambda item: (signlist.id(item[1]["title"]) or 0, item[1]["title"]))
+    def listing(pages):
+        return "<ul>" + "".join(
+            f'<li><a href="{urllib.parse.quote(path)}">{html.escape(entry["title"])}</a>'
+            f'{" <span class=subtitle>" + html.escape(entry["subtitle"]) + "</span>" if entry["subtitle"] else ""}</li>'
+            for path, entry in pages) + "</ul>"
+    body = f"""<h1>CLEE</h1>
+<p>Exported {html.escape(manifest["created"])}: {len(tablets)} tablets and {len(signs)} signs.</p>
+<p><input id="query" type="search" placeholder="Search: sign names, publications, comments..." size="50" oninput="showResults()" autofocus>
+<span id="count"></span></p>
+<ul id="results"></ul>
+<h2>Tablets</h2>
+{listing(tablets)}
+<h2>Signs</h2>
+{listing(signs)}
+<script src="search-index.js"></script>
+<script src="search.js"></script>
+"""
+    return page("Index", body, "index.html")
+
+def search_index(manifest):
+    """
+    Build the search index from the terms recorded for each page.
+    """
+    docs = []
+    postings = defaultdict(list)
+    for path, entry in sorted(manifest["pages"].items()):
+        for term in entry["terms"]:
+            postings[term].append(len(docs))
+        docs.append([path, entry["title"], entry["subtitle"]])
+    index = {"docs": docs, "terms": sorted(postings), "postings": [postings[term] for term in sorted(postings)]}
+    return "var searchIndex = " + json.dumps(index, separators=(",", ":")) + ";\n"
+
+def changed_pages(changes):
+    """
+    Find the pages affected by journaled changes.
+
+    :param changes: A list of changes, as returned by `journal.changes_since`.
+    :returns: A tuple `(tablets, signs)` of sets.
+    """
+    tablets, signs = set(), set()
+    def add_sign(name):
+        if name in signlist:
+            signs.add(name)
+            signs.add(signlist.base(name))
+    for change in changes:
+        for a in change.get("attributes", []):
+            tablets.add(a["uid"].split(":")[0])
+            if a["attribute"] in ["SignID", "DahlName"]:
+                for value in a["before"] + a["after"]:
+                    add_sign(signlist.name(value) if a["attribute"] == "SignID" else str(value))
+        for uid in change.get("objects", []):
+            tablets.add(uid.split(":")[0])
+        for sign_id in change.get("signs", []):
+            add_sign(signlist.name(sign_id))
+    return tablets, signs
+
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, manifest_name)) as fp:
+            manifest = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get("format") == export_format else None
+
+def write_file(path, content):
+    """
+    Write a file through a temporary file, so that a reader never sees
+    it half-written.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as fp:
+        fp.write(content)
+    os.replace(path + ".tmp", path)
+
+def export(path=export_path, jobs=None, force=False, progress=None):
+    """
+    Export the corpus as a static website, re-rendering only what has
+    changed since the last export to path.
+
+    :param jobs: Number of rendering processes (default: one per CPU).
+    :param force: Re-render every page, e.g. after changes made outside CLEE.
+    :param progress: Called with the number of pages rendered so far.
+    :returns: A dict of counters.
+    """
+    start = time.perf_counter()
+    version = database_version()
+    cursor.execute("SELECT UID FROM Object WHERE UID NOT LIKE '%:%' ORDER BY UID")
+    tablets = [uid for (uid,) in cursor.fetchall()]
+    signs = [name for name, _ in cursor.execute("SELECT DahlName, SignID FROM Signlist ORDER BY SignID").fetchall()]
+    pages = {f"tablets/{uid}.html": ("tablet", uid) for uid in tablets}
+    pages.update({f"signs/{name}.html": ("sign", name) for name in signs})
+
+    old = read_manifest(path) or {"database_version": None, "pages": {}}
+    changes = None if force else changes_since(old["database_version"])
+    if changes is not None:
+        changed_tablets, changed_signs = changed_pages(changes)
+        tasks = [task for page_path, task in pages.items()
+                 if page_path not in old["pages"]
+                 or not os.path.exists(os.path.join(path, page_path))
+                 or task[1] in (changed_tablets if task[0] == "tablet" else changed_signs)]
+    else:
+        tasks = list(pages.values())
+
+    manifest = {
+        "format": export_format,
+        "database_version": version,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        # Kept even when every page is re-rendered, so that unchanged pages aren't rewritten
+        "pages": {page_path: entry for page_path, entry in old["pages"].items() if page_path in pages},
+    }
+    stats = defaultdict(int)
+    stats["pages"] = len(pages)
+    stats["rendered"] = len(tasks)
+
+    def store(page_path, content, entry):
+        entry["hash"] = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        known = manifest["pages"].get(page_path, {}).get("hash")
+        if entry["hash"] != known or not os.path.exists(os.path.join(path, page_path)):
+            write_file(os.path.join(path, page_path), content)
+            stats["written"] += 1
+        manifest["pages"][page_path] = entry
+
+    if len(tasks) < pool_threshold:
+        for task in tasks:
+            store(*render(task))
+    else:
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(jobs, initializer=_init_worker) as pool:
+            for done, result in enumerate(pool.imap_unordered(render, tasks, chunksize=16), 1):
+                store(*result)
+                if progress and done % 100 == 0:
+                    progress(done)
+
+    for page_path in old["pages"]:
+        if page_path not in pages and os.path.exists(os.path.join(path, page_path)):
+            os.remove(os.path.join(path, page_path))
+            stats["removed"] += 1
+
+    write_file(os.path.join(path, "style.css"), style.lstrip())
+    write_file(os.path.join(path, "search.js"), search_script.lstrip())
+    write_file(os.path.join(path, "search-index.js"), search_index(manifest))
+    write_file(os.path.join(path, "index.html"), render_index(manifest))
+    write_file(os.path.join(path, manifest_name), json.dumps(manifest, indent=1))
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+def do_export(clee, line):
+    """
+    Export the corpus as a static website which can be browsed without
+    CLEE: a page for every tablet and every sign, as describe shows
+    them, and an index page with a search box. Exporting to the same
+    directory again only re-renders the pages of tablets and signs
+    which have changed since.
+
+    Usage:
+    export html [directory] [-j n] [--force]
+
+    Examples:
+    export html
+    -- writes the site to ~/.clee/html; open ~/.clee/html/index.html in a browser
+
+    export html ~/site --force
+    -- writes the site to ~/site, re-rendering every page (e.g. after
+       changing the database with another program)
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="export", exit_on_error=False)
+    parser.add_argument('format', choices=["html"])
+    parser.add_argument('directory', nargs='?', default=export_path)
+    parser.add_argument('-j', '--jobs', type=int)
+    parser.add_argument('--force', action='store_true')
+    try:
+        args = parser.parse_args(shlex.split(line))
+        path = os.path.expanduser(args.directory)
+        stats = export(path, args.jobs, args.force,
+                       progress=lambda done: print(f"\r{done} pages rendered", end="", flush=True))
+        removed = f"; removed {stats['removed']} old pages" if stats["removed"] else ""
+        print(f"\rRendered {stats['rendered']} of {stats['pages']} pages and wrote {stats['written']} "
+              f"in {stats['seconds']:.1f}s{removed}")
+        print(f"Open {os.path.join(path, 'index.html')} in a browser to read it.")
+    except (ValueError, OSError, sqlite3.OperationalError, argparse.ArgumentError) as e:
+        print(e)
+    except SystemExit:
+        pass
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m clee.htmlexport",
+                                     description="Export the corpus as a static website.")
+    parser.add_argument("path", nargs="?", default=export_path)
+    parser.add_argument("-j", "--jobs", type=int)
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args(argv)
+    db.set_trace_callback(None)
+    stats = export(args.path, args.jobs, args.force)
+    print(f"Rendered {stats['rendered']} of {stats['pages']} pages and wrote {stats['written']} to {args.path} in {stats['seconds']:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,519 @@
+"""
+Ingest ATF into grist.db.
+
+Each tablet in the ATF becomes the object hierarchy the rest of CLEE
+reads: the tablet, one entry (:ent) per line, the line's text (:txt)
+and numeral (:num) spans, a :sgn: token for each sign, and a part for
+each component of a CG. Tokens get their DahlName, SignID and
+quantity; a sign which isn't in the signlist gets SignID -1, as in
+rename, so that the errors command lists it.
+
+Entries are not parsed from the ATF: every numbered line becomes an
+entry of its own, numbered from 1 across the whole tablet. An entry
+which the ATF writes over several lines therefore becomes several
+entries. A new tablet gets a first segment (:1sg) which holds its
+first entry, as the header; segments of tablets already in the
+database are kept as they are.
+
+Files are read, hashed, and parsed in a pool of processes; the main
+process loads the results in batches, one transaction per batch. A
+file is only parsed again if its content hash differs from the one
+recorded when it was last ingested (in the IngestedFile table).
+
+Re-ingesting a tablet rewrites only the rows which ingestion itself
+produces, and only those which differ from what the ATF now says, so
+everything else is kept: comments, attributes added by hand or by
+other tools (provenience, span_type, numeral values, ...), and the
+segments (:1sg) which group entries, and the publication, if it has
+been set. When lines have been added or removed, the entries already
+in the database are matched with the lines by their signs (see
+`renumbering`), and an entry whose number changes is moved, with its
+spans, tokens, attributes and comments, to its new number. Renames and
+other changes made to tokens through CLEE are re-applied from the
+change journal, as long as the token still has the value they were
+made from. Numeral values (disambig_*) of a numeral span whose signs
+have changed are removed, since they no longer describe it.
+
+Ingestion also creates the indexes which query, describe and the
+other commands rely on to be fast, if they are missing; --index-only
+creates them without ingesting anything.
+
+Usage:
+python -m clee.ingest [atf_dir_or_files ...] [--db path] [-j n] [--batch n] [--force]
+python -m clee.ingest --index-only [--db path]
+"""
+from collections import defaultdict
+import difflib
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import time
+
+from .cli_util import atf_path, db_path, connect, token_key, transaction
+
+# Attributes written by ingestion. Any other attribute is left alone.
+# (The publication is only written for a tablet which has none.)
+derived_attributes = ("child", "DahlName", "SignID", "quantity")
+
+# Indexes which ingestion creates if they don't exist. The first serves
+# lookups by attribute value, as in query and select; the second, the
+# lookups of an object's attributes, as in describe and kwic. Commands
+# only read the database, so they work without them, only slower.
+indexes = {
+    "ObjectAttributeValue_AttributeValue": "ObjectAttributeValue(Attribute, Value)",
+    "ObjectAttributeValue_UID": "ObjectAttributeValue(UID, Attribute)",
+}
+
+schema = """
+CREATE TABLE IF NOT EXISTS IngestedFile (
+    Name TEXT PRIMARY KEY,
+    Hash TEXT NOT NULL,
+    Tablets TEXT NOT NULL,
+    Time TEXT NOT NULL
+)
+"""
+
+line_pattern = re.compile(r"^([0-9]+'*[a-z]?'*)\.\s*(.*)$")
+numeral_pattern = re.compile(r"^([0-9]+(?:/[0-9]+)?|n)\((.+)\)$")
+flags = re.compile(r"[\[\]⸢⸣<>#?!*]")
+
+def is_ingested(uid):
+    """
+    Return True if an object of this kind is created by ingestion.
+    """
+    return uid.endswith((":ent", ":txt", ":num")) or ":sgn:" in uid
+
+def sign_name(token):
+    return flags.sub("", token).upper()
+
+def parse_atf(text):
+    """
+    Split ATF into tablets and tokenize their lines.
+
+    Lines are numbered from 1 in the order they appear on the tablet,
+    across all surfaces. Structure (@), comment (#) and state ($) lines
+    are skipped.
+
+    :returns: A list of `(uid, publication, lines)` tuples, where lines is a
+              list of `(n, tokens)` pairs and each token is a tuple
+              `(names, quantity)`: names has more than one element for a CG.
+    """
+    tablets = []
+    for raw in text.splitlines():
+        raw = raw.strip()
+        if raw.startswith("&"):
+            uid, _, publication = raw[1:].partition("=")
+            tablets.append((uid.strip().upper(), publication.strip(), []))
+            continue
+        if not tablets or not (match := line_pattern.match(raw)):
+            continue
+        content = re.sub(r"\(\$.*?\$\)", " ", match.group(2))
+        tokens = []
+        for token in content.replace(",", " ").split():
+            quantity = None
+            if numeral := numeral_pattern.match(flags.sub("", token)):
+                quantity, token = numeral.groups()
+                quantity = int(quantity) if quantity.isdigit() else quantity
+            if token.startswith("|"):
+                names = tuple(sign_name(part) for part in token.strip("|").split("+"))
+            else:
+                names = (sign_name(token),)
+            if all(names):
+                tokens.append((names, quantity))
+        if tokens:
+            lines = tablets[-1][2]
+            lines.append((len(lines)+1, tokens))
+    return tablets
+
+def tablet_rows(uid, publication, lines, signlist):
+    """
+    Return the objects and object-attribute-value rows of a parsed tablet.
+
+    :param signlist: A dict mapping DahlNames to SignIDs. Signs which
+                     aren't in it get SignID -1.
+    :returns: A tuple `(objects, rows)`.
+    """
+    objects = [uid]
+    rows = []
+    if publication:
+        rows.append((uid, "publication", publication))
+
+    def sign(token_uid, name):
+        objects.append(token_uid)
+        rows.append((token_uid, "DahlName", name))
+        rows.append((token_uid, "SignID", signlist.get(name, -1)))
+
+    for n, tokens in lines:
+        entry, text, numeral = f"{uid}:{n}:ent", f"{uid}:{n}:txt", f"{uid}:{n}:num"
+        objects.append(entry)
+        rows.append((uid, "child", entry))
+        for k, (names, quantity) in enumerate(tokens):
+            span = numeral if quantity is not None else text
+            if span not in objects:
+                objects.append(span)
+                rows.append((entry, "child", span))
+            token = f"{uid}:{n}:sgn:{k}"
+            rows.append((span, "child", token))
+            if len(names) == 1:
+                sign(token, names[0])
+            else:
+                objects.append(token)
+                for j, name in enumerate(names):
+                    sign(f"{token}:{j}", name)
+                    rows.append((token, "child", f"{token}:{j}"))
+            if quantity is not None:
+                rows.append((token, "quantity", quantity))
+    return objects, rows
+
+_signlist = None
+
+def _init_worker(signlist):
+    global _signlist
+    _signlist = signlist
+
+def parse_file(task):
+    """
+    Read, hash and (if the hash has changed) parse one file. Runs in a
+    worker process.
+
+    :param task: A tuple `(name, path, known_hash)`.
+    :returns: A tuple `(name, hash, tablets)`, where tablets is None if the
+              file is unchanged and otherwise a list of
+              `(uid, objects, rows)` tuples.
+    """
+    name, path, known_hash = task
+    with open(path, "rb") as fp:
+        data = fp.read()
+    digest = hashlib.sha1(data).hexdigest()
+    if digest == known_hash:
+        return name, digest, None
+    tablets = [(uid, *tablet_rows(uid, publication, lines, _signlist))
+               for uid, publication, lines in parse_atf(data.decode("utf-8", errors="replace"))]
+    return name, digest, tablets
+
+def atf_files(sources):
+    """
+    Yield `(name, path)` for each ATF file in the given files and directories.
+    """
+    for source in sources:
+        if os.path.isdir(source):
+            for name in sorted(os.listdir(source)):
+                if name.endswith(".atf"):
+                    yield name, os.path.join(source, name)
+        else:
+            yield os.path.basename(source), source
+
+def numeral_signatures(rows):
+    """
+    Return a dict mapping each numeral span to a description of its signs.
+    """
+    children = defaultdict(list)
+    attrs = defaultdict(list)
+    for uid, attr, value in rows:
+        if attr == "child":
+            children[uid].append(value)
+        elif attr in ["DahlName", "quantity"]:
+            attrs[uid].append((attr, str(value)))
+    return {uid: sorted((child, sorted(attrs[child])) for child in kids)
+            for uid, kids in children.items() if uid.endswith(":num")}
+
+def journaled_changes(cursor):
+    """
+    Return the journaled changes to derived attributes, grouped by tablet,
+    as lists of `(uid, attribute, before, after)` in the order they were made.
+    """
+    changes = defaultdict(list)
+    if not cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'ChangeJournal'").fetchone():
+        return changes
+    for (change,) in cursor.execute("SELECT Change FROM ChangeJournal ORDER BY Seq"):
+        for cell in json.loads(change).get("attributes", []):
+            if cell["attribute"] in derived_attributes:
+                changes[cell["uid"][:7]].append((cell["uid"], cell["attribute"], cell["before"], cell["after"]))
+    return changes
+
+def entry_signatures(rows, entries=()):
+    """
+    Return a dict mapping each entry number of a tablet to the names of
+    its signs, in reading order.
+
+    :param rows: The tablet's `(uid, attribute, value)` rows.
+    :param entries: Entry numbers to include even if they have no signs.
+    """
+    names = {uid: value for uid, attr, value in rows if attr == "DahlName" and ":sgn:" in uid}
+    signatures = {n: [] for n in entries}
+    for uid in sorted(names, key=token_key):
+        signatures.setdefault(int(uid.split(":")[1]), []).append(names[uid])
+    return {n: tuple(signature) for n, signature in signatures.items()}
+
+def renumbering(old, new):
+    """
+    Match the entries of a tablet in the database with its entries as
+    now parsed, so that an entry keeps its comments and attributes when
+    lines are added or removed before it. Entries are aligned by their
+    signs; an entry whose signs were edited is matched with the line in
+    its place.
+
+    :param old: The `entry_signatures` of the tablet in the database.
+    :param new: The `entry_signatures` of the parsed tablet.
+    :returns: A dict mapping old entry numbers to new ones, for the
+              entries whose number changes. Entries which have no match
+              are given numbers past the end, out of the way.
+    """
+    a, b = sorted(old), sorted(new)
+    matcher = difflib.SequenceMatcher(None, [old[n] for n in a], [new[n] for n in b], autojunk=False)
+    matched = {}
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag in ["equal", "replace"]:
+            matched.update((a[i], b[j]) for i, j in zip(range(i1, i2), range(j1, j2)))
+    mapping = {n: m for n, m in matched.items() if n != m}
+    taken = set(mapping.values())
+    spare = max(a + b, default=0) + 1
+    for n in a:
+        if n not in matched and n in taken:
+            mapping[n] = spare
+            spare += 1
+    return mapping
+
+def tablet_range(column="UID"):
+    """
+    Return a condition matching a tablet (parameter 1) and the objects
+    on it, as a range which SQLite can find in an index.
+    """
+    return f"({column} = ?1 OR ({column} >= ?1||':' AND {column} < ?1||';'))"
+
+def load_batch(cursor, tablets, journal, stats):
+    """
+    Bring the given tablets in the database up to date with their parsed
+    rows, writing only the rows that differ.
+
+    :param tablets: A list of `(uid, objects, rows)` tuples.
+    :param journal: The result of `journaled_changes`.
+    :param stats: A dict of counters, updated in place.
+    """
+    old_objects = set()
+    old_rows = defaultdict(list)
+    for uid, _, _ in tablets:
+        old_objects.update(u for (u,) in cursor.execute(f"SELECT UID FROM Object WHERE {tablet_range()}", (uid,)))
+        old_rows[uid] = cursor.execute(
+            f"SELECT rowid, UID, Attribute, Value FROM ObjectAttributeValue WHERE {tablet_range()}", (uid,)).fetchall()
+
+    # Move entries whose number has changed, before comparing rows
+    renamed_rows, renamed_objects, renamed_references = [], {}, []
+    for uid, objects, rows in tablets:
+        entries = [int(u.split(":")[1]) for u in old_objects if u.startswith(uid + ":") and u.endswith(":ent")]
+        if not entries:
+            continue
+        old = entry_signatures([row[1:] for row in old_rows[uid]], entries)
+        mapping = renumbering(old, entry_signatures(rows))
+        if not mapping:
+            continue
+
+        def rename(u):
+            parts = u.split(":")
+            if not is_ingested(u) or int(parts[1]) not in mapping:
+                return u
+            return ":".join([parts[0], str(mapping[int(parts[1])])] + parts[2:])
+
+        for u in old_objects:
+            if u.startswith(uid + ":") and rename(u) != u:
+                renamed_objects[u] = rename(u)
+        moved = []
+        for rowid, u, attr, value in old_rows[uid]:
+            row = (rowid, rename(u), attr, rename(value) if attr == "child" else value)
+            if row != (rowid, u, attr, value):
+                renamed_rows.append((row[1], row[3], rowid))
+            moved.append(row)
+        old_rows[uid] = moved
+        renamed_references += [(rename(u), rowid) for rowid, u in cursor.execute(
+            f"SELECT rowid, UID FROM ReferencesObject WHERE {tablet_range()}", (uid,)) if rename(u) != u]
+        journal[uid] = [(rename(token), attr, before, after) for token, attr, before, after in journal.get(uid, [])]
+        stats["entries renumbered"] += len(mapping)
+    cursor.executemany("UPDATE ObjectAttributeValue SET UID = ?, Value = ? WHERE rowid = ?", renamed_rows)
+    cursor.executemany("DELETE FROM Object WHERE UID = ?", [(u,) for u in renamed_objects])
+    cursor.executemany("INSERT INTO Object VALUES (?)", [(u,) for u in renamed_objects.values()])
+    cursor.executemany("UPDATE ReferencesObject SET UID = ? WHERE rowid = ?", renamed_references)
+    old_objects = (old_objects - set(renamed_objects)) | set(renamed_objects.values())
+
+    new_objects = set()
+    for uid, objects, rows in tablets:
+        new_objects.update(objects)
+    vanished = set(uid for uid in old_objects if is_ingested(uid) and uid not in new_objects)
+
+    deletes, inserts = [], []
+    for uid, objects, rows in tablets:
+        existing = old_rows[uid]
+        # Rows whose object is gone, or which point at an object which is gone:
+        deletes += [rowid for rowid, u, attr, value in existing
+                    if u in vanished or (attr == "child" and value in vanished)]
+        kept = [(rowid, u, attr, value) for rowid, u, attr, value in existing
+                if u not in vanished and not (attr == "child" and value in vanished)]
+        # The publication may have been corrected by hand
+        if any(u == uid and attr == "publication" for _, u, attr, _ in kept):
+            rows = [row for row in rows if row[1] != "publication"]
+        # A new tablet's first entry is its first segment
+        segment, first = f"{uid}:1:1sg", f"{uid}:1:ent"
+        if first in objects and uid not in old_objects:
+            new_objects.add(segment)
+            rows = [row for row in rows if row != (uid, "child", first)]
+            inserts += [(uid, "child", segment), (segment, "child", first)]
+        # Rows which ingestion produced last time:
+        derived = {}
+        for rowid, u, attr, value in kept:
+            if attr in derived_attributes and (attr != "child" or (is_ingested(value) and (is_ingested(u) or ":" not in u))):
+                derived.setdefault((u, attr, value), []).append(rowid)
+        # An entry which belongs to a segment stays in it
+        has_parent = set(value for _, u, attr, value in kept
+                         if attr == "child" and (u, attr, value) not in derived)
+        rows = [row for row in rows if not (row[1] == "child" and row[2] in has_parent)]
+
+        new = set(rows)
+        for row, rowids in derived.items():
+            if row not in new:
+                deletes += rowids
+            else:
+                deletes += rowids[1:]
+        inserts += [row for row in rows if row not in derived]
+
+        # Numeral values no longer apply to a numeral whose signs changed
+        old_numerals = numeral_signatures((u, attr, value) for _, u, attr, value in kept if (u, attr, value) in derived)
+        for span, signature in numeral_signatures(rows).items():
+            if span in old_numerals and old_numerals[span] != signature:
+                stale = [rowid for rowid, u, attr, _ in kept if u == span and attr.startswith("disambig_")]
+                deletes += stale
+                stats["numeral values removed"] += len(stale)
+
+    cursor.executemany("DELETE FROM ObjectAttributeValue WHERE rowid = ?", [(rowid,) for rowid in deletes])
+    cursor.executemany("DELETE FROM Object WHERE UID = ?", [(uid,) for uid in vanished])
+    cursor.executemany("INSERT OR IGNORE INTO Object VALUES (?)", [(uid,) for uid in new_objects - old_objects])
+    cursor.executemany("INSERT INTO ObjectAttributeValue VALUES (?, ?, ?)", inserts)
+    stats["rows deleted"] += len(deletes)
+    stats["rows inserted"] += len(inserts)
+    stats["objects added"] += len(new_objects - old_objects)
+    stats["objects removed"] += len(vanished)
+
+    # Re-apply changes made through CLEE on top of the ATF
+    for uid, _, _ in tablets:
+        for token, attr, before, after in journal.get(uid, []):
+            cursor.execute("SELECT Value FROM ObjectAttributeValue WHERE UID = ? AND Attribute = ?", (token, attr))
+            if sorted((value for (value,) in cursor.fetchall()), key=str) != before:
+                continue
+            cursor.execute("DELETE FROM ObjectAttributeValue WHERE UID = ? AND Attribute = ?", (token, attr))
+            cursor.executemany("INSERT INTO ObjectAttributeValue VALUES (?, ?, ?)", [(token, attr, value) for value in after])
+            stats["changes re-applied"] += 1
+
+def create_indexes(connection):
+    """
+    Create any of CLEE's indexes which don't exist yet, and then ANALYZE
+    the database so that SQLite can choose between them. This takes a
+    few seconds on a large database, so it is only done when an index
+    is missing.
+
+    :returns: The names of the indexes created.
+    """
+    existing = set(name for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+    missing = [name for name in indexes if name not in existing]
+    if missing:
+        with transaction(connection) as cur:
+            for name in missing:
+                cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {indexes[name]}")
+            cur.execute("ANALYZE")
+    return missing
+
+def ingest(sources, path=db_path, jobs=None, batch_size=200, force=False, progress=None):
+    """
+    Ingest ATF files into the database.
+
+    :param sources: ATF files, or directories containing .atf files.
+    :param path: Path of the database.
+    :param jobs: Number of parsing processes (default: one per CPU).
+    :param batch_size: Number of changed files to load per transaction.
+    :param force: Re-ingest every file, even if its hash is unchanged.
+    :param progress: Called with the stats dict after each batch.
+    :returns: A dict of counters.
+    """
+    connection = connect(path)
+    cursor = connection.cursor()
+    cursor.execute(schema)
+    # Before loading, since the tablets are looked up by their UIDs
+    created = create_indexes(connection)
+    known = {} if force else dict(cursor.execute("SELECT Name, Hash FROM IngestedFile"))
+    signlist = dict(cursor.execute("SELECT DahlName, SignID FROM Signlist"))
+    journal = journaled_changes(cursor)
+
+    tasks = [(name, file_path, known.get(name)) for name, file_path in atf_files(sources)]
+    stats = defaultdict(int)
+    stats["files"] = len(tasks)
+    stats["indexes created"] = len(created)
+    pending = []
+
+    def flush():
+        tablets = [tablet for _, _, parsed in pending for tablet in parsed]
+        now = time.strftime("%Y-%m-%dT%H:%M:%S")
+        with transaction(connection) as cur:
+            load_batch(cur, tablets, journal, stats)
+            cur.executemany("INSERT OR REPLACE INTO IngestedFile VALUES (?, ?, ?, ?)",
+                            [(name, digest, " ".join(uid for uid, _, _ in parsed), now) for name, digest, parsed in pending])
+        stats["files ingested"] += len(pending)
+        stats["tablets"] += len(tablets)
+        pending.clear()
+        if progress:
+            progress(stats)
+
+    start = time.perf_counter()
+    with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(signlist,)) as pool:
+        for name, digest, tablets in pool.imap_unordered(parse_file, tasks, chunksize=16):
+            if tablets is None:
+                stats["files unchanged"] += 1
+                continue
+            pending.append((name, digest, tablets))
+            if len(pending) >= batch_size:
+                flush()
+    if pending:
+        flush()
+    stats["seconds"] = time.perf_counter() - start
+    connection.close()
+    return stats
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="python -m clee.ingest",
+        description="Parse ATF files and load them into the database, re-ingesting only files which have changed.")
+    parser.add_argument("sources", nargs="*", default=[atf_path], help="ATF files or directories (default: ~/.clee/atf)")
+    parser.add_argument("--db", default=db_path, help="database to load into (default: ~/.clee/grist.db)")
+    parser.add_argument("-j", "--jobs", type=int, help="number of parsing processes (default: one per CPU)")
+    parser.add_argument("--batch", type=int, default=200, help="number of files to load per transaction")
+    parser.add_argument("--force", action="store_true", help="re-ingest every file, even unchanged ones")
+    parser.add_argument("--index-only", action="store_true", help="only create CLEE's indexes, if they are missing")
+    args = parser.parse_args(argv)
+
+    if args.index_only:
+        connection = connect(args.db)
+        created = create_indexes(connection)
+        connection.close()
+        print(f"Created {', '.join(created)}" if created else "The indexes already exist")
+        return
+
+    def progress(stats):
+        print(f"\r{stats['files ingested'] + stats['files unchanged']}/{stats['files']} files", end="", flush=True)
+
+    stats = ingest(args.sources, args.db, args.jobs, args.batch, args.force, progress)
+    rate = stats["files"] / stats["seconds"] if stats["seconds"] else 0
+    print(f"\rIngested {stats['files ingested']} files ({stats['tablets']} tablets); "
+          f"{stats['files unchanged']} were unchanged. {stats['files']} files in {stats['seconds']:.1f}s ({rate:.0f} files/s)")
+    print(f"  {stats['rows inserted']} rows inserted, {stats['rows deleted']} deleted; "
+          f"{stats['objects added']} objects added, {stats['objects removed']} removed")
+    if stats["entries renumbered"]:
+        print(f"  {stats['entries renumbered']} entries moved to a new number, with their comments and attributes")
+    if stats["changes re-applied"]:
+        print(f"  {stats['changes re-applied']} journaled changes re-applied")
+    if stats["indexes created"]:
+        print(f"  {stats['indexes created']} indexes created")
+    if stats["numeral values removed"]:
+        print(f"  {stats['numeral values removed']} numeral values removed from numerals whose signs changed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+The change journal, and the sync command which moves changes between
+machines.
+
+Every write made by annotate, rename and comment (and by the query
+server) appends an entry to the ChangeJournal table, in the same
+transaction as the write itself. Each entry records the machine it was
+first made on and its position in that machine's sequence of changes,
+so an entry keeps the same identity however many machines it passes
+through, and importing it twice has no effect.
+
+Attribute changes are recorded as the values of each affected
+(UID, attribute) pair before and after the change. When a change is
+imported, the values must still be the "before" values for it to be
+applied; otherwise another change got there first, and the entry is
+reported as a conflict instead of silently overwriting it.
+
+`sync export --since n` writes the entries after n to a file, and
+`sync import file` applies them, so syncing two machines costs time in
+proportion to the number of changes rather than the size of the corpus.
+"""
+import contextlib
+import datetime
+import gzip
+import json
+import os
+import shlex
+import uuid
+
+from .cli_util import *
+
+machine_id_path = os.path.join(clee_dir, 'machine-id')
+
+export_format = 1
+
+schema = """
+CREATE TABLE IF NOT EXISTS ChangeJournal (
+    Seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    Origin TEXT NOT NULL,
+    OriginSeq INTEGER NOT NULL,
+    Time TEXT NOT NULL,
+    Change TEXT NOT NULL,
+    UNIQUE (Origin, OriginSeq)
+)
+"""
+
+_machine_id = None
+
+def machine_id():
+    """
+    Return the identifier of this machine, creating it the first time.
+    It is kept outside the database, since databases are copied between
+    machines.
+    """
+    global _machine_id
+    if _machine_id is None:
+        if os.path.exists(machine_id_path):
+            with open(machine_id_path) as fp:
+                _machine_id = fp.read().strip()
+        else:
+            _machine_id = uuid.uuid4().hex
+            with open(machine_id_path, "w") as fp:
+                fp.write(_machine_id + "\n")
+    return _machine_id
+
+def ensure_journal(cursor=cursor):
+    cursor.execute(schema)
+
+def latest_seq(cursor=cursor):
+    """
+    Return the sequence number of the newest journal entry, or 0 if
+    nothing has been recorded yet.
+    """
+    if not cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'ChangeJournal'").fetchone():
+        return 0
+    (seq,) = cursor.execute("SELECT COALESCE(MAX(Seq), 0) FROM ChangeJournal").fetchone()
+    return seq
+
+def changes_since(version, cursor=cursor):
+    """
+    Return the changes made since the database had the given version
+    (see `database_version`), so that results computed from it can be
+    brought up to date without starting over.
+
+    :returns: A list of the changes recorded since, oldest first, or None
+              if the journal can't say what has changed: there is no
+              version, ATF has been ingested since, or the version is
+              from another database.
+    """
+    if version is None:
+        return None
+    seq, digest = version.split("-")
+    current_seq, current_digest = database_version(cursor).split("-")
+    if digest != current_digest or int(seq) > int(current_seq):
+        return None
+    if int(seq) == int(current_seq):
+        return []
+    return [json.loads(change) for (change,) in
+            cursor.execute("SELECT Change FROM ChangeJournal WHERE Seq > ? ORDER BY Seq", (int(seq),)).fetchall()]
+
+def append(cursor, change, origin=None, origin_seq=None, time=None):
+    """
+    Append an entry to the journal. Must be called inside the transaction
+    which made the change.
+
+    :param change: A JSON-serializable dict describing the change.
+    :param origin: The machine the change was first made on; by default, this one.
+    :param origin_seq: The position of the change in its origin's sequence; by default, the next one.
+    :returns: The local sequence number of the entry.
+    """
+    ensure_journal(cursor)
+    origin = origin or machine_id()
+    if origin_seq is None:
+        (origin_seq,) = cursor.execute("SELECT COALESCE(MAX(OriginSeq), 0) + 1 FROM ChangeJournal WHERE Origin = ?", (origin,)).fetchone()
+    time = time or datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+    cursor.execute("INSERT INTO ChangeJournal(Origin, OriginSeq, Time, Change) VALUES (?, ?, ?, ?)",
+                   (origin, origin_seq, time, json.dumps(change, separators=(",", ":"))))
+    return cursor.lastrowid
+
+def attribute_values(cursor, cells):
+    """
+    Return the values of each (UID, attribute) pair in cells, as a list
+    of sorted lists of values.
+    """
+    values = []
+    for uid, attr in cells:
+        cursor.execute("SELECT Value FROM ObjectAttributeValue WHERE UID = ? AND Attribute = ?", (uid, attr))
+        values.append(sorted((value for (value,) in cursor.fetchall()), key=str))
+    return values
+
+@contextlib.contextmanager
+def journaled(cursor, command, cells):
+    """
+    Record the changes made to the given (UID, attribute) pairs by the
+    enclosed block in the journal, unless the block raises or leaves
+    the values as they were.
+
+    Usage:
+    with transaction() as cur, journaled(cur, "annotate update ...", [(uid, attr)]):
+        cur.execute("UPDATE ObjectAttributeValue ...")
+    """
+    cells = list(dict.fromkeys(cells))
+    before = attribute_values(cursor, cells)
+    yield
+    after = attribute_values(cursor, cells)
+    if after != before:
+        append(cursor, {
+            "command": command,
+            "attributes": [{"uid": uid, "attribute": attr, "before": b, "after": a}
+                           for (uid, attr), b, a in zip(cells, before, after) if a != b],
+        })
+
+def record_comment(cursor, command, comment, uids, sign_ids):
+    """
+    Record a new comment and its links in the journal. Comments are
+    identified by their text, since CommentIDs are only unique on one
+    machine.
+    """
+    append(cursor, {"command": command, "comment": comment, "objects": list(uids), "signs": list(sign_ids)})
+
+def export(path, since=0, cursor=cursor):
+    """
+    Write the journal entries after `since` to path, as JSON lines,
+    compressed if path ends in .gz.
+
+    :returns: The number of entries written and the sequence number of the last one.
+    """
+    ensure_journal(cursor)
+    rows = cursor.execute("SELECT Seq, Origin, OriginSeq, Time, Change FROM ChangeJournal WHERE Seq > ? ORDER BY Seq", (since,)).fetchall()
+    through = rows[-1][0] if rows else since
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "wt", encoding="utf-8") as fp:
+        fp.write(json.dumps({"clee_sync": export_format, "origin": machine_id(), "since": since, "through": through}) + "\n")
+        for _, origin, origin_seq, time, change in rows:
+            fp.write(json.dumps({"origin": origin, "seq": origin_seq, "time": time, "change": json.loads(change)},
+                                separators=(",", ":")) + "\n")
+    return len(rows), through
+
+def read_export(path):
+    """
+    Return the header and entries of an exported file.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as fp:
+        header = json.loads(fp.readline() or "{}")
+        if header.get("clee_sync") != export_format:
+            raise ValueError(f"{path} is not a CLEE change file")
+        return header, [json.loads(line) for line in fp if line.strip()]
+
+def apply_attributes(cursor, change, theirs=False):
+    """
+    Apply an attribute change, if the current values are still the ones
+    it was made from.
+
+    :returns: A list of conflicts, as `(uid, attribute, expected, found)`
+              tuples; the change is only applied if it is empty, or if
+              theirs is set, in which case the values are overwritten.
+    """
+    cells = [(a["uid"], a["attribute"]) for a in change["attributes"]]
+    current = attribute_values(cursor, cells)
+    conflicts = []
+    for a, found in zip(change["attributes"], current):
+        if found != a["before"] and found != a["after"]:
+            conflicts.append((a["uid"], a["attribute"], a["before"], found))
+        elif not cursor.execute("SELECT 1 FROM Object WHERE UID = ?", (a["uid"],)).fetchone():
+            conflicts.append((a["uid"], a["attribute"], a["before"], "no such UID"))
+    if conflicts and not theirs:
+        return conflicts
+    for a, found in zip(change["attributes"], current):
+        if found == a["after"]:
+            continue
+        if found == a["before"]:
+            # only touch the values which changed
+            removed, added = list(a["before"]), list(a["after"])
+            for value in a["before"]:
+                if value in added:
+                    removed.remove(value)
+                    added.remove(value)
+        else:
+            removed, added = found, a["after"]
+        for value in removed:
+            cursor.execute("DELETE FROM ObjectAttributeValue WHERE rowid IN (SELECT rowid FROM ObjectAttributeValue WHERE UID = ? AND Attribute = ? AND Value = ? LIMIT 1)",
+                           (a["uid"], a["attribute"], value))
+        cursor.executemany("INSERT INTO ObjectAttributeValue VALUES (?, ?, ?)",
+                           [(a["uid"], a["attribute"], value) for value in added])
+    return conflicts
+
+def apply_comment(cursor, change):
+    cursor.execute("INSERT INTO Comment(Comment) VALUES (?)", (change["comment"],))
+    comment_id = cursor.lastrowid
+    cursor.executemany("INSERT INTO ReferencesObject(CommentID, UID) VALUES (?, ?)", [(comment_id, uid) for uid in change["objects"]])
+    cursor.executemany("INSERT INTO ReferencesSign(CommentID, SignID) VALUES (?, ?)", [(comment_id, sign_id) for sign_id in change["signs"]])
+
+def import_changes(path, theirs=False):
+    """
+    Apply the entries of an exported file which this database hasn't
+    seen yet, in one transaction.
+
+    :param theirs: Apply conflicting changes anyway, overwriting the local values.
+    :returns: A tuple `(applied, seen, conflicts)`, where conflicts is a
+              list of `(entry, [(uid, attribute, expected, found), ...])`.
+    """
+    header, entries = read_export(path)
+    applied, seen, conflicts = 0, 0, []
+    with transaction() as cur:
+        ensure_journal(cur)
+        for entry in entries:
+            if entry["origin"] == machine_id() or cur.execute(
+                    "SELECT 1 FROM ChangeJournal WHERE Origin = ? AND OriginSeq = ?", (entry["origin"], entry["seq"])).fetchone():
+                seen += 1
+                continue
+            change = entry["change"]
+            if "attributes" in change:
+                if found := apply_attributes(cur, change, theirs):
+                    conflicts.append((entry, found))
+                    if not theirs:
+                        continue
+            elif "comment" in change:
+                apply_comment(cur, change)
+            append(cur, change, entry["origin"], entry["seq"], entry["time"])
+            applied += 1
+    return applied, seen, conflicts
+
+def do_sync(clee, line):
+    """
+    Exchange annotations, renames and comments with another copy of the
+    database. Every change is recorded in a journal; export writes the
+    changes made since a given point to a file, and import applies a
+    file of changes. Changes which were already imported are skipped, and
+    changes to values which have since been changed here are reported as
+    conflicts and not applied (unless --theirs is given).
+
+    Usage:
+    sync status
+    sync export file [--since n]
+    sync import file [--theirs]
+
+    Examples:
+    sync export ~/changes.jsonl.gz
+    -- writes every change in the journal to ~/changes.jsonl.gz, and prints the
+       number to pass to --since next time
+
+    sync export ~/changes.jsonl.gz --since 120
+    -- writes only the changes after number 120
+
+    sync import ~/changes.jsonl.gz
+    -- applies the changes in ~/changes.jsonl.gz which this database hasn't seen yet
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="sync", exit_on_error=False)
+    parser.add_argument('action', choices=["status", "export", "import"])
+    parser.add_argument('file', nargs='?')
+    parser.add_argument('--since', type=int, default=0)
+    parser.add_argument('--theirs', action='store_true')
+    try:
+        args = parser.parse_args(shlex.split(line))
+        if args.action != "status" and not args.file:
+            raise ValueError(f"Usage: sync {args.action} file")
+        path = os.path.expanduser(args.file or "")
+
+        if args.action == "status":
+            draw_header("change journal")
+            print(f"This machine: {machine_id()}")
+            print(f"Latest change: {latest_seq()}")
+            if latest_seq():
+                cursor.execute("SELECT Origin, COUNT(*), MAX(Time) FROM ChangeJournal GROUP BY Origin ORDER BY MAX(Seq)")
+                for origin, count, time in cursor.fetchall():
+                    print(f"  {origin}{' (here)' if origin == machine_id() else ''}: {count} changes, latest {time}")
+
+        elif args.action == "export":
+            count, through = export(path, args.since)
+            print(f"Exported {count} changes to {path}")
+            print(f"Next time, use: sync export {args.file} --since {through}")
+
+        elif args.action == "import":
+            applied, seen, conflicts = import_changes(path, args.theirs)
+            print(f"Applied {applied} changes from {path}; {seen} were already here.")
+            if conflicts:
+                print(f"{len(conflicts)} changes conflict with changes made here{' and were applied anyway' if args.theirs else ' and were not applied'}:")
+                for entry, found in conflicts:
+                    print(f"  {entry['change'].get('command', '')} ({entry['time']})")
+                    for uid, attr, expected, value in found:
+                        print(f"    {uid} {attr}: expected {expected}, found {value}")
+                if not args.theirs:
+                    print("Use --theirs to apply them anyway.")
+
+    except (ValueError, OSError, sqlite3.OperationalError, argparse.ArgumentError) as e:
+        print(e)
+    except SystemExit:
+        pass
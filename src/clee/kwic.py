@@ -0,0 +1,189 @@
+"""
+The kwic command: a keyword-in-context concordance of a sign.
+
+Occurrences are produced by a generator, one text at a time, so the
+first lines are printed as soon as the first text has been read. When
+the output is sorted by context, occurrences are sorted in runs which
+are spilled to temporary files and merged, so the number of
+occurrences held in memory stays bounded however many there are.
+"""
+import heapq
+import itertools
+import json
+import os
+import shlex
+import tempfile
+
+from .cli_util import *
+
+# Number of occurrences to sort in memory before spilling to disk
+run_size = 10000
+
+def tablet_tokens(uid, cursor=cursor):
+    """
+    Return the tokens of a tablet in reading order, as `(line, name)`
+    pairs. CGs are written with their parts joined by '+', and counted
+    signs as quantity(name), as in describe.
+    """
+    cursor.execute("""
+    SELECT sgn.UID, dname.Value, Signs.DahlName, qty.Value
+    FROM Object sgn
+    LEFT JOIN ObjectAttributeValue dname ON dname.UID = sgn.UID AND dname.Attribute = 'DahlName'
+    LEFT JOIN ObjectAttributeValue sid ON sid.UID = sgn.UID AND sid.Attribute = 'SignID'
+    LEFT JOIN Signs ON Signs.SignID = sid.Value
+    LEFT JOIN ObjectAttributeValue qty ON qty.UID = sgn.UID AND qty.Attribute = 'quantity'
+    WHERE sgn.UID >= ?1 AND sgn.UID < ?1||char(1114111) AND sgn.UID LIKE ?1||':%sgn:%'
+    """, (uid,))
+    tokens = []
+    previous = None
+    for key, fallback, name, quantity in sorted((token_key(u), f, n, q) for u, f, n, q in cursor.fetchall()):
+        name = name or fallback
+        if name is None:
+            # a CG: its parts follow
+            continue
+        if quantity:
+            name = f"{quantity}({name})"
+        if len(key) > 2 and previous == key[:2] and tokens:
+            tokens[-1] = (tokens[-1][0], tokens[-1][1] + "+" + name)
+        else:
+            tokens.append((key[0], name))
+        previous = key[:2]
+    return tokens
+
+def occurrences(sign, texts, width=5):
+    """
+    Yield one record for each occurrence of a sign.
+
+    :param sign: A sign name or CG, normalized (see `SignlistIndex.normalize`).
+    :param texts: The UIDs of the texts to search, in order.
+    :param width: Number of signs of context to keep on either side, not
+                  counting the line breaks.
+    :returns: A generator of `(uid, line, left, sign, right)` records,
+              where `left` and `right` are lists of sign names. Line breaks
+              within the context are marked with "/".
+    """
+    for uid in texts:
+        tokens = tablet_tokens(uid)
+        for i, (line, name) in enumerate(tokens):
+            if name != sign and re.sub(r"^[0-9]+\((.*)\)$", r"\1", name) != sign:
+                continue
+            left, right = [], []
+            for j in range(i-1, max(-1, i-1-width), -1):
+                if tokens[j][0] != tokens[j+1][0]:
+                    left.insert(0, "/")
+                left.insert(0, tokens[j][1])
+            for j in range(i+1, min(len(tokens), i+1+width)):
+                if tokens[j][0] != tokens[j-1][0]:
+                    right.append("/")
+                right.append(tokens[j][1])
+            yield (uid, line, left, name, right)
+
+def external_sort(records, key):
+    """
+    Sort records which may not fit in memory.
+
+    Records are sorted in runs of `run_size`; if there is more than
+    one run, each is written to a temporary file and the runs are
+    merged lazily, so the first record is available before the merge
+    has read all of them.
+    """
+    records = iter(records)
+    run = sorted(itertools.islice(records, run_size), key=key)
+    following = list(itertools.islice(records, run_size))
+    if not following:
+        yield from run
+        return
+
+    with tempfile.TemporaryDirectory(prefix="clee-kwic-") as tmpdir:
+        paths = []
+        while run:
+            path = os.path.join(tmpdir, f"run{len(paths)}.jsonl")
+            with open(path, "w") as fp:
+                for record in run:
+                    fp.write(json.dumps([key(record), record]) + "\n")
+            paths.append(path)
+            run = sorted(following, key=key)
+            following = list(itertools.islice(records, run_size))
+
+        files = [open(path) for path in paths]
+        try:
+            runs = [(json.loads(line) for line in fp) for fp in files]
+            for _, record in heapq.merge(*runs, key=lambda pair: pair[0]):
+                yield tuple(record)
+        finally:
+            for fp in files:
+                fp.close()
+
+sort_keys = {
+    # nearest left neighbour first
+    "left": lambda r: (r[2][::-1], r[0], r[1]),
+    "right": lambda r: (r[4], r[0], r[1]),
+    "tablet": lambda r: (r[0], r[1]),
+}
+
+def format_occurrence(record, chars):
+    uid, line, left, name, right = record
+    left, right = " ".join(left), " ".join(right)
+    if len(left) > chars:
+        left = "…" + left[-(chars-1):]
+    if len(right) > chars:
+        right = right[:chars-1] + "…"
+    return f"{uid+':'+str(line):12} {left:>{chars}} \033[31;1m{name}\033[0m {right}"
+
+def do_kwic(clee, line):
+    """
+    Print a keyword-in-context concordance of a sign: one line for each
+    occurrence, with the sign highlighted between the signs before and
+    after it. Results are printed as they are found.
+
+    Usage:
+    kwic sign [--sort left|right|tablet] [-w signs] [-n limit] [in selection]
+
+    Examples:
+    kwic M288
+    -- prints every occurrence of M288 with its context
+
+    kwic M288 --sort left
+    -- sorts the occurrences of M288 by the sign before them (then the one before that, etc.)
+
+    kwic M157+M288 --sort right -w 3 in @susa
+    -- sorts the occurrences of M157+M288 in the saved selection @susa by the signs after them,
+       showing three signs of context on either side
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="kwic", exit_on_error=False)
+    parser.add_argument('sign')
+    parser.add_argument('--sort', choices=list(sort_keys))
+    parser.add_argument('-w', '--width', type=int, default=5)
+    parser.add_argument('-n', '--limit', type=int)
+    try:
+        line, within = clee.split_filter(line)
+        args = parser.parse_args(shlex.split(line))
+        if not (sign := is_sign(args.sign)):
+            raise ValueError(f"{args.sign} is not a sign name")
+        # as the tokens are named, e.g. M56 -> M056
+        sign = signlist.normalize(sign)
+        texts = get_texts(sign)
+        if texts is None:
+            raise ValueError(f"{sign} is not in the signlist")
+        uids = sorted(uid for uid, _ in texts)
+        if within is not None:
+            from .selection import contains
+            uids = [uid for uid in uids if contains(within, uid)]
+    except (ValueError, argparse.ArgumentError) as e:
+        print(e)
+        return
+    except SystemExit:
+        return
+
+    records = occurrences(sign, uids, args.width)
+    # Texts are read in order, so sorting by tablet is free
+    if args.sort in ["left", "right"]:
+        records = external_sort(records, sort_keys[args.sort])
+    # room for the signs and a line break after each
+    chars = 8 * args.width
+    count = 0
+    for record in itertools.islice(records, args.limit):
+        print(format_occurrence(record, chars))
+        count += 1
+    print(f"\n{count} occurrences of {sign}")
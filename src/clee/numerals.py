@@ -0,0 +1,296 @@
+"""
+The numerals command: corpus-wide arithmetic over numeral values.
+
+Every :num span has a value in N01 for each numeral system it could
+belong to (its disambig_<system> attributes). These are loaded once
+into parallel numpy arrays, one row per (numeral, system) pair, so
+that sums, totals checks, histograms and filters over the whole corpus
+are single vectorized operations. The arrays, and the results computed
+from them, are cached until the database changes.
+"""
+from collections import defaultdict
+import re
+import shlex
+
+import numpy as np
+
+from .cli_util import *
+
+class Numerals:
+    """
+    The numeral values of the whole corpus.
+
+    Per-row arrays (one row per numeral and system):
+      numeral  index into `uids`
+      tablet   tablet number (8001 for P008001)
+      system   index into `systems`
+      value    value in N01
+
+    Per-numeral lists/arrays (indexed like `uids`):
+      uids     UID of each :num span
+      entries  UID of the entry containing each numeral (or None)
+      lines    line number of each numeral
+      totals   True if the numeral is marked as a total (span_type = TOTAL)
+
+    If a snapshot (see clee.snapshot) is given, the arrays are mapped
+    from it instead of being read from the database.
+    """
+    def __init__(self, snapshot=None):
+        if snapshot is not None:
+            self.uids = snapshot["numerals.uids"]
+            self.entries = snapshot["numerals.entries"]
+            self.systems = snapshot["numerals.systems"].tolist()
+            for name in ["lines", "totals", "numeral", "tablet", "system", "value"]:
+                setattr(self, name, snapshot[f"numerals.{name}"])
+            return
+
+        cursor.execute("SELECT UID, SUBSTR(Attribute, 10), Value FROM ObjectAttributeValue WHERE Attribute LIKE 'disambig_%'")
+        rows = cursor.fetchall()
+        cursor.execute("SELECT Value, UID FROM ObjectAttributeValue WHERE Attribute = 'child' AND Value LIKE '%:num'")
+        parents = dict(cursor.fetchall())
+        cursor.execute("SELECT UID FROM ObjectAttributeValue WHERE Attribute = 'span_type' AND Value = 'TOTAL'")
+        marked_totals = set(uid for (uid,) in cursor.fetchall())
+
+        self.uids = sorted(set(uid for uid, _, _ in rows))
+        index = {uid: i for i, uid in enumerate(self.uids)}
+        self.systems = sorted(set(system for _, system, _ in rows))
+        system_index = {system: i for i, system in enumerate(self.systems)}
+
+        self.entries = [parents.get(uid) for uid in self.uids]
+        self.lines = np.array([int(uid.split(":")[1]) for uid in self.uids], dtype=np.int32)
+        self.totals = np.array([uid in marked_totals or self.entries[i] in marked_totals
+                                for i, uid in enumerate(self.uids)], dtype=bool)
+
+        self.numeral = np.array([index[uid] for uid, _, _ in rows], dtype=np.int32)
+        self.tablet = np.array([int(uid[1:7]) for uid, _, _ in rows], dtype=np.int32)
+        self.system = np.array([system_index[system] for _, system, _ in rows], dtype=np.int16)
+        self.value = np.array([float(value) for _, _, value in rows], dtype=np.float64)
+
+    def mask(self, tablets=None, system=None, uid=None):
+        """
+        Return a boolean mask over the rows.
+
+        :param tablets: A selection bitmap (see clee.selection), or None for all tablets.
+        :param system: The name of a numeral system, or None for all systems.
+        :param uid: Only keep numerals which are part of this UID.
+        """
+        mask = np.ones(len(self.value), dtype=bool)
+        if tablets is not None:
+            from .selection import tablet_number, tablets as selected
+            mask &= np.isin(self.tablet, [tablet_number(t) for t in selected(tablets)])
+        if system is not None:
+            if system not in self.systems:
+                raise ValueError(f"Unknown numeral system '{system}'. Known systems: {', '.join(self.systems)}")
+            mask &= self.system == self.systems.index(system)
+        if uid is not None:
+            keep = np.array([u == uid or u.startswith(uid+":") or (e or "") == uid
+                             for u, e in zip(self.uids, self.entries)], dtype=bool)
+            mask &= keep[self.numeral]
+        return mask
+
+    def sums(self, mask):
+        """
+        Return `(totals, counts)`: the sum of the values and the number of
+        numerals in each system, for the rows in mask.
+        """
+        n = len(self.systems)
+        totals = np.bincount(self.system[mask], weights=self.value[mask], minlength=n)
+        counts = np.bincount(self.system[mask], minlength=n)
+        return totals, counts
+
+    def check(self, mask, tolerance=0.01):
+        """
+        Check, for each tablet, whether its entries add up to its total.
+
+        The total of a tablet is the numeral marked with span_type = TOTAL
+        if there is one, and otherwise the last numeral on the tablet.
+
+        :returns: A list of `(tablet, system, entries_sum, total)` rows, one
+                  per tablet and system for which both sides have a value,
+                  and a boolean array saying which of them balance.
+        """
+        rows = np.flatnonzero(mask)
+        tablet, numeral, system = self.tablet[rows], self.numeral[rows], self.system[rows]
+        # Find the total numeral(s) of each tablet:
+        is_total = self.totals[numeral]
+        has_marked = defaultdict(bool)
+        for t in np.unique(tablet[is_total]):
+            has_marked[t] = True
+        last_line = {}
+        for t, n in zip(tablet, numeral):
+            if not has_marked[t] and self.lines[n] >= self.lines[last_line.get(t, n)]:
+                last_line[t] = n
+        is_total |= np.array([not has_marked[t] and last_line[t] == n for t, n in zip(tablet, numeral)], dtype=bool)
+
+        # Sum each side per (tablet, system) with one bincount each:
+        keys, key_index = np.unique(np.stack([tablet, system]), axis=1, return_inverse=True)
+        key_index = key_index.reshape(-1)
+        entries_sum = np.bincount(key_index, weights=np.where(is_total, 0, self.value[rows]), minlength=keys.shape[1])
+        entries_n = np.bincount(key_index, weights=(~is_total).astype(float), minlength=keys.shape[1])
+        total = np.bincount(key_index, weights=np.where(is_total, self.value[rows], 0), minlength=keys.shape[1])
+        total_n = np.bincount(key_index, weights=is_total.astype(float), minlength=keys.shape[1])
+
+        both = (entries_n > 0) & (total_n > 0)
+        results = [(f"P{t:06}", self.systems[s], e, v)
+                   for t, s, e, v in zip(keys[0][both], keys[1][both], entries_sum[both], total[both])]
+        balanced = np.abs(entries_sum[both] - total[both]) <= tolerance
+        return results, balanced
+
+    def where(self, mask, op, threshold):
+        """
+        Return the rows in mask whose value satisfies `value <op> threshold`.
+        """
+        compare = {
+            ">": np.greater, ">=": np.greater_equal,
+            "<": np.less, "<=": np.less_equal,
+            "=": np.isclose, "==": np.isclose, "!=": lambda a, b: ~np.isclose(a, b),
+        }
+        if op not in compare:
+            raise ValueError(f"Unknown comparison '{op}'")
+        return np.flatnonzero(mask & compare[op](self.value, threshold))
+
+_engine = None
+_engine_version = None
+_results = {}
+
+def engine():
+    """
+    Return the numeral arrays, reloading them if the database has changed.
+    They are read from the snapshot if it is up to date.
+    """
+    global _engine, _engine_version
+    version = db_version()
+    if _engine is None or _engine_version != version:
+        from .snapshot import current
+        _engine = Numerals(current())
+        _engine_version = version
+        _results.clear()
+    return _engine
+
+def cached(key, compute):
+    """
+    Return the result of compute(), cached under key until the database changes.
+    """
+    engine()
+    if key not in _results:
+        _results[key] = compute()
+    return _results[key]
+
+def format_value(value):
+    return re.sub(r'\.00', '   ', '{:>10.2f}'.format(round(value, 2)))
+
+def do_numerals(clee, line):
+    """
+    Sum, check, and search numeral values across entries, tablets,
+    or the whole corpus. Values are given in N01 for each numeral system,
+    as in the VALUE(S) column of describe.
+
+    Usage:
+    numerals sum [uid] [in selection]
+    numerals check [uid] [--all] [in selection]
+    numerals hist system [--bins n] [--log] [in selection]
+    numerals where system (>|>=|<|<=|=|!=) value [in selection]
+
+    Examples:
+    numerals sum
+    -- totals every numeral in the corpus, for each numeral system
+
+    numerals sum P008001
+    -- totals the numerals on P008001
+
+    numerals check in @susa
+    -- for each text in the saved selection @susa, checks whether the entries add up to the
+       total (the numeral marked span_type = TOTAL, or else the last numeral on the text),
+       and lists the texts which don't. --all also lists the ones which do.
+
+    numerals hist decimal --bins 20 --log
+    -- prints a histogram of the values of all numerals in the decimal system
+
+    numerals where decimal > 100
+    -- lists the numerals whose value in the decimal system exceeds 100 N01
+    """
+    import argparse
+    try:
+        line, within = clee.split_filter(line)
+        args = shlex.split(line)
+        if not args:
+            raise ValueError("Usage: numerals (sum|check|hist|where) ...")
+        action, args = args[0], args[1:]
+        numerals = engine()
+
+        if action == "sum":
+            uid = is_uid(args[0]) if args else None
+            if args and not uid:
+                raise ValueError(f"Unknown UID: {args[0]}")
+            totals, counts = cached(("sum", uid, within), lambda: numerals.sums(numerals.mask(within, uid=uid)))
+            draw_header("numerals")
+            print(f"{'SYSTEM':20} {'NUMERALS':>9} {'TOTAL (N01)':>13}")
+            for system, total, count in zip(numerals.systems, totals, counts):
+                if count:
+                    print(f"{system.replace(',', ''):20} {count:>9} {format_value(total):>13}")
+
+        elif action == "check":
+            parser = argparse.ArgumentParser(prog="numerals check", exit_on_error=False)
+            parser.add_argument('uid', nargs='?')
+            parser.add_argument('--all', action='store_true')
+            parser.add_argument('--tolerance', type=float, default=0.01)
+            check_args = parser.parse_args(args)
+            uid = None
+            if check_args.uid and not (uid := is_uid(check_args.uid)):
+                raise ValueError(f"Unknown UID: {check_args.uid}")
+            results, balanced = cached(("check", uid, within, check_args.tolerance),
+                                       lambda: numerals.check(numerals.mask(within, uid=uid), check_args.tolerance))
+            draw_header("totals")
+            texts = defaultdict(list)
+            for (tablet, system, entries_sum, total), ok in zip(results, balanced):
+                texts[tablet].append((system, entries_sum, total, ok))
+            n_balanced = sum(any(ok for *_, ok in rows) for rows in texts.values())
+            print(f"{n_balanced} of {len(texts)} texts have entries which add up to their total in at least one system.\n")
+            for tablet, rows in sorted(texts.items()):
+                ok = any(ok for *_, ok in rows)
+                if ok and not check_args.all:
+                    continue
+                print(f"{tablet}: {'balances' if ok else 'does not balance'}")
+                for system, entries_sum, total, balances in rows:
+                    print(f"  {'=' if balances else '≠'} {system.replace(',', ''):20} entries {format_value(entries_sum)}  total {format_value(total)}")
+
+        elif action == "hist":
+            parser = argparse.ArgumentParser(prog="numerals hist", exit_on_error=False)
+            parser.add_argument('system')
+            parser.add_argument('--bins', type=int, default=10)
+            parser.add_argument('--log', action='store_true')
+            hist_args = parser.parse_args(args)
+
+            def compute():
+                values = numerals.value[numerals.mask(within, system=hist_args.system)]
+                if hist_args.log:
+                    values = values[values > 0]
+                    counts, edges = np.histogram(np.log10(values), bins=hist_args.bins)
+                    return counts, 10**edges
+                return np.histogram(values, bins=hist_args.bins)
+            counts, edges = cached(("hist", hist_args.system, hist_args.bins, hist_args.log, within), compute)
+            draw_header(f"{hist_args.system.replace(',', '')}")
+            width = 40
+            peak = max(counts.max(), 1) if len(counts) else 1
+            for count, low, high in zip(counts, edges, edges[1:]):
+                print(f"{format_value(low)} - {format_value(high)} │{'█'*int(round(width*count/peak)):{width}} {count}")
+
+        elif action == "where":
+            if len(args) != 3:
+                raise ValueError("Usage: numerals where system (>|>=|<|<=|=|!=) value")
+            system, op, threshold = args[0], args[1], float(args[2])
+            rows = cached(("where", system, op, threshold, within),
+                          lambda: numerals.where(numerals.mask(within, system=system), op, threshold))
+            draw_header("numerals")
+            print(f"{len(rows)} numerals have a value {op} {args[2]} N01 in the {system.replace(',', '')} system:")
+            for row in rows:
+                n = numerals.numeral[row]
+                print(f"  {numerals.entries[n] or numerals.uids[n]:20} {format_value(numerals.value[row])} xN01")
+
+        else:
+            raise ValueError(f"Unknown action '{action}'. Type \"? numerals\" for documentation.")
+
+    except (ValueError, argparse.ArgumentError) as e:
+        print(e)
+    except SystemExit:
+        pass
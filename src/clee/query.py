@@ -0,0 +1,500 @@
+"""
+The query command: find entries by their structure.
+
+A query is a condition on entries, built from terms about the entry
+itself (its attributes, signs and numerals) and about the entries
+around it (the next or previous entry, the rest of its segment or
+tablet). For example,
+
+    span_type=HEADER and next (has M288 and numeral > 10)
+
+finds headers whose following entry contains M288 and has a numeral
+worth more than 10 N01.
+
+Queries are evaluated like selections (see clee.selection), but over
+entries rather than tablets: every entry of the corpus has a bit
+position, in reading order, and each term is a bitmap. Terms which
+need data (attributes, signs, numerals) are loaded with SQL queries
+which use the indexes clee.ingest creates; the structure is loaded
+once per database version from the 'child' attributes. The query
+command only reads the database, and works without the indexes, only
+more slowly. Relations between entries are then bit
+operations: "next X" is X shifted by one place, masked to stay within
+a tablet, so a query over the whole corpus takes a handful of queries
+and integer operations however it is nested.
+
+"query explain ..." prints the plan, with the number of entries
+matched by each term, the time it took, and SQLite's plan for each SQL
+query it ran.
+"""
+from collections import defaultdict
+import shlex
+import time
+
+from .cli_util import *
+
+relations = ["next", "prev", "segment", "tablet"]
+comparisons = [">", ">=", "<", "<=", "=", "!="]
+
+def from_positions(positions):
+    """
+    Return the bitmap with the given bits set. Building it as bytes
+    avoids creating a large int for every bit.
+    """
+    positions = list(positions)
+    if not positions:
+        return 0
+    data = bytearray(max(positions)//8 + 1)
+    for i in positions:
+        data[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(data, "little")
+
+def positions(bits):
+    """
+    Return the positions of the set bits of a bitmap, in order.
+    """
+    return [i for i, bit in enumerate(reversed(bin(bits)[2:])) if bit == "1"]
+
+class Entries:
+    """
+    The entries of the corpus, in reading order, and how they are grouped
+    into tablets and segments.
+
+      uids       UID of each entry; entry i is bit i of a bitmap
+      position   dict from UID to bit position
+      tablets    dict from tablet UID to the bitmap of its entries
+      segments   dict from segment UID to the bitmap of its entries
+      has_next   bitmap of the entries followed by another entry on the same tablet
+    """
+    def __init__(self):
+        cursor.execute("SELECT UID, Value FROM ObjectAttributeValue WHERE Attribute = 'child'")
+        self.parent = {}
+        children = defaultdict(list)
+        for parent, child in cursor.fetchall():
+            self.parent[child] = parent
+            children[parent].append(child)
+        cursor.execute("SELECT UID FROM Object WHERE UID LIKE '%:ent'")
+        self.uids = sorted((uid for (uid,) in cursor.fetchall()), key=lambda uid: (uid[:7], int(uid.split(":")[1])))
+        self.position = {uid: i for i, uid in enumerate(self.uids)}
+        self.all = (1 << len(self.uids)) - 1
+
+        # Each tablet's entries are consecutive
+        first = {}
+        count = defaultdict(int)
+        for i, uid in enumerate(self.uids):
+            first.setdefault(uid[:7], i)
+            count[uid[:7]] += 1
+        self.tablets = {tablet: ((1 << count[tablet]) - 1) << i for tablet, i in first.items()}
+        self.has_next = from_positions(i for i in range(len(self.uids)-1) if self.uids[i][:7] == self.uids[i+1][:7])
+        self._entry = {}
+        self.segments = {}
+        self.segments = {segment: self.bitmap(children[segment]) for segment in children if segment.endswith(":1sg")}
+
+    def entry(self, uid):
+        """
+        Return the position of the entry which uid belongs to (uid may be
+        the entry, one of its spans, or a sign), or None.
+        """
+        if uid in self.position:
+            return self.position[uid]
+        if uid not in self._entry:
+            parent = self.parent.get(uid)
+            self._entry[uid] = self.entry(parent) if parent else None
+        return self._entry[uid]
+
+    def bitmap(self, uids):
+        """
+        Return the bitmap of the entries the given objects belong to. A
+        tablet or segment stands for all of its entries.
+        """
+        bits = 0
+        entries = set()
+        for uid in uids:
+            if uid in self.tablets:
+                bits |= self.tablets[uid]
+            elif uid in self.segments:
+                bits |= self.segments[uid]
+            elif (i := self.entry(uid)) is not None:
+                entries.add(i)
+        return bits | from_positions(entries)
+
+    def expand(self, bits, groups):
+        """
+        Return every entry in a group (tablet or segment) which has an entry in bits.
+        """
+        expanded = 0
+        for group in groups.values():
+            if group & bits:
+                expanded |= group
+        return expanded
+
+_entries = None
+_entries_version = None
+
+def entries():
+    """
+    Return the entry structure, reloading it if the database has changed.
+    """
+    global _entries, _entries_version
+    version = db_version()
+    if _entries is None or _entries_version != version:
+        _entries = Entries()
+        _entries_version = version
+    return _entries
+
+def tokenize(query):
+    lexer = shlex.shlex(query, posix=True, punctuation_chars="()<>=!")
+    lexer.wordchars += "@:+|~,."
+    return list(lexer)
+
+def parse(query):
+    """
+    Parse a query into a tree of tuples: ("or", a, b), ("and", a, b),
+    ("not", a), (relation, a), or an atom:
+      ("attribute", name, value)
+      ("has", sign)
+      ("numeral", system or None, comparison, number)
+      ("first",), ("last",)
+      ("selection", expression)
+
+    :param query: The query, or its tokens as returned by `tokenize`.
+    """
+    tokens = tokenize(query) if isinstance(query, str) else list(query)
+    pos = 0
+
+    def peek(offset=0):
+        return tokens[pos+offset] if pos+offset < len(tokens) else None
+
+    def take(expected=None):
+        nonlocal pos
+        if pos >= len(tokens):
+            raise ValueError(f"Incomplete query: {query}")
+        token = tokens[pos]
+        if expected and token.lower() != expected:
+            raise ValueError(f"Expected '{expected}' but found '{token}'")
+        pos += 1
+        return token
+
+    def disjunction():
+        tree = conjunction()
+        while (peek() or "").lower() == "or":
+            take()
+            tree = ("or", tree, conjunction())
+        return tree
+
+    def conjunction():
+        tree = negation()
+        while (peek() or "").lower() in ["and", "but"]:
+            take()
+            tree = ("and", tree, negation())
+        return tree
+
+    def negation():
+        word = (peek() or "").lower()
+        if word == "not":
+            take()
+            return ("not", negation())
+        if word in relations:
+            take()
+            return (word, negation())
+        if word == "(":
+            take()
+            tree = disjunction()
+            take(")")
+            return tree
+        return atom()
+
+    def atom():
+        token = take()
+        word = token.lower()
+        if word == "has":
+            sign = take()
+            if not (name := is_sign(sign)):
+                raise ValueError(f"{sign} is not a sign name")
+            return ("has", signlist.normalize(name))
+        if word == "numeral":
+            system = None
+            if peek() not in comparisons:
+                system = take()
+            comparison = take()
+            if comparison not in comparisons:
+                raise ValueError(f"Expected one of {' '.join(comparisons)} after 'numeral'")
+            try:
+                return ("numeral", system, comparison, float(take()))
+            except ValueError:
+                raise ValueError("Expected a number after the comparison")
+        if word in ["first", "last"]:
+            return (word,)
+        if word in ["selection", "all"] or token.startswith("@"):
+            return ("selection", token)
+        if peek() in ["=", "!="]:
+            comparison = take()
+            tree = ("attribute", token, take())
+            return tree if comparison == "=" else ("not", tree)
+        raise ValueError(f"Don't know how to query '{token}'")
+
+    tree = disjunction()
+    if pos != len(tokens):
+        raise ValueError(f"Unexpected '{tokens[pos]}' in query")
+    return tree
+
+def run_sql(sql, params, plan):
+    """
+    Run a query, noting it (and SQLite's plan for it) in plan.
+    """
+    if plan is not None:
+        steps = [row[-1] for row in cursor.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+        plan.append((sql.strip(), params, steps))
+    return cursor.execute(sql, params).fetchall()
+
+def values(value):
+    # Values may be stored as numbers or as text
+    try:
+        number = float(value)
+        return [value, int(number) if number.is_integer() else number]
+    except ValueError:
+        return [value, value]
+
+def has_sign(index, sign, plan):
+    """
+    Return the bitmap of the entries which contain a sign or CG.
+    """
+    components = signlist.components(sign)
+    if any(sign_id is None for _, sign_id in components):
+        raise ValueError(f"{sign} is not in the signlist")
+    sql = "SELECT UID FROM ObjectAttributeValue WHERE Attribute = 'SignID' AND Value = ?"
+    if len(components) == 1:
+        return index.bitmap(uid for (uid,) in run_sql(sql, (components[0][1],), plan))
+    # A CG: the token whose parts are the components, in order, and no others
+    parts = defaultdict(dict)
+    for j, (_, sign_id) in enumerate(components):
+        for (uid,) in run_sql(sql, (sign_id,), plan):
+            token, _, part = uid.rpartition(":")
+            if part == str(j) and ":sgn:" in token:
+                parts[token][j] = True
+    matches = [token for token, found in parts.items()
+               if len(found) == len(components) and f"{token}:{len(components)}" not in index.parent]
+    return index.bitmap(matches)
+
+_systems = None
+_systems_version = None
+
+def numeral_systems(plan):
+    """
+    Return the disambig_<system> attributes in the database, looking them
+    up again only if the database has changed. Each step of the recursion
+    finds the next attribute with one lookup in the index on
+    (Attribute, Value), rather than reading every value.
+    """
+    global _systems, _systems_version
+    version = db_version()
+    if _systems is None or _systems_version != version:
+        rows = run_sql("""
+        WITH RECURSIVE systems(attribute) AS (
+          SELECT MIN(Attribute) FROM ObjectAttributeValue WHERE Attribute > 'disambig_' AND Attribute < 'disambig`'
+          UNION ALL
+          SELECT (SELECT MIN(Attribute) FROM ObjectAttributeValue WHERE Attribute > systems.attribute AND Attribute < 'disambig`')
+          FROM systems WHERE attribute IS NOT NULL
+        ) SELECT attribute FROM systems WHERE attribute IS NOT NULL""", (), plan)
+        _systems = [attribute for (attribute,) in rows]
+        _systems_version = version
+    return _systems
+
+def numeral_uids(system, comparison, number, plan):
+    """
+    Return the numerals whose value in a system (or in any system, if
+    system is None) compares to number as given.
+
+    The comparison is made on Value itself, so that it is a range in the
+    index on (Attribute, Value). Values are stored as numbers, which
+    SQLite orders before all text, so the rare value stored as text is
+    found separately, in the text part of the range, and converted.
+    Each part of the condition is its own range (SQLite's "multi-index
+    OR"), and without the index it is still one scan per system.
+    """
+    attributes = [f"disambig_{system}"] if system else numeral_systems(plan)
+    # != is two ranges
+    ops = ["<", ">"] if comparison == "!=" else [comparison]
+    condition = " OR ".join([f"(Value {op} ?2 AND typeof(Value) IN ('integer', 'real'))" for op in ops] +
+                            [f"(Value >= '' AND typeof(Value) = 'text' AND CAST(Value AS REAL) {comparison} ?2)"])
+    uids = []
+    for attribute in attributes:
+        uids += [uid for (uid,) in run_sql(
+            f"SELECT UID FROM ObjectAttributeValue WHERE Attribute = ?1 AND ({condition})", (attribute, number), plan)]
+    return uids
+
+def evaluate(tree, index, clee=None, explain=None, depth=0):
+    """
+    Evaluate a parsed query.
+
+    :param explain: If a list, a line describing each step is appended to it.
+    :returns: The bitmap of matching entries.
+    """
+    start = time.perf_counter()
+    plan = [] if explain is not None else None
+    if explain is not None:
+        # reserve a place, so that steps are listed top-down
+        step = len(explain)
+        explain.append(None)
+    kind = tree[0]
+
+    if kind == "or":
+        bits = evaluate(tree[1], index, clee, explain, depth+1) | evaluate(tree[2], index, clee, explain, depth+1)
+    elif kind == "and":
+        bits = evaluate(tree[1], index, clee, explain, depth+1)
+        # no need to evaluate the right side if nothing is left
+        bits = bits and bits & evaluate(tree[2], index, clee, explain, depth+1)
+    elif kind == "not":
+        bits = index.all & ~evaluate(tree[1], index, clee, explain, depth+1)
+    elif kind == "next":
+        bits = (evaluate(tree[1], index, clee, explain, depth+1) >> 1) & index.has_next
+    elif kind == "prev":
+        bits = (evaluate(tree[1], index, clee, explain, depth+1) & index.has_next) << 1
+    elif kind == "tablet":
+        bits = index.expand(evaluate(tree[1], index, clee, explain, depth+1), index.tablets)
+    elif kind == "segment":
+        bits = index.expand(evaluate(tree[1], index, clee, explain, depth+1), index.segments)
+    elif kind == "first":
+        bits = index.all & ~((index.has_next & index.all) << 1)
+    elif kind == "last":
+        bits = index.all & ~index.has_next
+    elif kind == "attribute":
+        _, attr, value = tree
+        rows = run_sql("SELECT UID FROM ObjectAttributeValue WHERE Attribute = ? AND Value IN (?, ?)",
+                       (attr, *values(value)), plan)
+        bits = index.bitmap(uid for (uid,) in rows)
+    elif kind == "has":
+        bits = has_sign(index, tree[1], plan)
+    elif kind == "numeral":
+        bits = index.bitmap(numeral_uids(*tree[1:], plan))
+    elif kind == "selection":
+        from .selection import evaluate as select, tablets
+        bits = sum(index.tablets.get(uid, 0) for uid in tablets(select(tree[1], clee.selection if clee else 0)))
+    else:
+        raise ValueError(f"Unknown query term {kind}")
+
+    if explain is not None:
+        label = describe_tree(tree) if kind not in ["and", "or", "not"] + relations else kind
+        explain[step] = (depth, label, bin(bits).count("1"), time.perf_counter() - start, plan)
+    return bits
+
+def describe_tree(tree):
+    """
+    Return a parsed query written out in full, with parentheses.
+    """
+    kind = tree[0]
+    if kind in ["and", "or"]:
+        return f"({describe_tree(tree[1])} {kind} {describe_tree(tree[2])})"
+    if kind == "not" or kind in relations:
+        return f"{kind} {describe_tree(tree[1])}"
+    if kind == "attribute":
+        return f"{tree[1]}={shlex.quote(tree[2])}"
+    if kind == "numeral":
+        _, system, comparison, number = tree
+        return f"numeral {system + ' ' if system else ''}{comparison} {number:g}"
+    return " ".join(str(part) for part in tree)
+
+def print_explain(tree, steps, total):
+    draw_header("query plan")
+    print(f"Query: {describe_tree(tree)}")
+    print(f"{'STEP':50} {'ENTRIES':>8} {'TIME (ms)':>10}")
+    for depth, label, count, seconds, plan in steps:
+        print(f"{'  '*depth + label:50} {count:>8} {seconds*1000:>10.1f}")
+        for sql, params, sqlite_plan in plan or []:
+            print(f"{'  '*depth}  SQL: {' '.join(sql.split())}  {list(params)}")
+            for step in sqlite_plan:
+                print(f"{'  '*depth}    {step}")
+    print(f"Total: {total*1000:.1f} ms\n")
+
+def entry_text(uid, cache):
+    from .kwic import tablet_tokens
+    tablet, line = uid[:7], int(uid.split(":")[1])
+    if tablet not in cache:
+        cache[tablet] = tablet_tokens(tablet)
+    return " ".join(name for n, name in cache[tablet] if n == line)
+
+def do_query(clee, line):
+    """
+    Find entries by their content and by the entries around them.
+
+    Usage:
+    query [tablets] [explain] condition [-n limit] [in selection]
+
+    Conditions combine the following terms with and, or, not, but, and parentheses:
+    attribute=value        the entry, its text or numeral, or its segment or tablet has that value
+    has M288, has M056+M288
+                           the entry contains the sign or CG
+    numeral > 10           the entry has a numeral worth more than 10 N01 (in any system);
+                           also >=, <, <=, =, !=
+    numeral decimal > 10   ... worth more than 10 N01 in the decimal system
+    first, last            the first or last entry of its tablet
+    @name, selection       the entry is on a tablet in a saved selection, or the current selection
+
+    and these relations, which apply to the term after them:
+    next X                 the following entry (on the same tablet) matches X
+    prev X                 the preceding entry matches X
+    segment X              some entry in the same segment matches X
+    tablet X               some entry on the same tablet matches X
+
+    Examples:
+    query span_type=HEADER and next (has M288 and numeral > 10)
+    -- lists headers whose following entry contains M288 and has a numeral greater than 10 N01
+
+    query tablets has M388 and not tablet has M288 in provenience=Susa
+    -- lists the tablets from Susa with an entry containing M388, but no M288 anywhere
+
+    query explain last and prev numeral decimal >= 100
+    -- shows how the query is evaluated and how long each step takes
+    """
+    show_tablets = explain = False
+    limit = 50
+    try:
+        line, within = clee.split_filter(line)
+        # Tokenized as the query will be, so that quoted values are kept whole
+        words = tokenize(line)
+        while words and words[0] in ["tablets", "explain"]:
+            show_tablets |= words[0] == "tablets"
+            explain |= words[0] == "explain"
+            words = words[1:]
+        if "-n" in words:
+            i = words.index("-n")
+            limit = int(words[i+1])
+            words = words[:i] + words[i+2:]
+        if not words:
+            raise ValueError("Usage: query [tablets] [explain] condition [-n limit] [in selection]")
+        tree = parse(words)
+
+        start = time.perf_counter()
+        index = entries()
+        loaded = time.perf_counter()
+        steps = [] if explain else None
+        bits = evaluate(tree, index, clee, steps)
+        if within is not None:
+            from .selection import tablets as selected
+            bits &= sum(index.tablets.get(uid, 0) for uid in selected(within))
+        finished = time.perf_counter()
+    except (ValueError, IndexError) as e:
+        print(e)
+        return
+
+    if explain:
+        print(f"Loaded the structure of {len(index.uids)} entries in {(loaded-start)*1000:.1f} ms")
+        print_explain(tree, steps, finished - loaded)
+
+    matches = [index.uids[i] for i in positions(bits)]
+    if show_tablets:
+        tablets = sorted(set(uid[:7] for uid in matches))
+        draw_header("tablets")
+        print(f"{len(tablets)} tablets have matching entries:")
+        for tablet in tablets[:limit]:
+            print(f"  {tablet}: {', '.join(uid for uid in matches if uid[:7] == tablet)}")
+        if len(tablets) > limit:
+            print(f"  ... ({len(tablets)-limit} more)")
+    else:
+        draw_header("entries")
+        print(f"{len(matches)} entries match:")
+        cache = {}
+        for uid in matches[:limit]:
+            print(f"  {uid:16} {entry_text(uid, cache)}")
+        if len(matches) > limit:
+            print(f"  ... ({len(matches)-limit} more; use -n to show more)")
@@ -0,0 +1,253 @@
+"""
+Replay a recorded CLEE workload against a copy of the database and
+report per-command latency.
+
+Usage:
+python -m clee.replay [history|sql.log|session-file] [--db path] [--repeat n] [--answer y|n] [--verbose]
+
+Examples:
+python -m clee.replay
+-- replays ~/.clee/history against a copy of ~/.clee/grist.db
+
+python -m clee.replay sql.log --db ~/grist-with-index.db --repeat 3
+-- replays the commands recorded in ~/.clee/sql.log three times against
+   a copy of an alternative database, e.g. one with an extra index
+"""
+import argparse
+import builtins
+import contextlib
+import io
+import math
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+clee_dir = os.path.join(os.path.expanduser('~'), '.clee')
+
+# Answer given to prompts other than yes/no questions (e.g. the
+# [n]ext/[p]rev/[q]uit prompt in grep) when the recording doesn't
+# contain one:
+default_answer = "q"
+
+def read_history(path):
+    """
+    Return the commands stored in a readline history file.
+    """
+    with open(path) as fp:
+        lines = fp.read().splitlines()
+    # libedit (macOS) writes a header and escapes spaces:
+    if lines and lines[0] == "_HiStOrY_V2_":
+        lines = [re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), l) for l in lines[1:]]
+    return lines
+
+def read_sql_log(path):
+    """
+    Return the commands which issued the queries in sql.log, in order.
+
+    Each line of sql.log has the form "time #pid.n │ command │ query",
+    where n numbers the commands of a session and queries may continue
+    over several lines. The queries issued by one command are collapsed
+    into a single command, but a command which was run twice in a row
+    is returned twice. (Logs written before commands were numbered only
+    have the time, to the second, to tell such commands apart.)
+    """
+    commands = []
+    last = None
+    with open(path) as fp:
+        for line in fp:
+            fields = line.split(" │ ", 2)
+            if len(fields) < 3:
+                # continuation of a multi-line query
+                continue
+            stamp, command = fields[0], fields[1]
+            key = (stamp.rpartition(" #")[2] if " #" in stamp else stamp, command)
+            if key != last:
+                commands.append(command)
+                last = key
+    return commands
+
+def read_session(path):
+    """
+    Return the commands in a session file: one command per line, with
+    blank lines and lines starting with # ignored.
+    """
+    with open(path) as fp:
+        return [l.strip() for l in fp if l.strip() and not l.startswith("#")]
+
+def load_workload(source):
+    """
+    Read a workload from history, sql.log, or a session file.
+
+    :param source: "history", "sql.log", or the path to a file in any of the three formats.
+    :returns: A list of lines in the order they were entered.
+    """
+    if source == "history":
+        return read_history(os.path.join(clee_dir, "history"))
+    if source == "sql.log":
+        return read_sql_log(os.path.join(clee_dir, "sql.log"))
+    with open(source) as fp:
+        first = fp.readline()
+    if first.rstrip("\n") == "_HiStOrY_V2_":
+        return read_history(source)
+    if first.count(" │ ") >= 2:
+        return read_sql_log(source)
+    return read_session(source)
+
+def group_answers(lines, commands):
+    """
+    Pair each command with the answers which were typed into its prompts.
+
+    History files and sql.log record the answers to prompts (e.g. "y" for
+    "Does this comment refer to P008001?") as though they were commands.
+    Lines which do not start with a known command are treated as answers
+    to the prompts of the preceding command.
+
+    :param lines: The lines of a workload, as returned by `load_workload`.
+    :param commands: The names of the commands CLEE understands.
+    :returns: A list of `(command, answers)` pairs.
+    """
+    workload = []
+    for line in lines:
+        line = line.strip()
+        name = re.split(r"[ \t]", line, 1)[0]
+        if name in commands or name in ["?", "help"]:
+            if name not in ["exit", "EOF"]:
+                workload.append((line, []))
+        elif workload and line:
+            workload[-1][1].append(line)
+    return workload
+
+def copy_database(src, dst):
+    """
+    Copy an SQLite database using the backup API, which (unlike a file
+    copy) gives a consistent snapshot even while CLEE has it open.
+    """
+    source = sqlite3.connect(src)
+    target = sqlite3.connect(dst)
+    with target:
+        source.backup(target)
+    target.close()
+    source.close()
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of a non-empty list of numbers.
+    """
+    values = sorted(values)
+    rank = max(1, math.ceil(p/100 * len(values)))
+    return values[rank-1]
+
+def replay(workload, answer="Y", verbose=False, repeat=1):
+    """
+    Run each command of a workload through CLEE and time it.
+
+    :param workload: A list of `(command, answers)` pairs, as returned by `group_answers`.
+    :param answer: The answer to give to yes/no prompts which were not recorded.
+    :param verbose: If True, show CLEE's output instead of discarding it.
+    :param repeat: Number of times to run the whole workload.
+    :returns: A tuple `(timings, errors)`: a dict mapping each command type to a list of latencies in seconds, and a dict counting the commands of each type which raised an exception.
+    """
+    from .__main__ import CLEE
+    from . import cli_util
+    # Replayed commands must not end up in the user's sql.log
+    cli_util.db.set_trace_callback(None)
+
+    clee = CLEE()
+    timings = defaultdict(list)
+    errors = defaultdict(int)
+    pending = []
+
+    def auto_input(question=""):
+        if pending:
+            return pending.pop(0)
+        if "(Y/N)" in question:
+            return answer
+        return default_answer
+
+    real_input = builtins.input
+    builtins.input = auto_input
+    try:
+        for _ in range(repeat):
+            for command, answers in workload:
+                pending[:] = answers
+                kind = clee.parseline(command)[0] or command
+                output = sys.stdout if verbose else io.StringIO()
+                start = time.perf_counter()
+                try:
+                    with contextlib.redirect_stdout(output):
+                        clee.onecmd(command)
+                except Exception:
+                    errors[kind] += 1
+                timings[kind].append(time.perf_counter() - start)
+    finally:
+        builtins.input = real_input
+    return timings, errors
+
+def report(timings, errors):
+    print(f"{'COMMAND':12} {'N':>6} {'ERR':>4} {'MEAN':>9} {'P50':>9} {'P90':>9} {'P99':>9} {'MAX':>9}")
+    for kind, values in sorted(timings.items(), key=lambda kv: -sum(kv[1])):
+        ms = [v*1000 for v in values]
+        print(f"{kind:12} {len(ms):>6} {errors[kind]:>4} "
+              f"{sum(ms)/len(ms):>9.2f} {percentile(ms, 50):>9.2f} "
+              f"{percentile(ms, 90):>9.2f} {percentile(ms, 99):>9.2f} {max(ms):>9.2f}")
+    print("(latencies in ms)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m clee.replay",
+        description="Replay a recorded CLEE session against a copy of the database.")
+    parser.add_argument(
+        'source',
+        nargs='?',
+        default='history',
+        help='"history", "sql.log", or the path to a history, sql.log, or session file',
+    )
+    parser.add_argument(
+        '--db',
+        default=os.environ.get('CLEE_DB', os.path.join(clee_dir, 'grist.db')),
+        help='database to copy and replay against (default: ~/.clee/grist.db)',
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--answer',
+        choices=["y", "n"],
+        default="y",
+        help='answer to give to yes/no prompts which were not recorded',
+    )
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help="show CLEE's output while replaying",
+    )
+    args = parser.parse_args(argv)
+
+    lines = load_workload(args.source)
+
+    tmpdir = tempfile.mkdtemp(prefix="clee-replay-")
+    try:
+        copy = os.path.join(tmpdir, "grist.db")
+        copy_database(args.db, copy)
+        # cli_util reads CLEE_DB when it is first imported
+        os.environ['CLEE_DB'] = copy
+
+        from .__main__ import CLEE
+        commands = [name[3:] for name in CLEE().get_names() if name.startswith("do_")]
+        workload = group_answers(lines, commands)
+        print(f"Replaying {len(workload)} commands from {args.source} against a copy of {args.db}")
+
+        timings, errors = replay(workload, answer=args.answer.upper(), verbose=args.verbose, repeat=args.repeat)
+        report(timings, errors)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
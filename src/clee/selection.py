@@ -0,0 +1,317 @@
+"""
+Selections: sets of tablets, stored as bitmaps over tablet numbers.
+
+A bitmap is a plain int in which bit n is set if tablet Pn belongs to
+the set, so AND/OR/NOT are single integer operations which take
+microseconds even for the whole corpus. Sets are built from queries
+(texts containing a sign or CG, texts with an attribute value, texts
+linked to a comment), and the per-sign sets are all computed in one
+pass over the database and cached until the database changes.
+"""
+import base64
+import json
+import os
+import shlex
+import textwrap
+import zlib
+
+from .cli_util import *
+
+selections_path = os.path.join(clee_dir, 'selections.json')
+
+def tablet_number(uid):
+    """
+    Return the number of a tablet, e.g. 8001 for P008001 or any of its parts.
+    """
+    try:
+        return int(uid[1:7])
+    except ValueError:
+        return None
+
+def bitmap(uids):
+    """
+    Return the bitmap of the tablets which the given UIDs belong to.
+    """
+    bits = 0
+    for uid in uids:
+        if (n := tablet_number(uid)) is not None:
+            bits |= 1 << n
+    return bits
+
+def tablets(bits):
+    """
+    Yield the UID of each tablet in a bitmap, in order.
+    """
+    while bits:
+        low = bits & -bits
+        yield f"P{low.bit_length()-1:06}"
+        bits ^= low
+
+def size(bits):
+    return bin(bits).count("1")
+
+def contains(bits, uid):
+    n = tablet_number(uid)
+    return n is not None and bool(bits >> n & 1)
+
+_cache = {}
+_cache_version = None
+
+def cached(key, compute):
+    """
+    Return the bitmap for key, computing it if the database has changed
+    since it was last computed.
+    """
+    global _cache_version
+    version = db_version()
+    if _cache_version != version:
+        _cache.clear()
+        _cache_version = version
+    if key not in _cache:
+        _cache[key] = compute()
+    return _cache[key]
+
+def sign_bitmaps():
+    """
+    Return a dict mapping each SignID to the bitmap of texts containing it.
+    """
+    def compute():
+        bitmaps = {}
+        cursor.execute("SELECT DISTINCT SUBSTR(UID, 1, 7), Value FROM ObjectAttributeValue WHERE Attribute = 'SignID'")
+        for uid, sign_id in cursor.fetchall():
+            if (n := tablet_number(uid)) is not None:
+                sign_id = int(sign_id)
+                bitmaps[sign_id] = bitmaps.get(sign_id, 0) | 1 << n
+        return bitmaps
+    return cached("signs", compute)
+
+def all_tablets():
+    return cached("all", lambda: bitmap(uid for uid in canonical_uids.values() if ":" not in uid))
+
+def sign_id(name):
+    if (id_ := signlist.id(name)) is None:
+        raise ValueError(f"{name} is not in the signlist")
+    return id_
+
+def by_sign(sign):
+    if "+" in sign:
+        ids = [sign_id(component) for component in sign.split("+")]
+        return cached(sign, lambda: bitmap(uid for uid, _ in get_texts_by_cg(ids[0], ids[1], *ids[2:3])))
+    return sign_bitmaps().get(sign_id(sign), 0)
+
+def by_attribute(attr, value):
+    def compute():
+        cursor.execute("SELECT DISTINCT SUBSTR(UID, 1, 7) FROM ObjectAttributeValue WHERE Attribute = ? AND Value = ?", (attr, value))
+        return bitmap(uid for (uid,) in cursor.fetchall())
+    return cached(("attr", attr, value), compute)
+
+def by_comment(comment_id=None):
+    def compute():
+        if comment_id is None:
+            cursor.execute("SELECT DISTINCT UID FROM ReferencesObject")
+        else:
+            cursor.execute("SELECT DISTINCT UID FROM ReferencesObject WHERE CommentID = ?", (comment_id,))
+        return bitmap(uid for (uid,) in cursor.fetchall())
+    return cached(("comment", comment_id), compute)
+
+def load_saved():
+    if not os.path.exists(selections_path):
+        return {}
+    with open(selections_path) as fp:
+        saved = json.load(fp)
+    return {name: int.from_bytes(zlib.decompress(base64.b64decode(data)), "little")
+            for name, data in saved.items()}
+
+def store_saved(saved):
+    # Bitmaps are mostly runs of zeros, so they compress well
+    encoded = {name: base64.b64encode(zlib.compress(bits.to_bytes((bits.bit_length()+7)//8, "little"))).decode("ascii")
+               for name, bits in saved.items()}
+    with open(selections_path, "w") as fp:
+        json.dump(encoded, fp, indent=1)
+
+def atom(token, current=0):
+    """
+    Return the bitmap for a single term of a selection expression.
+
+    :param token: One of
+                  - a sign or CG name, e.g. M288 or M056+M288: texts containing that sign
+                  - attribute=value, e.g. provenience=Susa: texts with that attribute value
+                  - comment:ID: texts linked to that comment; "commented" for texts linked to any comment
+                  - @name: a saved selection
+                  - "selection": the current selection
+                  - "all": every tablet
+    :param current: The current selection.
+    """
+    if token.lower() == "all":
+        return all_tablets()
+    if token.lower() == "selection":
+        return current
+    if token.lower() == "commented":
+        return by_comment()
+    if token.startswith("@"):
+        saved = load_saved()
+        if token[1:] not in saved:
+            raise ValueError(f"No saved selection called {token[1:]}")
+        return saved[token[1:]]
+    if token.lower().startswith("comment:"):
+        return by_comment(int(token[8:]))
+    if "=" in token:
+        attr, _, value = token.partition("=")
+        return by_attribute(attr, value)
+    if uid := is_uid(token):
+        return bitmap([uid])
+    if sign := is_sign(token):
+        return by_sign(sign)
+    raise ValueError(f"Don't know how to select '{token}'")
+
+def tokenize(expression):
+    lexer = shlex.shlex(expression, posix=True, punctuation_chars="()")
+    lexer.wordchars += "@:+|~,"
+    return list(lexer)
+
+def evaluate(expression, current=0):
+    """
+    Evaluate a selection expression.
+
+    Terms (see `atom`) are combined with "and", "or", "not" and
+    parentheses; "but" means the same as "and". "not" binds tightest,
+    then "and", then "or".
+
+    :param expression: e.g. "M288 and M056 but not M388"
+    :param current: The current selection.
+    :returns: A bitmap.
+    """
+    tokens = tokenize(expression)
+    pos = 0
+
+    def peek():
+        return tokens[pos].lower() if pos < len(tokens) else None
+
+    def take():
+        nonlocal pos
+        pos += 1
+        return tokens[pos-1]
+
+    def disjunction():
+        bits = conjunction()
+        while peek() == "or":
+            take()
+            bits |= conjunction()
+        return bits
+
+    def conjunction():
+        bits = negation()
+        while peek() in ["and", "but"]:
+            take()
+            bits &= negation()
+        return bits
+
+    def negation():
+        if peek() == "not":
+            take()
+            return all_tablets() & ~negation()
+        if peek() == "(":
+            take()
+            bits = disjunction()
+            if peek() != ")":
+                raise ValueError("Missing )")
+            take()
+            return bits
+        if peek() in [None, ")", "and", "but", "or"]:
+            raise ValueError(f"Incomplete selection: {expression}")
+        return atom(take(), current)
+
+    bits = disjunction()
+    if pos != len(tokens):
+        raise ValueError(f"Unexpected '{tokens[pos]}' in selection")
+    return bits
+
+def split_filter(line, current=0):
+    """
+    Split a trailing "in EXPRESSION" filter off a command.
+
+    :param line: e.g. "M288 in provenience=Susa and not M388". An " in "
+                 inside quotes (span_type="in total") is not a filter.
+    :returns: A tuple `(line, bits)`, where `bits` is the bitmap of the filter or None if there isn't one.
+    """
+    quote = None
+    for i, char in enumerate(line):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in "\"'":
+            quote = char
+        elif line.startswith(" in ", i):
+            return line[:i].strip(), evaluate(line[i+4:], current)
+    return line, None
+
+def show(bits, limit):
+    uids = list(tablets(bits))
+    print(f"{len(uids)} texts selected{':' if uids else '.'}")
+    if uids:
+        listing = ', '.join(uids[:limit]) + (f", ... ({len(uids)-limit} more)" if len(uids) > limit else '')
+        for line in textwrap.wrap(listing, initial_indent='  ', subsequent_indent='  '):
+            print(line)
+
+def do_select(clee, line):
+    """
+    Select the set of texts matching an expression. The selection can be
+    saved by name, and used to filter the texts listed by describe (for
+    a sign), grep, kwic, numerals and query by adding "in EXPRESSION" to
+    them.
+
+    Usage:
+    select expression
+    select save name
+    select drop name
+    select list
+    select
+
+    Expressions combine the following terms with and, or, not, but, and parentheses:
+    M288, M056+M288   texts containing a sign or CG
+    attribute=value   texts where some object has that attribute value
+    comment:3         texts linked to comment 3
+    commented         texts linked to any comment
+    @name             a saved selection
+    selection         the current selection
+    all               every text
+
+    Examples:
+    select M288 and M056 but not M388
+    -- selects the texts which contain M288 and M056 but not M388
+
+    select save m288-no-m388
+    -- saves the current selection under the name m288-no-m388
+
+    describe M157 in @m288-no-m388
+    -- lists the attestations of M157 in the saved selection
+
+    grep M157 in selection and provenience="Susa, mod. Shush"
+    -- steps through the texts in the current selection with the given provenience which contain M157
+
+    select
+    -- shows the current selection
+    """
+    action, _, rest = line.strip().partition(" ")
+    rest = rest.strip()
+    try:
+        if action == "":
+            show(clee.selection, clee.selection_limit)
+        elif action == "list" and not rest:
+            for name, bits in sorted(load_saved().items()):
+                print(f"@{name}: {size(bits)} texts")
+        elif action == "save" and rest and " " not in rest:
+            saved = load_saved()
+            saved[rest.lstrip("@")] = clee.selection
+            store_saved(saved)
+            print(f"Saved {size(clee.selection)} texts as @{rest.lstrip('@')}")
+        elif action == "drop" and rest and " " not in rest:
+            saved = load_saved()
+            if saved.pop(rest.lstrip("@"), None) is None:
+                raise ValueError(f"No saved selection called {rest}")
+            store_saved(saved)
+        else:
+            clee.selection = evaluate(line, clee.selection)
+            show(clee.selection, clee.selection_limit)
+    except ValueError as e:
+        print(e)
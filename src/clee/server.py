@@ -0,0 +1,429 @@
+"""
+A read-only JSON query server, so that several people and scripts can
+query the same corpus at once.
+
+Each request is handled on its own thread with a connection borrowed
+from a pool of read-only connections, which it also uses to look up
+signs (see `RequestSignlist`). The database is switched to WAL
+journaling, so readers never wait for each other or for the writer.
+All annotations go through a single writer thread, one at a time.
+Responses are cached until the database changes.
+
+The server only listens on localhost.
+
+Usage:
+python -m clee.server [--port n] [--pool n]
+
+Endpoints:
+GET  /describe?id=P008001        summary of a UID or sign, as in describe
+GET  /grep?sign=M288             texts containing a sign or CG, with counts
+GET  /comments?uid=P008001       comments linked to a UID (or ?sign=M288)
+GET  /statistics[?limit=n]       corpus size and most frequent signs
+POST /annotate                   {"action": "add|update|delete|rename",
+                                  "uid": ..., "attribute": ..., "value": ...}
+
+Example, from Python:
+>>> from clee.server import request
+>>> request("/describe?id=P008001")
+"""
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import queue
+import shlex
+import sqlite3
+import threading
+import traceback
+import urllib.parse
+import urllib.request
+
+from .cli_util import *
+from .journal import journaled
+
+host = "127.0.0.1"
+default_port = 8765
+
+class ConnectionPool:
+    """
+    A fixed set of read-only connections, lent out one per request.
+    """
+    def __init__(self, path, size):
+        self._connections = queue.Queue()
+        for _ in range(size):
+            self._connections.put(connect(path, read_only=True))
+
+    def borrow(self):
+        return self._connections.get()
+
+    def give_back(self, connection):
+        self._connections.put(connection)
+
+# Numbers the states of the database seen by the server, across every
+# ResponseCache, so that a generation never means two different states
+_generations = itertools.count(1)
+
+class ResponseCache:
+    """
+    Least-recently-used cache of response bodies, emptied whenever the
+    database changes. Each emptying starts a new generation; a body is
+    only stored if it was computed in the current one, so a request
+    which raced with a write can't put back what the write cleared.
+    """
+    def __init__(self, path, size=1024):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # PRAGMA data_version changes when any *other* connection
+        # commits, so a connection of our own is used to watch for writes
+        self._probe = connect(path, read_only=True)
+        self._version = None
+        self._generation = next(_generations)
+
+    def _check_version(self):
+        (version,) = self._probe.execute("PRAGMA data_version").fetchone()
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+            self._generation = next(_generations)
+
+    def generation(self):
+        """
+        Return the current generation, which changes whenever the database does.
+        """
+        with self._lock:
+            self._check_version()
+            return self._generation
+
+    def get(self, key):
+        with self._lock:
+            self._check_version()
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        return None
+
+    def put(self, key, body, generation):
+        """
+        :param generation: The generation the body was computed in (see `generation`).
+        """
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = body
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation = next(_generations)
+
+class RequestSignlist(SignlistIndex):
+    """
+    The signlist, for request threads, which can't use CLEE's own
+    connection. It is checked once per request, with the connection the
+    request borrowed and the cache's generation as its version (see
+    `Handler.do_GET`), rather than once per command.
+    """
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+
+    def check(self, version, cursor):
+        with self._lock:
+            return super().check(version, cursor)
+
+    def _load(self):
+        return self
+
+resolver = RequestSignlist()
+
+def comments(cursor, uid=None, sign_id=None):
+    if uid is not None:
+        # all comments on the same line/tablet, as in describe
+        cursor.execute("SELECT CommentID, Comment FROM Comment NATURAL JOIN ReferencesObject WHERE UID LIKE ?||'%'",
+                       (":".join(uid.split(":")[:2]),))
+    else:
+        cursor.execute("SELECT CommentID, Comment FROM Comment NATURAL JOIN ReferencesSign WHERE SignID = ?", (sign_id,))
+    results = []
+    for comment_id, comment in cursor.fetchall():
+        uids, signs = mentioned_entities(comment_id, cursor=cursor)
+        results.append({
+            "id": comment_id,
+            "comment": comment,
+            "uids": [u for (u,) in uids],
+            "signs": [s for (s,) in signs],
+        })
+    return results
+
+def describe_uid(cursor, uid):
+    from .kwic import tablet_tokens
+    tablet = uid.split(":")[0]
+    result = {
+        "uid": uid,
+        "type": get_type(uid),
+        "attributes": {attr: sorted(values) for attr, values in get_attrs(uid, cursor=cursor).items()},
+        "comments": comments(cursor, uid=uid),
+    }
+    lines = defaultdict(list)
+    for line, name in tablet_tokens(tablet, cursor=cursor):
+        lines[line].append(name)
+    cursor.execute("SELECT UID, SUBSTR(Attribute, 10), Value FROM ObjectAttributeValue WHERE UID LIKE ?||':%:num' AND Attribute LIKE 'disambig_%'", (tablet,))
+    values = defaultdict(dict)
+    for num, system, value in cursor.fetchall():
+        values[int(num.split(":")[1])][system] = float(value)
+    result["lines"] = [{"line": line, "signs": signs, "values": values.get(line, {})}
+                       for line, signs in sorted(lines.items())]
+    return result
+
+def describe_sign(cursor, sign):
+    sign = resolver.normalize(sign)
+    result = {"sign": sign}
+    if (sign_id := resolver.id(sign)) is not None:
+        result.update({
+            "sign_id": sign_id,
+            "base_name": resolver.base(sign),
+            "variants": [name for name in resolver.variants(sign) if name != sign],
+            "comments": comments(cursor, sign_id=sign_id),
+        })
+    texts = get_texts(sign, cursor=cursor, resolver=resolver)
+    if texts is None:
+        raise LookupError(f"{sign} is not in the signlist")
+    result["attestations"] = {uid: count for uid, count in sorted(texts, key=lambda x: x[1], reverse=True)}
+    result["total"] = sum(result["attestations"].values())
+    return result
+
+def normalize_uid(identifier):
+    """
+    Return the canonical form of a UID in any case: the text number is
+    upper case and the rest is lower case (P008001:1:sgn:0). Unlike
+    comparing with COLLATE NOCASE, this lets SQLite look the UID up in
+    the primary key of Object.
+    """
+    text, sep, rest = identifier.partition(":")
+    return text.upper() + sep + rest.lower()
+
+def describe(cursor, params):
+    identifier = params.get("id", "")
+    cursor.execute("SELECT UID FROM Object WHERE UID = ?", (normalize_uid(identifier),))
+    if row := cursor.fetchone():
+        return describe_uid(cursor, row[0])
+    if sign := is_sign(identifier):
+        return describe_sign(cursor, sign)
+    raise LookupError(f"Unknown identifier: '{identifier}'")
+
+def grep(cursor, params):
+    sign = is_sign(params.get("sign", ""))
+    if not sign:
+        raise ValueError("Expected ?sign=<sign name>")
+    sign = resolver.normalize(sign)
+    texts = get_texts(sign, cursor=cursor, resolver=resolver)
+    if texts is None:
+        raise LookupError(f"{sign} is not in the signlist")
+    return {"sign": sign, "texts": [{"uid": uid, "count": count} for uid, count in texts]}
+
+def comments_endpoint(cursor, params):
+    if "uid" in params:
+        return {"comments": comments(cursor, uid=params["uid"])}
+    if "sign" in params:
+        sign_id = resolver.id(params["sign"])
+        if sign_id is None:
+            raise LookupError(f"{params['sign']} is not in the signlist")
+        return {"comments": comments(cursor, sign_id=sign_id)}
+    raise ValueError("Expected ?uid=<uid> or ?sign=<sign name>")
+
+def statistics(cursor, params):
+    limit = int(params.get("limit", 20))
+    (texts,) = cursor.execute("SELECT COUNT(*) FROM Object WHERE UID NOT LIKE '%:%'").fetchone()
+    (tokens,) = cursor.execute("SELECT COUNT(*) FROM ObjectAttributeValue WHERE Attribute = 'SignID'").fetchone()
+    (comment_count,) = cursor.execute("SELECT COUNT(*) FROM Comment").fetchone()
+    cursor.execute("""
+    SELECT Signs.DahlName, COUNT(*) AS n
+    FROM ObjectAttributeValue JOIN Signs ON Signs.SignID = ObjectAttributeValue.Value
+    WHERE Attribute = 'SignID'
+    GROUP BY Signs.SignID ORDER BY n DESC LIMIT ?""", (limit,))
+    return {
+        "texts": texts,
+        "tokens": tokens,
+        "comments": comment_count,
+        "most_frequent_signs": [{"sign": name, "count": count} for name, count in cursor.fetchall()],
+    }
+
+def annotate(cursor, data):
+    """
+    Apply an annotation, as in the annotate command but without prompts:
+    adding an attribute which already exists is an error.
+    """
+    action, uid, attr = data.get("action"), data.get("uid"), data.get("attribute")
+    value = data.get("value", "")
+    if action not in ["add", "update", "delete", "rename"] or not uid or not attr:
+        raise ValueError('Expected {"action": "add|update|delete|rename", "uid": ..., "attribute": ..., "value": ...}')
+    if not cursor.execute("SELECT 1 FROM Object WHERE UID = ?", (uid,)).fetchone():
+        raise LookupError(f"No such UID: {uid}")
+    current = cursor.execute("SELECT Value FROM ObjectAttributeValue WHERE UID = ? AND Attribute = ?", (uid, attr)).fetchall()
+    if action == "add" and current:
+        raise ValueError(f"{uid} already has value {current[0][0]} for property {attr}")
+    if action in ["update", "rename"] and not current:
+        raise LookupError(f"{uid} has no property {attr}")
+
+    cells = [(uid, attr)] + ([(uid, value)] if action == "rename" else [])
+    with journaled(cursor, shlex.join(["annotate", action, uid, attr, value]), cells):
+        if action == "add":
+            cursor.execute("INSERT INTO ObjectAttributeValue VALUES (?, ?, ?)", (uid, attr, value))
+        elif action == "update":
+            cursor.execute("UPDATE ObjectAttributeValue SET Value = ? WHERE UID = ? AND Attribute = ?", (value, uid, attr))
+        elif action == "delete":
+            cursor.execute("DELETE FROM ObjectAttributeValue WHERE UID = ? AND Attribute = ? AND Value = ?", (uid, attr, value))
+        elif action == "rename":
+            cursor.execute("UPDATE ObjectAttributeValue SET Attribute = ? WHERE UID = ? AND Attribute = ?", (value, uid, attr))
+        changed = cursor.rowcount
+    return {"changed": changed}
+
+readers = {
+    "/describe": describe,
+    "/grep": grep,
+    "/comments": comments_endpoint,
+    "/statistics": statistics,
+}
+
+writers = {
+    "/annotate": annotate,
+}
+
+class Writer:
+    """
+    Runs every write on one thread with one connection, so writes are
+    applied one at a time in the order they arrive.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="clee-writer")
+        self._connection = None
+
+    def _run(self, handler, data):
+        if self._connection is None:
+            self._connection = connect(self._path)
+        with transaction(self._connection) as cursor:
+            return handler(cursor, data)
+
+    def submit(self, handler, data):
+        return self._executor.submit(self._run, handler, data).result()
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "CLEE"
+
+    def send_json(self, status, body):
+        encoded = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def handle_errors(self, action):
+        try:
+            action()
+        except LookupError as e:
+            # str() of a KeyError quotes its message
+            self.send_json(404, {"error": str(e.args[0]) if e.args else str(e)})
+        except (ValueError, json.JSONDecodeError) as e:
+            self.send_json(400, {"error": str(e)})
+        except sqlite3.Error as e:
+            self.send_json(503, {"error": str(e)})
+        except Exception as e:
+            # e.g. an object get_type doesn't know; answer rather than
+            # dropping the connection
+            self.log_error("%s", traceback.format_exc())
+            self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+    def do_GET(self):
+        def respond():
+            url = urllib.parse.urlsplit(self.path)
+            if url.path not in readers:
+                raise LookupError(f"No such endpoint: {url.path}")
+            params = dict(urllib.parse.parse_qsl(url.query))
+            key = (url.path, tuple(sorted(params.items())))
+            generation = self.server.cache.generation()
+            body = self.server.cache.get(key)
+            if body is None:
+                connection = self.server.pool.borrow()
+                try:
+                    cursor = connection.cursor()
+                    resolver.check(generation, cursor)
+                    body = json.dumps(readers[url.path](cursor, params)).encode("utf-8")
+                finally:
+                    self.server.pool.give_back(connection)
+                self.server.cache.put(key, body, generation)
+            self.send_json(200, body)
+        self.handle_errors(respond)
+
+    def do_POST(self):
+        def respond():
+            url = urllib.parse.urlsplit(self.path)
+            if url.path not in writers:
+                raise LookupError(f"No such endpoint: {url.path}")
+            length = int(self.headers.get("Content-Length", 0))
+            data = json.loads(self.rfile.read(length) or b"{}")
+            result = self.server.writer.submit(writers[url.path], data)
+            self.server.cache.clear()
+            self.send_json(200, result)
+        self.handle_errors(respond)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+def make_server(port=default_port, pool_size=4, path=None, verbose=False):
+    """
+    Create (but don't start) a server for the database at path.
+    """
+    path = path or db_path
+    # Switch to WAL so that readers don't block each other or the writer;
+    # this is a property of the database file, so it only needs doing once.
+    connect(path).close()
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.pool = ConnectionPool(path, pool_size)
+    server.cache = ResponseCache(path)
+    server.writer = Writer(path)
+    server.verbose = verbose
+    return server
+
+def request(path, data=None, port=default_port):
+    """
+    Query a running server. Sends a POST with data as JSON if data is
+    given, and a GET otherwise.
+
+    :param path: e.g. "/describe?id=P008001"
+    :returns: The decoded JSON response. Error responses raise urllib.error.HTTPError.
+    """
+    body = None if data is None else json.dumps(data).encode("utf-8")
+    req = urllib.request.Request(f"http://{host}:{port}{path}", data=body,
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req) as response:
+        return json.loads(response.read())
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="python -m clee.server",
+        description="Serve read-only JSON queries of the CLEE database on localhost.")
+    parser.add_argument('--port', type=int, default=default_port)
+    parser.add_argument('--pool', type=int, default=4, help='number of read-only connections')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args(argv)
+
+    server = make_server(args.port, args.pool, verbose=args.verbose)
+    print(f"Serving {db_path} on http://{host}:{args.port}/ (Ctrl-C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
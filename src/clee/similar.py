@@ -0,0 +1,288 @@
+"""
+The similar command: find parallel and duplicate texts.
+
+Each text is reduced to its set of shingles (runs of `shingle_size`
+consecutive signs), and each set to a MinHash signature of
+`num_perm` values, so that the fraction of positions on which two
+signatures agree estimates the Jaccard similarity of the two texts.
+Banding the signatures (locality-sensitive hashing) gives the
+candidate pairs for the near-duplicate report without comparing every
+pair of texts.
+
+Signatures are saved to ~/.clee/similar.npz along with a digest of each
+text's sign sequence and the version of the database they describe.
+When the database changes, the change journal says which texts had
+tokens renamed since, and only their sign sequences are read again
+(and only those which actually changed are re-hashed). The whole
+corpus is only read again after ATF has been ingested.
+"""
+from collections import defaultdict
+import os
+import shlex
+import zlib
+
+import numpy as np
+
+from .cli_util import *
+
+index_path = os.path.join(clee_dir, 'similar.npz')
+
+shingle_size = 2
+num_perm = 128
+bands = 32  # num_perm/bands rows per band
+
+prime = (1 << 31) - 1
+_rng = np.random.default_rng(20230)
+_a = _rng.integers(1, prime, num_perm, dtype=np.uint64)
+_b = _rng.integers(0, prime, num_perm, dtype=np.uint64)
+
+def sign_sequences(tablets=None):
+    """
+    Return a dict mapping each tablet to its sequence of signs, in
+    reading order, with the parts of each CG joined by '+'. The tokens
+    are read from the snapshot if it is up to date. Signs which aren't
+    in the signlist (SignID -1, see clee.ingest) are left out, so that
+    unknown signs don't make texts look alike.
+
+    :param tablets: The tablets to read, or None for the whole corpus.
+                    Tablets without signs are left out of the result.
+    """
+    from .snapshot import current
+    if tablets is not None:
+        rows = []
+        for tablet in tablets:
+            # The range lets SQLite use the index on ObjectAttributeValue(UID, Attribute)
+            cursor.execute("SELECT UID, Value FROM ObjectAttributeValue WHERE UID >= ?1 AND UID < ?1||char(1114111) "
+                           "AND Attribute = 'SignID' AND UID LIKE ?1||':%:sgn:%'", (tablet,))
+            rows += cursor.fetchall()
+    elif (snapshot := current()) is not None:
+        # no_sign_id (no SignID at all) is negative too
+        keep = np.asarray(snapshot["tokens.sign_id"]) >= 0
+        columns = [np.asarray(snapshot[f"tokens.{name}"])[keep] for name in ["tablet", "line", "position", "part", "sign_id"]]
+        sequences = {}
+        previous = None
+        for tablet, line, position, part, sign_id in zip(*(column.tolist() for column in columns)):
+            sequence = sequences.setdefault(f"P{tablet:06}", [])
+            if part > 0 and previous == (tablet, line, position):
+                sequence[-1] += "+" + str(sign_id)
+            else:
+                sequence.append(str(sign_id))
+            previous = (tablet, line, position)
+        return sequences
+    else:
+        cursor.execute("SELECT UID, Value FROM ObjectAttributeValue WHERE Attribute = 'SignID' AND UID LIKE '%:sgn:%'")
+        rows = cursor.fetchall()
+    tokens = defaultdict(list)
+    for uid, sign_id in rows:
+        # as the snapshot reads them (see snapshot.build_columns)
+        try:
+            sign_id = int(sign_id)
+        except (TypeError, ValueError):
+            continue
+        if sign_id >= 0:
+            tokens[uid[:7]].append((token_key(uid), str(sign_id)))
+    sequences = {}
+    for tablet, signs in tokens.items():
+        sequence = []
+        previous = None
+        for key, sign_id in sorted(signs):
+            if len(key) > 2 and previous == key[:2]:
+                sequence[-1] += "+" + sign_id
+            else:
+                sequence.append(sign_id)
+            previous = key[:2]
+        sequences[tablet] = sequence
+    return sequences
+
+def digest(sequence):
+    return zlib.crc32(" ".join(sequence).encode("ascii"))
+
+def signature(sequence):
+    """
+    Return the MinHash signature of a sign sequence.
+    """
+    n = max(1, len(sequence) - shingle_size + 1)
+    shingles = np.array([zlib.crc32(" ".join(sequence[i:i+shingle_size]).encode("ascii")) % prime
+                         for i in range(n)], dtype=np.uint64)
+    return ((_a[:, None] * shingles[None, :] + _b[:, None]) % prime).min(axis=1).astype(np.uint32)
+
+class MinHashIndex:
+    def __init__(self, uids, digests, signatures, version=None):
+        self.uids = list(uids)
+        self.position = {uid: i for i, uid in enumerate(self.uids)}
+        self.digests = np.asarray(digests, dtype=np.uint32)
+        self.signatures = np.asarray(signatures, dtype=np.uint32).reshape(-1, num_perm)
+        # The database_version the signatures describe
+        self.version = version
+        self._buckets = None
+
+    @classmethod
+    def load(cls, path=index_path):
+        if not os.path.exists(path):
+            return cls([], [], np.zeros((0, num_perm)))
+        data = np.load(path)
+        if data["signatures"].shape[1] != num_perm or int(data["shingle_size"]) != shingle_size:
+            return cls([], [], np.zeros((0, num_perm)))
+        version = str(data["version"]) if "version" in data else None
+        return cls(data["uids"].tolist(), data["digests"], data["signatures"], version or None)
+
+    def save(self, path=index_path):
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, uids=np.array(self.uids, dtype=str), digests=self.digests,
+                 signatures=self.signatures, shingle_size=shingle_size, version=self.version or "")
+        os.replace(tmp_path, path)
+
+    def update(self, sequences, tablets=None):
+        """
+        Bring the index up to date with the given sign sequences, only
+        re-hashing texts whose sequence has changed.
+
+        :param tablets: The tablets which sequences was read for (see
+                        `sign_sequences`), or None if it covers the corpus.
+                        Other texts are kept as they are.
+        :returns: The number of texts which were (re-)hashed or removed.
+        """
+        digests = {uid: digest(sequence) for uid, sequence in sequences.items()}
+        changed = [uid for uid in digests
+                   if uid not in self.position or self.digests[self.position[uid]] != digests[uid]]
+        removed = [uid for uid in self.uids if uid not in digests and (tablets is None or uid in tablets)]
+        if not changed and not removed:
+            return 0
+        changed_or_removed = set(changed) | set(removed)
+        keep = [i for i, uid in enumerate(self.uids) if uid not in changed_or_removed]
+        uids = [self.uids[i] for i in keep] + changed
+        signatures = np.concatenate([self.signatures[keep]] +
+                                    [signature(sequences[uid])[None, :] for uid in changed])
+        self.__init__(uids, [int(self.digests[i]) for i in keep] + [digests[uid] for uid in changed],
+                      signatures, self.version)
+        return len(changed) + len(removed)
+
+    def buckets(self):
+        """
+        Return, for each band, a dict mapping band values to the texts which share them.
+        """
+        if self._buckets is None:
+            rows = num_perm // bands
+            self._buckets = []
+            for band in range(bands):
+                table = defaultdict(list)
+                chunk = np.ascontiguousarray(self.signatures[:, band*rows:(band+1)*rows])
+                for i, key in enumerate(chunk):
+                    table[key.tobytes()].append(i)
+                self._buckets.append(table)
+        return self._buckets
+
+    def most_similar(self, uid, k=10):
+        """
+        Return the k texts most similar to uid, as `(uid, jaccard_estimate)` pairs.
+        """
+        i = self.position[uid]
+        estimates = (self.signatures == self.signatures[i]).mean(axis=1)
+        estimates[i] = -1
+        top = np.argsort(-estimates, kind="stable")[:k]
+        return [(self.uids[j], float(estimates[j])) for j in top if estimates[j] > 0]
+
+    def pairs(self, threshold=0.8):
+        """
+        Return the pairs of texts whose estimated similarity is at least
+        threshold, most similar first. Only pairs which share a band are
+        compared.
+        """
+        candidates = set()
+        for table in self.buckets():
+            for members in table.values():
+                for x in range(len(members)):
+                    for y in range(x+1, len(members)):
+                        candidates.add((members[x], members[y]))
+        results = []
+        for x, y in candidates:
+            estimate = float((self.signatures[x] == self.signatures[y]).mean())
+            if estimate >= threshold:
+                results.append((self.uids[x], self.uids[y], estimate))
+        return sorted(results, key=lambda r: (-r[2], r[0], r[1]))
+
+_index = None
+_index_version = None
+
+def changed_tablets(changes):
+    """
+    Return the tablets whose sign sequence may have been changed by
+    journaled changes (see `journal.changes_since`).
+    """
+    return set(a["uid"].split(":")[0] for change in changes
+               for a in change.get("attributes", []) if a["attribute"] == "SignID")
+
+def get_index():
+    """
+    Return the MinHash index, updating it (and the copy on disk) if the
+    database has changed since it was last used.
+    """
+    global _index, _index_version
+    from .journal import changes_since
+    version = db_version()
+    if _index is None:
+        _index = MinHashIndex.load()
+    if _index_version != version:
+        current = database_version()
+        if _index.version != current:
+            changes = changes_since(_index.version)
+            tablets = None if changes is None else changed_tablets(changes)
+            _index.update(sign_sequences(tablets), tablets)
+            _index.version = current
+            _index.save()
+        _index_version = version
+    return _index
+
+def do_similar(clee, line):
+    """
+    Find the texts most similar to a given text, or list pairs of
+    near-duplicate texts across the corpus. Similarity is the Jaccard
+    similarity of the texts' sets of two-sign sequences, estimated
+    with MinHash.
+
+    Usage:
+    similar uid [-k n]
+    similar --pairs [--threshold t]
+
+    Examples:
+    similar P008001
+    -- lists the 10 texts most similar to P008001
+
+    similar P008001 -k 25
+    -- lists the 25 texts most similar to P008001
+
+    similar --pairs --threshold 0.9
+    -- lists every pair of texts with an estimated similarity of at least 0.9
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="similar", exit_on_error=False)
+    parser.add_argument('uid', nargs='?')
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--pairs', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.8)
+    try:
+        args = parser.parse_args(shlex.split(line))
+        if not args.pairs and not args.uid:
+            raise ValueError("Usage: similar uid [-k n] | similar --pairs [--threshold t]")
+        index = get_index()
+
+        if args.pairs:
+            pairs = index.pairs(args.threshold)
+            draw_header("near duplicates")
+            print(f"{len(pairs)} pairs of texts have an estimated similarity of at least {args.threshold}:")
+            for left, right, estimate in pairs:
+                print(f"  {left}  {right}  {estimate:.2f}")
+        else:
+            uid = is_uid(args.uid)
+            if not uid or ":" in uid:
+                raise ValueError(f"Unknown text: {args.uid}")
+            if uid not in index.position:
+                raise ValueError(f"{uid} has no signs to compare")
+            draw_header("similar texts")
+            print(f"Texts most similar to {uid} (estimated Jaccard similarity):")
+            for other, estimate in index.most_similar(uid, args.k):
+                print(f"  {other}  {estimate:.2f}")
+    except (ValueError, argparse.ArgumentError) as e:
+        print(e)
+    except SystemExit:
+        pass
@@ -0,0 +1,274 @@
+"""
+Columnar snapshots of the corpus, for analysis.
+
+A snapshot is a directory of NumPy .npy files, one per column, which
+can be memory-mapped: loading one reads no data until it is used, so
+it takes milliseconds however large the corpus is. Strings which
+repeat (sign names, attribute names and values) are dictionary
+encoded: the column holds integer codes into a separate array of
+distinct strings.
+
+Columns:
+  tokens.*        one row per sign (each part of a CG is a sign), in reading order
+    tablet        tablet number (8001 for P008001)
+    line          line number
+    position      position of the token in the line
+    part          position in its CG, or -1
+    sign          code into sign_names (the token's DahlName)
+    sign_id       SignID, or no_sign_id if there is none
+    quantity      quantity of a counted sign, or NaN
+    numeral       True if the token is part of a numeral span
+  spans.*         one row per :1sg, :ent, :txt and :num object
+    uid, kind (code into span_kinds), tablet, line, parent (row of the parent span, or -1)
+  attributes.*    every attribute except the hierarchy ('child') and token data
+    object, attribute, value: codes into objects, attribute_names and values
+  numerals.*      the arrays of clee.numerals.Numerals
+
+meta.json records the version of the database the snapshot was built
+from (see `database_version`), so a stale snapshot can be detected.
+
+Usage, from Python:
+>>> from clee.snapshot import load
+>>> snapshot = load()
+>>> snapshot["tokens.sign"]
+"""
+from collections.abc import Mapping
+import json
+import os
+import shlex
+import shutil
+import time
+
+import numpy as np
+
+from .cli_util import *
+
+snapshot_path = os.path.join(clee_dir, 'snapshot')
+
+# 2: tokens.part was -1 for every token in format 1
+snapshot_format = 2
+no_sign_id = np.iinfo(np.int32).min
+span_kinds = ["1sg", "ent", "txt", "num"]
+
+class StaleSnapshot(Exception):
+    pass
+
+def encode(strings):
+    """
+    Dictionary-encode a sequence of strings.
+
+    :returns: A tuple `(codes, dictionary)`.
+    """
+    dictionary, codes = np.unique(np.array(list(strings), dtype=str), return_inverse=True)
+    return codes.astype(np.int32).reshape(-1), dictionary
+
+def build_columns(cursor=cursor):
+    """
+    Read the corpus into a dict of column name to array.
+    """
+    columns = {}
+
+    # Tokens
+    cursor.execute("SELECT UID, Attribute, Value FROM ObjectAttributeValue WHERE UID LIKE '%:sgn:%' AND Attribute IN ('DahlName', 'SignID', 'quantity')")
+    tokens = {}
+    for uid, attr, value in cursor.fetchall():
+        tokens.setdefault(uid, {})[attr] = value
+    cursor.execute("SELECT Value FROM ObjectAttributeValue WHERE Attribute = 'child' AND UID LIKE '%:num'")
+    numeral_tokens = set(uid for (uid,) in cursor.fetchall())
+    signlist = dict(cursor.execute("SELECT SignID, DahlName FROM Signlist"))
+    rows = sorted((int(uid[1:7]), *token_key(uid), uid) for uid in tokens
+                  if "DahlName" in tokens[uid] or "SignID" in tokens[uid])
+    def quantity(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return np.nan
+    def sign_id(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return no_sign_id
+    columns["tokens.tablet"] = np.array([r[0] for r in rows], dtype=np.int32)
+    columns["tokens.line"] = np.array([r[1] for r in rows], dtype=np.int32)
+    columns["tokens.position"] = np.array([r[2] for r in rows], dtype=np.int32)
+    columns["tokens.part"] = np.array([r[3] if len(r) == 5 else -1 for r in rows], dtype=np.int16)
+    columns["tokens.sign_id"] = np.array([sign_id(tokens[r[-1]].get("SignID")) for r in rows], dtype=np.int32)
+    names = [signlist.get(sign_id) or tokens[r[-1]].get("DahlName") or ""
+             for r, sign_id in zip(rows, columns["tokens.sign_id"])]
+    columns["tokens.sign"], columns["sign_names"] = encode(names)
+    columns["tokens.quantity"] = np.array([quantity(tokens[r[-1]].get("quantity")) for r in rows], dtype=np.float64)
+    columns["tokens.numeral"] = np.array([":".join(r[-1].split(":")[:4]) in numeral_tokens for r in rows], dtype=bool)
+
+    # Spans
+    cursor.execute("SELECT UID FROM Object WHERE UID LIKE '%:1sg' OR UID LIKE '%:ent' OR UID LIKE '%:txt' OR UID LIKE '%:num'")
+    spans = sorted(uid for (uid,) in cursor.fetchall())
+    position = {uid: i for i, uid in enumerate(spans)}
+    cursor.execute("SELECT UID, Value FROM ObjectAttributeValue WHERE Attribute = 'child' AND UID LIKE 'P%:%' AND Value NOT LIKE '%:sgn:%'")
+    parents = {child: position[parent] for parent, child in cursor.fetchall() if parent in position}
+    columns["spans.uid"] = np.array(spans, dtype=str)
+    columns["spans.kind"] = np.array([span_kinds.index(uid.rsplit(":", 1)[1]) for uid in spans], dtype=np.int8)
+    columns["spans.tablet"] = np.array([int(uid[1:7]) for uid in spans], dtype=np.int32)
+    columns["spans.line"] = np.array([int(uid.split(":")[1]) for uid in spans], dtype=np.int32)
+    columns["spans.parent"] = np.array([parents.get(uid, -1) for uid in spans], dtype=np.int32)
+    columns["span_kinds"] = np.array(span_kinds, dtype=str)
+
+    # Other attributes
+    cursor.execute("SELECT UID, Attribute, Value FROM ObjectAttributeValue WHERE Attribute NOT IN ('child', 'DahlName', 'SignID', 'quantity') ORDER BY UID, Attribute")
+    attributes = cursor.fetchall()
+    columns["attributes.object"], columns["objects"] = encode(uid for uid, _, _ in attributes)
+    columns["attributes.attribute"], columns["attribute_names"] = encode(attr for _, attr, _ in attributes)
+    columns["attributes.value"], columns["values"] = encode(str(value) for _, _, value in attributes)
+
+    # Numerals
+    from .numerals import Numerals
+    numerals = Numerals()
+    columns["numerals.uids"] = np.array(numerals.uids, dtype=str)
+    columns["numerals.entries"] = np.array([entry or "" for entry in numerals.entries], dtype=str)
+    columns["numerals.lines"] = numerals.lines
+    columns["numerals.totals"] = numerals.totals
+    columns["numerals.numeral"] = numerals.numeral
+    columns["numerals.tablet"] = numerals.tablet
+    columns["numerals.system"] = numerals.system
+    columns["numerals.value"] = numerals.value
+    columns["numerals.systems"] = np.array(numerals.systems, dtype=str)
+    return columns
+
+def build(path=snapshot_path, cursor=cursor):
+    """
+    Write a snapshot of the database to path, replacing any snapshot there.
+
+    :returns: The snapshot's metadata.
+    """
+    start = time.perf_counter()
+    version = database_version(cursor)
+    columns = build_columns(cursor)
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, column in columns.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), column)
+    meta = {
+        "format": snapshot_format,
+        "database_version": version,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "seconds": round(time.perf_counter() - start, 3),
+        "rows": {name: len(column) for name, column in columns.items()},
+    }
+    with open(os.path.join(tmp_path, "meta.json"), "w") as fp:
+        json.dump(meta, fp, indent=1)
+    old_path = path + ".old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return meta
+
+class Snapshot(Mapping):
+    """
+    Read-only mapping from column name to a memory-mapped array.
+    """
+    def __init__(self, path=snapshot_path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as fp:
+            self.meta = json.load(fp)
+        if self.meta.get("format") != snapshot_format:
+            raise StaleSnapshot(f"{path} was written by a different version of CLEE")
+        self._columns = {}
+
+    def __getitem__(self, name):
+        if name not in self._columns:
+            if name not in self.meta["rows"]:
+                raise KeyError(name)
+            self._columns[name] = np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+        return self._columns[name]
+
+    def __iter__(self):
+        return iter(self.meta["rows"])
+
+    def __len__(self):
+        return len(self.meta["rows"])
+
+    def is_current(self, cursor=cursor):
+        return self.meta["database_version"] == database_version(cursor)
+
+def load(path=snapshot_path, check=True, cursor=cursor):
+    """
+    Open a snapshot.
+
+    :param check: Raise StaleSnapshot if the database has changed since the snapshot was built.
+    """
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        raise StaleSnapshot(f"There is no snapshot at {path}")
+    snapshot = Snapshot(path)
+    if check and not snapshot.is_current(cursor):
+        raise StaleSnapshot(f"The snapshot at {path} is out of date; rebuild it with \"snapshot build\"")
+    return snapshot
+
+_current = None
+_current_version = None
+
+def current():
+    """
+    Return the snapshot if there is one and it is up to date, else None.
+    Used by commands which can read the snapshot instead of the database.
+    """
+    global _current, _current_version
+    try:
+        built = os.stat(os.path.join(snapshot_path, "meta.json")).st_mtime_ns
+    except OSError:
+        built = None
+    version = (db_version(), built)
+    if _current_version != version:
+        try:
+            _current = load()
+        except (StaleSnapshot, OSError, ValueError):
+            _current = None
+        _current_version = version
+    return _current
+
+def do_snapshot(clee, line):
+    """
+    Build a columnar snapshot of the corpus in ~/.clee/snapshot, for
+    analysis scripts and for commands which can read it instead of
+    the database (numerals, similar). It can be loaded in milliseconds
+    with clee.snapshot.load(). A snapshot which is out of date is
+    ignored until it is rebuilt.
+
+    Usage:
+    snapshot build
+    snapshot status
+
+    Examples:
+    snapshot build
+    -- writes the token, span, attribute and numeral columns to ~/.clee/snapshot
+
+    snapshot status
+    -- says when the snapshot was built and whether the database has changed since
+    """
+    args = shlex.split(line)
+    try:
+        if args == ["build"]:
+            meta = build()
+            print(f"Built a snapshot of {meta['rows']['tokens.sign']} tokens, {meta['rows']['spans.uid']} spans "
+                  f"and {meta['rows']['attributes.value']} attributes in {meta['seconds']:.1f}s")
+        elif args in [["status"], []]:
+            snapshot = load(check=False)
+            state = "up to date" if snapshot.is_current() else 'out of date (run "snapshot build")'
+            print(f"Snapshot built {snapshot.meta['created']} in {snapshot.path}: {state}")
+        else:
+            print("Usage: snapshot (build|status)")
+    except (StaleSnapshot, OSError) as e:
+        print(e)
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m clee.snapshot",
+                                     description="Build a columnar snapshot of the database.")
+    parser.add_argument("path", nargs="?", default=snapshot_path)
+    args = parser.parse_args(argv)
+    meta = build(args.path)
+    print(f"Wrote {len(meta['rows'])} columns to {args.path} in {meta['seconds']:.1f}s")
+
+if __name__ == "__main__":
+    main()
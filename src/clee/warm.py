@@ -0,0 +1,166 @@
+"""
+Warms CLEE's caches in the background while the prompt waits for input.
+
+As soon as the prompt appears, a small pool of low-priority threads
+reads the database file (so that it is in the operating system's page
+cache), loads the signlist, the UID index and the table of sign
+frequencies used by describe, and lays out the tablets which were
+described most often according to ~/.clee/history. The results are
+handed over through `cli_util.warmed`.
+
+Each thread has its own read-only connection, so warming never holds
+a lock that a command would wait for. It stops as soon as the first
+command is entered: running queries are interrupted and queued work
+is dropped, so the command has the database (and the interpreter) to
+itself.
+"""
+from collections import Counter
+import os
+import queue
+import threading
+
+from .cli_util import *
+
+workers = 2
+# How many of the most described tablets to lay out in advance
+tablets = 20
+# Size of the reads which bring the database file into the page cache
+chunk_size = 1 << 20
+
+class Warmer:
+    """
+    A pool of daemon threads which run warming tasks until there are
+    none left or they are stopped. (concurrent.futures is not used
+    because importing it would delay the prompt.)
+    """
+    def __init__(self, workers=workers):
+        self.stopped = threading.Event()
+        self.connections = []
+        self.tasks = queue.SimpleQueue()
+        self.threads = [threading.Thread(target=self._work, name=f"clee-warm-{i}", daemon=True)
+                        for i in range(workers)]
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._base = None
+
+    def start(self):
+        self.tasks.put((read_files, self))
+        self.tasks.put((warm_caches, self))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop warming straight away. Safe to call more than once.
+        """
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        with self._lock:
+            for connection in self.connections:
+                connection.interrupt()
+
+    def cursor(self):
+        """
+        Return this thread's cursor, opening its connection the first time.
+        """
+        if not hasattr(self._local, "connection"):
+            connection = connect(db_path, read_only=True)
+            with self._lock:
+                self.connections.append(connection)
+            self._local.connection = connection
+        return self._local.connection.cursor()
+
+    def base(self):
+        """
+        Return the version the results are valid for (see `Warmed.put`):
+        the data_version of a connection of the warmer's own, taken the
+        first time a task asks, before it reads anything. CLEE's own
+        connection isn't used, so warming doesn't open it before the
+        prompt appears; the probe is left open for Warmed to check.
+        """
+        with self._lock:
+            if self._base is None:
+                probe = connect(db_path, read_only=True)
+                (version,) = probe.execute("PRAGMA data_version").fetchone()
+                self._base = (probe, version)
+        return self._base
+
+    def _work(self):
+        try:
+            # On Linux, this lowers the priority of the calling thread only
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+        except (AttributeError, OSError):
+            pass
+        while not self.stopped.is_set():
+            try:
+                task, *args = self.tasks.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                task(*args)
+            except (sqlite3.Error, OSError, KeyError, ValueError):
+                # Interrupted, or the database isn't usable yet; whatever
+                # wasn't warmed is loaded when it is needed, as usual.
+                pass
+        if hasattr(self._local, "connection"):
+            with self._lock:
+                self.connections.remove(self._local.connection)
+            self._local.connection.close()
+
+def read_files(warmer):
+    """
+    Read the database and its write-ahead log, so that the operating
+    system keeps them in memory. (SQLite's own page cache belongs to a
+    connection, so it can't be filled from another thread.)
+    """
+    for path in [db_path, db_path + "-wal"]:
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb", buffering=0) as fp:
+            while not warmer.stopped.is_set() and fp.read(chunk_size):
+                pass
+
+def described_tablets(limit=tablets):
+    """
+    Return the tablets described most often in the command history,
+    most frequent first.
+    """
+    counts = Counter()
+    if not os.path.exists(histfile):
+        return []
+    with open(histfile, errors="replace") as fp:
+        for line in fp:
+            words = line.split()
+            if len(words) == 2 and words[0] in ["describe", "desc", "atf"] and words[1][:1] in "Pp":
+                counts[words[1].split(":")[0].upper()] += 1
+    return [uid for uid, _ in counts.most_common(limit)]
+
+def warm_caches(warmer):
+    base = warmer.base()
+    cursor = warmer.cursor()
+    version = database_version(cursor)
+    results = {}
+    for key, read in [("signlist", SignlistIndex.read),
+                      ("uids", UIDIndex.read),
+                      ("sign_texts", get_sign_texts)]:
+        if warmer.stopped.is_set():
+            return
+        results[key] = read(cursor)
+        warmed.put(key, results[key], version, base)
+    for uid in described_tablets():
+        if warmer.stopped.is_set():
+            return
+        if uid := results["uids"].get(uid):
+            try:
+                warmed.put(("tablet", uid, None), layout_tablet(uid, cursor=cursor), version, base)
+            except ValueError:
+                # a tablet without any lines
+                pass
+
+def start():
+    """
+    Start warming, and return the Warmer so that it can be stopped.
+    """
+    return Warmer().start()
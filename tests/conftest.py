@@ -0,0 +1,108 @@
+"""
+Builds a small synthetic corpus for the tests. CLEE finds its database
+and other files under ~/.clee when clee.cli_util is imported, so HOME
+is pointed at a temporary directory before any test imports clee.
+"""
+import atexit
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import pytest
+
+home = tempfile.mkdtemp(prefix="clee-test-")
+atexit.register(shutil.rmtree, home, ignore_errors=True)
+os.environ["HOME"] = home
+os.environ.pop("CLEE_DB", None)
+
+signs = ["M056", "M288", "M388", "M157", "M157~A", "N01", "N14", "M004", "M004~B"]
+
+# Each entry is (signs, [(quantity, numeral sign), ...]); M056+M288 is a
+# CG, and X isn't in the signlist, so it gets SignID -1 (see clee.ingest)
+tablets = {
+    "P008001": [(["M288", "M056"], [(3, "N01")]),
+                (["M157", "M056+M288"], [(2, "N14"), (1, "N01")]),
+                (["M388"], [(5, "N01")])],
+    "P008002": [(["M288", "M056"], [(4, "N01")]),
+                (["M157~A", "X"], [(1, "N14")])],
+    "P008003": [(["M004~B", "M288"], [(2, "N01")]),
+                (["M388+X", "M056"], [(7, "N01")]),
+                (["M288", "M056"], [(9, "N01")])],
+}
+
+def build_corpus(path):
+    """
+    Write the synthetic corpus to a new database at path.
+    """
+    connection = sqlite3.connect(path)
+    cursor = connection.cursor()
+    cursor.executescript("""
+    CREATE TABLE Object(UID TEXT PRIMARY KEY);
+    CREATE TABLE ObjectAttributeValue(UID TEXT, Attribute TEXT, Value);
+    CREATE TABLE Signlist(SignID INTEGER PRIMARY KEY, DahlName TEXT, BaseName TEXT);
+    CREATE VIEW Signs AS SELECT SignID, DahlName FROM Signlist;
+    CREATE TABLE Comment(CommentID INTEGER PRIMARY KEY, Comment TEXT);
+    CREATE TABLE ReferencesObject(CommentID INTEGER, UID TEXT);
+    CREATE TABLE ReferencesSign(CommentID INTEGER, SignID INTEGER);
+    """)
+    ids = {}
+    for sign_id, name in enumerate(signs, 1):
+        cursor.execute("INSERT INTO Signlist VALUES (?, ?, ?)", (sign_id, name, name.split("~")[0]))
+        ids[name] = sign_id
+    objects, values = [], []
+    for tablet, entries in tablets.items():
+        segment = f"{tablet}:1:1sg"
+        objects += [tablet, segment]
+        values += [(tablet, "publication", f"MDP 06, {tablet[-3:]}"), (tablet, "child", segment)]
+        for n, (text, numerals) in enumerate(entries, 1):
+            entry, txt, num = f"{tablet}:{n}:ent", f"{tablet}:{n}:txt", f"{tablet}:{n}:num"
+            objects += [entry, txt, num]
+            values += [(segment if n == 1 else tablet, "child", entry), (entry, "child", txt), (entry, "child", num)]
+            if n == 1:
+                values.append((entry, "span_type", "HEADER"))
+            position = 0
+            for name in text:
+                uid = f"{tablet}:{n}:sgn:{position}"
+                objects.append(uid)
+                values.append((txt, "child", uid))
+                if "+" in name:
+                    for i, part in enumerate(name.split("+")):
+                        objects.append(f"{uid}:{i}")
+                        values += [(uid, "child", f"{uid}:{i}"), (f"{uid}:{i}", "DahlName", part), (f"{uid}:{i}", "SignID", ids.get(part, -1))]
+                else:
+                    values += [(uid, "DahlName", name), (uid, "SignID", ids.get(name, -1))]
+                position += 1
+            total = 0
+            for quantity, name in numerals:
+                uid = f"{tablet}:{n}:sgn:{position}"
+                objects.append(uid)
+                values += [(num, "child", uid), (uid, "DahlName", name), (uid, "SignID", ids[name]), (uid, "quantity", quantity)]
+                total += quantity * (10 if name == "N14" else 1)
+                position += 1
+            values += [(num, "disambig_decimal", total), (num, "disambig_sexagesimal", total * 1.5)]
+    cursor.executemany("INSERT INTO Object VALUES (?)", [(uid,) for uid in objects])
+    cursor.executemany("INSERT INTO ObjectAttributeValue VALUES (?, ?, ?)", values)
+    cursor.execute("INSERT INTO Comment VALUES (1, 'M288 header in P008001')")
+    cursor.execute("INSERT INTO ReferencesObject VALUES (1, 'P008001')")
+    cursor.execute("INSERT INTO ReferencesSign VALUES (1, 2)")
+    connection.commit()
+    connection.close()
+
+clee_dir = os.path.join(home, ".clee")
+os.makedirs(clee_dir)
+build_corpus(os.path.join(clee_dir, "grist.db"))
+# CLEE logs each statement with the command which ran it
+with open(os.path.join(clee_dir, "history"), "w") as fp:
+    fp.write("pytest\n")
+
+@pytest.fixture
+def corpus(tmp_path):
+    """
+    A cursor on a fresh copy of the corpus, for tests which write to it.
+    """
+    path = str(tmp_path / "grist.db")
+    build_corpus(path)
+    connection = sqlite3.connect(path, isolation_level=None)
+    yield connection.cursor()
+    connection.close()
@@ -0,0 +1,63 @@
+import pytest
+
+from clee import journal
+
+def values(cursor, uid, attribute):
+    return journal.attribute_values(cursor, [(uid, attribute)])[0]
+
+def test_journaled_records_changes(corpus):
+    version = journal.database_version(corpus)
+    cells = [("P008001:1:ent", "span_type")]
+    with journal.journaled(corpus, "annotate", cells):
+        corpus.execute("UPDATE ObjectAttributeValue SET Value = 'TOTAL' WHERE UID = 'P008001:1:ent' AND Attribute = 'span_type'")
+    # nothing changed, so nothing is recorded
+    with journal.journaled(corpus, "annotate", cells):
+        pass
+    assert journal.changes_since(version, corpus) == [{
+        "command": "annotate",
+        "attributes": [{"uid": "P008001:1:ent", "attribute": "span_type", "before": ["HEADER"], "after": ["TOTAL"]}],
+    }]
+
+def test_journaled_ignores_failed_blocks(corpus):
+    with pytest.raises(RuntimeError):
+        with journal.journaled(corpus, "annotate", [("P008001:1:ent", "span_type")]):
+            corpus.execute("DELETE FROM ObjectAttributeValue WHERE UID = 'P008001:1:ent'")
+            raise RuntimeError
+    assert journal.latest_seq(corpus) == 0
+
+def test_changes_since(corpus):
+    version = journal.database_version(corpus)
+    assert journal.changes_since(version, corpus) == []
+    assert journal.changes_since(None, corpus) is None
+    journal.append(corpus, {"command": "test"})
+    assert journal.changes_since(version, corpus) == [{"command": "test"}]
+    # a version from another database, or from the future
+    assert journal.changes_since("0-0000000000000000", corpus) is None
+    assert journal.changes_since(f"5-{version.split('-')[1]}", corpus) is None
+
+def change(before, after, uid="P008001:1:ent"):
+    return {"command": "annotate", "attributes": [{"uid": uid, "attribute": "span_type", "before": before, "after": after}]}
+
+def test_apply_attributes(corpus):
+    assert journal.apply_attributes(corpus, change(["HEADER"], ["TOTAL"])) == []
+    assert values(corpus, "P008001:1:ent", "span_type") == ["TOTAL"]
+    # already applied
+    assert journal.apply_attributes(corpus, change(["HEADER"], ["TOTAL"])) == []
+    assert values(corpus, "P008001:1:ent", "span_type") == ["TOTAL"]
+
+def test_apply_attributes_conflict(corpus):
+    conflicts = journal.apply_attributes(corpus, change(["OTHER"], ["TOTAL"]))
+    assert conflicts == [("P008001:1:ent", "span_type", ["OTHER"], ["HEADER"])]
+    assert values(corpus, "P008001:1:ent", "span_type") == ["HEADER"]
+    assert journal.apply_attributes(corpus, change(["OTHER"], ["TOTAL"]), theirs=True) == conflicts
+    assert values(corpus, "P008001:1:ent", "span_type") == ["TOTAL"]
+
+def test_apply_attributes_missing_uid(corpus):
+    conflicts = journal.apply_attributes(corpus, change([], ["TOTAL"], uid="P009999:1:ent"))
+    assert conflicts == [("P009999:1:ent", "span_type", [], "no such UID")]
+    assert values(corpus, "P009999:1:ent", "span_type") == []
+
+def test_apply_attributes_keeps_unchanged_values(corpus):
+    corpus.execute("INSERT INTO ObjectAttributeValue VALUES ('P008001:1:ent', 'span_type', 'TOTAL')")
+    assert journal.apply_attributes(corpus, change(["HEADER", "TOTAL"], ["SUBTOTAL", "TOTAL"])) == []
+    assert values(corpus, "P008001:1:ent", "span_type") == ["SUBTOTAL", "TOTAL"]
@@ -0,0 +1,84 @@
+import pytest
+
+from clee import query, selection
+from clee.cli_util import is_sign, signlist, token_key
+
+def test_query_tokenize():
+    assert query.tokenize('numeral decimal>=10 or (first and @mine)') == \
+        ["numeral", "decimal", ">=", "10", "or", "(", "first", "and", "@mine", ")"]
+    assert query.tokenize('span_type="in total"') == ["span_type", "=", "in total"]
+    assert query.tokenize("next has |M056+M288|") == ["next", "has", "|M056+M288|"]
+
+def test_query_parse():
+    assert query.parse("has M56 and not span_type=HEADER") == \
+        ("and", ("has", "M056"), ("not", ("attribute", "span_type", "HEADER")))
+    # and binds tighter than or
+    assert query.parse("first or last and has M288") == \
+        ("or", ("first",), ("and", ("last",), ("has", "M288")))
+    assert query.parse("numeral >= 10 or (first and @mine)") == \
+        ("or", ("numeral", None, ">=", 10.0), ("and", ("first",), ("selection", "@mine")))
+    assert query.parse("next has |m56+m288|") == ("next", ("has", "M056+M288"))
+    assert query.parse("provenience!=Susa but last") == \
+        ("and", ("not", ("attribute", "provenience", "Susa")), ("last",))
+
+@pytest.mark.parametrize("text", ["has", "has foo", "numeral >= many", "(first", "first last", "frobnicate"])
+def test_query_parse_errors(text):
+    with pytest.raises(ValueError):
+        query.parse(text)
+
+def test_selection_tokenize():
+    assert selection.tokenize("M288 and (@mine or comment:1) but not |M056+M288|") == \
+        ["M288", "and", "(", "@mine", "or", "comment:1", ")", "but", "not", "|M056+M288|"]
+
+def test_split_filter():
+    assert selection.split_filter("M288") == ("M288", None)
+    # inside quotes, " in " is part of the value
+    assert selection.split_filter('span_type="in total"') == ('span_type="in total"', None)
+    line, bits = selection.split_filter("M056 in M288 and not M388")
+    assert line == "M056"
+    assert list(selection.tablets(bits)) == ["P008002"]
+    line, bits = selection.split_filter("span_type='a in b' in P008003")
+    assert line == "span_type='a in b'"
+    assert list(selection.tablets(bits)) == ["P008003"]
+
+def test_selection_evaluate():
+    assert list(selection.tablets(selection.evaluate("M388 or M157~A"))) == ["P008001", "P008002", "P008003"]
+    assert list(selection.tablets(selection.evaluate("M056+M288"))) == ["P008001"]
+    assert list(selection.tablets(selection.evaluate("not (M388 or commented)"))) == ["P008002"]
+    with pytest.raises(ValueError):
+        selection.evaluate("M288 and")
+
+def test_token_key():
+    assert token_key("P008001:6:sgn:0") == (6, 0)
+    assert token_key("P008001:6:sgn:12:1") == (6, 12, 1)
+    uids = ["P008001:10:sgn:0", "P008001:2:sgn:10", "P008001:2:sgn:2:1", "P008001:2:sgn:2"]
+    assert sorted(uids, key=token_key) == \
+        ["P008001:2:sgn:2", "P008001:2:sgn:2:1", "P008001:2:sgn:10", "P008001:10:sgn:0"]
+
+@pytest.mark.parametrize("text, sign", [
+    ("m288", "M288"),
+    ("|M056+M288|", "M056+M288"),
+    ("3(N01)", "N01"),
+    ("M157~A", "M157~A"),
+    ("M4~b", "M4~B"),
+    ("foo", False),
+    ("P008001", False),
+])
+def test_is_sign(text, sign):
+    assert is_sign(text) == sign
+
+@pytest.mark.parametrize("name, normal", [
+    ("M56", "M056"),
+    ("m288", "M288"),
+    ("|m56+m288|", "M056+M288"),
+    ("M4~B", "M004~B"),
+    ("MXX", "MXXX"),
+    ("N01", "N01"),
+])
+def test_normalize(name, normal):
+    assert signlist.normalize(name) == normal
+
+def test_signlist_lookup():
+    assert signlist.id("M56") == 1
+    assert signlist.ids("m004~b") == [9]
+    assert signlist.ids("M999") == []
@@ -0,0 +1,25 @@
+import pytest
+
+from clee import similar, snapshot
+
+@pytest.fixture
+def built(tmp_path):
+    path = str(tmp_path / "snapshot")
+    snapshot.build(path)
+    return snapshot.load(path)
+
+def test_snapshot_is_current(built):
+    assert built.is_current()
+
+def test_sequences_agree(built, monkeypatch):
+    monkeypatch.setattr(snapshot, "current", lambda: None)
+    from_db = similar.sign_sequences()
+    monkeypatch.setattr(snapshot, "current", lambda: built)
+    from_snapshot = similar.sign_sequences()
+    assert from_snapshot == from_db
+    # 3(N01) ending the first entry, then M157, the CG M056+M288, 2(N14) and 1(N01)
+    assert from_db["P008001"][2:7] == ["6", "4", "1+2", "7", "6"]
+    # signs which aren't in the signlist are left out, also from CGs
+    assert from_db["P008002"] == ["2", "1", "6", "5", "7"]
+    assert from_db["P008003"][3:5] == ["3", "1"]
+    assert similar.sign_sequences(["P008001"]) == {"P008001": from_db["P008001"]}